@@ -0,0 +1,146 @@
+import asyncio
+import math
+import os
+import time
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from app.metrics import counter, gauge, histogram
+
+ADMISSION_IN_FLIGHT = gauge(
+    "admission_in_flight", "Requests currently holding an admission slot", ["pool"]
+)
+ADMISSION_QUEUE_DEPTH = gauge(
+    "admission_queue_depth", "Requests waiting for an admission slot", ["pool"]
+)
+ADMISSION_WAIT_SECONDS = histogram(
+    "admission_wait_seconds", "Time spent waiting for an admission slot", ["pool"]
+)
+ADMISSION_REJECTED = counter(
+    "admission_rejected_total", "Requests rejected by admission control", ["pool", "reason"]
+)
+
+
+class Slot:
+    """An acquired admission slot. Releasing it more than once is a no-op."""
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+class AdmissionController:
+    """
+    Bounds the number of concurrent requests of one kind.
+
+    Up to `limit` requests run at once and up to `max_queue` more wait for a
+    slot for at most `queue_timeout` seconds. Requests beyond the queue are
+    rejected immediately with 429, requests whose wait times out get 503; both
+    carry a `Retry-After` header.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self._waiting = 0
+        self._in_flight = 0
+
+    @classmethod
+    def from_env(cls, name: str, limit: int, max_queue: int, queue_timeout: float) -> "AdmissionController":
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name=name,
+            limit=int(os.getenv(f"{prefix}_LIMIT", limit)),
+            max_queue=int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+            queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", queue_timeout)),
+        )
+
+    def _retry_after(self) -> str:
+        # rough guess: one queue timeout per full round of waiting requests
+        rounds = (self._waiting + 1) / max(self.limit, 1)
+        return str(max(1, math.ceil(rounds * self.queue_timeout)))
+
+    def _reject(self, status_code: int, reason: str, detail: str):
+        ADMISSION_REJECTED.inc(pool=self.name, reason=reason)
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": self._retry_after()},
+        )
+
+    async def acquire(self) -> Slot:
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            self._reject(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "queue_full",
+                f"Too many concurrent {self.name} requests, please retry later",
+            )
+
+        self._waiting += 1
+        ADMISSION_QUEUE_DEPTH.set(self._waiting, pool=self.name)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "queue_timeout",
+                f"Timed out waiting for a free {self.name} slot, please retry later",
+            )
+        finally:
+            self._waiting -= 1
+            ADMISSION_QUEUE_DEPTH.set(self._waiting, pool=self.name)
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, pool=self.name)
+
+        self._in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self._in_flight, pool=self.name)
+        return Slot(self)
+
+    def _release(self):
+        self._in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self._in_flight, pool=self.name)
+        self._semaphore.release()
+
+    async def __call__(self):
+        """FastAPI dependency that holds a slot until the response has been built."""
+        slot = await self.acquire()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    async def stream_slot(self):
+        """
+        FastAPI dependency for streamed responses, whose slot outlives the
+        handler and is released by the stream. It is only released here if the
+        request fails before the response takes it over.
+        """
+        slot = await self.acquire()
+        try:
+            yield slot
+        except BaseException:
+            slot.release()
+            raise
+
+
+# Separate pools: ingestion can never occupy the slots of interactive chat.
+# The ingest limit also stays well below the default threadpool size (40), so
+# the sync ingest handlers leave worker threads free for chat dependencies.
+chat_stream_admission = AdmissionController.from_env(
+    "chat_stream", limit=32, max_queue=64, queue_timeout=10.0
+)
+chat_request_admission = AdmissionController.from_env(
+    "chat_request", limit=16, max_queue=32, queue_timeout=10.0
+)
+ingest_admission = AdmissionController.from_env(
+    "ingest", limit=4, max_queue=16, queue_timeout=30.0
+)
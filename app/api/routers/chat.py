@@ -1,19 +1,44 @@
+import asyncio
+import gzip
+import os
+import time
 from pydantic import BaseModel
-from typing import List, Any, Optional, Dict, Tuple
-from fastapi import APIRouter, Depends, HTTPException, Request, status
+from typing import AsyncIterator, List, Any, Literal, Optional, Dict, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from starlette.background import BackgroundTask
 from llama_index.core.chat_engine.types import (
     BaseChatEngine,
     StreamingAgentChatResponse,
 )
 from llama_index.core.schema import NodeWithScore
 from llama_index.core.llms import ChatMessage, MessageRole
+from app.admission import Slot, chat_request_admission, chat_stream_admission
 from app.engine import get_chat_engine
+from app.engine.scope import Scope
+from app.engine.sessions import SessionTurn, chat_sessions
+from app.engine.sources import (
+    SNIPPET_CHARS,
+    SNIPPET_METADATA_KEYS,
+    default_source_mode,
+    get_source_node,
+    query_terms,
+    snippet,
+    source_cache,
+)
 from app.api.routers.vercel_response import VercelStreamResponse
 from app.api.routers.messaging import EventCallbackHandler
+from app.metrics import CHAT_TOKENS_PER_SECOND, ChatTrace, current_chat_trace
 from aiostream import stream
 
 chat_router = r = APIRouter()
 
+# smaller JSON bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+MAX_CHAT_NAMESPACES = int(os.getenv("MAX_CHAT_NAMESPACES", "10"))
+
+SourceMode = Literal["ids", "snippet", "full"]
+
 
 class _Message(BaseModel):
     role: MessageRole
@@ -22,6 +47,13 @@ class _Message(BaseModel):
 
 class _ChatData(BaseModel):
     messages: List[_Message]
+    scope: Optional[Scope] = None
+    # searched concurrently, the default namespace if not given
+    namespaces: Optional[List[str]] = None
+    # defaults to SOURCE_PAYLOAD_MODE
+    source_mode: Optional[SourceMode] = None
+    # from POST /api/chat/sessions; the server keeps the history, send only the new message
+    session_id: Optional[str] = None
 
     class Config:
         json_schema_extra = {
@@ -31,34 +63,82 @@ class _ChatData(BaseModel):
                         "role": "user",
                         "content": "What standards for letters exist?",
                     }
-                ]
+                ],
+                "scope": {"folder": "Projects/Alpha", "file_types": ["pdf", "docx"]},
             }
         }
 
 
 class _SourceNodes(BaseModel):
+    """
+    A source of the answer. Depending on the source mode it carries only the
+    id and score ("ids"), a snippet of the text with a few metadata keys
+    ("snippet") or the full text and metadata ("full"). Fields that a mode
+    doesn't fill are left out of the response; the full source can be fetched
+    from `/api/chat/sources/{id}`.
+    """
+
     id: str
-    metadata: Dict[str, Any]
     score: Optional[float]
-    text: str
+    metadata: Optional[Dict[str, Any]] = None
+    text: Optional[str] = None
+    # snippet mode: offset of the snippet in the full text and the query term
+    # matches, as (start, end) offsets into the snippet
+    offset: Optional[int] = None
+    truncated: Optional[bool] = None
+    highlights: Optional[List[Tuple[int, int]]] = None
 
     @classmethod
-    def from_source_node(cls, source_node: NodeWithScore):
+    def from_source_node(
+        cls, source_node: NodeWithScore, mode: SourceMode = "full", terms: Optional[List[str]] = None
+    ):
+        node = source_node.node
+        if mode == "ids":
+            return cls(id=node.node_id, score=source_node.score)
+        if mode == "snippet":
+            text, offset, highlights = snippet(node.text, terms or [], SNIPPET_CHARS)  # type: ignore
+            return cls(
+                id=node.node_id,
+                score=source_node.score,
+                metadata={key: node.metadata[key] for key in SNIPPET_METADATA_KEYS if key in node.metadata},
+                text=text,
+                offset=offset,
+                truncated=len(text) < len(node.text),  # type: ignore
+                highlights=highlights,
+            )
         return cls(
-            id=source_node.node.node_id,
-            metadata=source_node.node.metadata,
+            id=node.node_id,
+            metadata=node.metadata,
             score=source_node.score,
-            text=source_node.node.text,  # type: ignore
+            text=node.text,  # type: ignore
         )
 
     @classmethod
-    def from_source_nodes(cls, source_nodes: List[NodeWithScore]):
-        return [cls.from_source_node(node) for node in source_nodes]
+    def from_source_nodes(
+        cls,
+        source_nodes: List[NodeWithScore],
+        mode: SourceMode = "full",
+        terms: Optional[List[str]] = None,
+        namespaces: Optional[List[str]] = None,
+    ):
+        namespaces = sorted(set(namespaces)) if namespaces else [""]
+        # the merged results of several namespaces don't tell which one a node came from,
+        # those are fetched from the vector store of the requested namespace instead
+        if mode != "full" and len(namespaces) == 1:
+            # keep them around for the lazy full-text fetch
+            for source_node in source_nodes:
+                source_cache.put(namespaces[0], source_node.node)
+        return [cls.from_source_node(node, mode, terms) for node in source_nodes]
 
 
 class _Result(BaseModel):
     result: _Message
     nodes: List[_SourceNodes]
+    session_id: Optional[str] = None
+
+
+class _Session(BaseModel):
+    session_id: str
 
 
 async def parse_chat_data(data: _ChatData) -> Tuple[str, List[ChatMessage]]:
@@ -85,24 +165,125 @@ async def parse_chat_data(data: _ChatData) -> Tuple[str, List[ChatMessage]]:
     return last_message.content, messages
 
 
+async def begin_session_turn(
+    data: _ChatData, question: str, messages: List[ChatMessage]
+) -> Tuple[Optional[SessionTurn], List[ChatMessage]]:
+    """
+    Without a session id, the history is the one sent by the client. With one,
+    it is the session's; earlier messages in the request only seed a new session.
+    """
+    if data.session_id is None:
+        return None, messages
+    session = chat_sessions.get(data.session_id)
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Chat session {data.session_id} not found, it may have expired",
+        )
+    try:
+        turn = await chat_sessions.begin_turn(session, question)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Chat session {data.session_id} is still answering the previous message",
+        )
+    if messages:
+        if session.turns or session.messages:
+            turn.release()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The session keeps the history, send only the new message",
+            )
+        session.messages = messages
+    return turn, session.chat_history()
+
+
+async def chat_turn(data: _ChatData) -> AsyncIterator[Tuple[str, Optional[SessionTurn], List[ChatMessage]]]:
+    """
+    FastAPI dependency with the question, the session turn and the history of
+    a chat request. It comes before the admission slot and the chat engine, so
+    waiting for the previous turn of the session holds neither. The turn is
+    only released here if the request fails before the response takes it over.
+    """
+    question, messages = await parse_chat_data(data)
+    turn, messages = await begin_session_turn(data, question, messages)
+    try:
+        yield question, turn, messages
+    except BaseException:
+        if turn is not None:
+            turn.release()
+        raise
+
+
+def get_scoped_chat_engine(data: _ChatData) -> BaseChatEngine:
+    # shares the request body with the endpoint, FastAPI parses it once
+    if data.namespaces and len(data.namespaces) > MAX_CHAT_NAMESPACES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_CHAT_NAMESPACES} namespaces can be searched at once",
+        )
+    return get_chat_engine(
+        filter=data.scope.to_filter() if data.scope else None,
+        namespaces=sorted(set(data.namespaces)) if data.namespaces else None,
+    )
+
+
+def _json_response(request: Request, body: BaseModel) -> Response:
+    """Serialize without the fields the source mode left out, gzip if the client accepts it."""
+    content = body.json(exclude_unset=True).encode("utf-8")
+    headers = {"Vary": "Accept-Encoding"}
+    if len(content) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        content = gzip.compress(content, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
 # streaming endpoint - delete if not needed
 @r.post("")
 async def chat(
     request: Request,
     data: _ChatData,
-    chat_engine: BaseChatEngine = Depends(get_chat_engine),
+    # resolved in this order: the engine is only built for admitted requests
+    chat_input: Tuple[str, Optional[SessionTurn], List[ChatMessage]] = Depends(chat_turn),
+    # the slot is held for the whole stream, not just until the handler returns
+    slot: Slot = Depends(chat_stream_admission.stream_slot),
+    chat_engine: BaseChatEngine = Depends(get_scoped_chat_engine),
 ):
-    last_message_content, messages = await parse_chat_data(data)
+    last_message_content, turn, messages = chat_input
+    source_mode = data.source_mode or default_source_mode()
+    trace = ChatTrace("chat")
+    current_chat_trace.set(trace)
 
     event_handler = EventCallbackHandler()
     chat_engine.callback_manager.handlers.append(event_handler)  # type: ignore
-    response = await chat_engine.astream_chat(last_message_content, messages)
+    try:
+        response = await chat_engine.astream_chat(last_message_content, messages)
+    except BaseException:
+        chat_engine.callback_manager.remove_handler(event_handler)
+        if turn is not None:
+            turn.release()
+        slot.release()
+        raise
+    answer: List[str] = []
+    # only an answer that reached the client in full is recorded in the session
+    completed = False
 
     async def content_generator():
+        nonlocal completed
         # Yield the text response
         async def _text_generator():
+            tokens = 0
+            generation_start = time.perf_counter()
             async for token in response.async_response_gen():
+                if tokens == 0:
+                    trace.observe("time_to_first_token", time.perf_counter() - trace.start)
+                tokens += 1
+                answer.append(token)
                 yield VercelStreamResponse.convert_text(token)
+            generation_time = time.perf_counter() - generation_start
+            trace.observe("generation", generation_time)
+            if tokens and generation_time > 0:
+                CHAT_TOKENS_PER_SECOND.observe(tokens / generation_time)
             # the text_generator is the leading stream, once it's finished, also finish the event stream
             event_handler.is_done = True
 
@@ -116,39 +297,117 @@ async def chat(
                     }
                 )
 
-        combine = stream.merge(_text_generator(), _event_generator())
-        async with combine.stream() as streamer:
-            async for item in streamer:
-                if await request.is_disconnected():
-                    break
-                yield item
-
-        # Yield the source nodes
-        yield VercelStreamResponse.convert_data(
-            {
-                "type": "sources",
-                "data": {
-                    "nodes": [
-                        _SourceNodes.from_source_node(node).dict()
-                        for node in response.source_nodes
-                    ]
-                },
-            }
-        )
+        try:
+            combine = stream.merge(_text_generator(), _event_generator())
+            async with combine.stream() as streamer:
+                async for item in streamer:
+                    if await request.is_disconnected():
+                        return
+                    yield item
 
-    return VercelStreamResponse(content=content_generator())
+            # Yield the source nodes
+            with trace.timer("source_serialization"):
+                sources = VercelStreamResponse.convert_data(
+                    {
+                        "type": "sources",
+                        "data": {
+                            "nodes": [
+                                node.dict(exclude_unset=True)
+                                for node in _SourceNodes.from_source_nodes(
+                                    response.source_nodes,
+                                    source_mode,
+                                    query_terms(last_message_content),
+                                    data.namespaces,
+                                )
+                            ]
+                        },
+                    }
+                )
+            yield sources
+            trace.observe("total", time.perf_counter() - trace.start)
+            completed = True
+        finally:
+            # the callback manager is shared between requests, don't let handlers pile up
+            if event_handler in chat_engine.callback_manager.handlers:
+                chat_engine.callback_manager.remove_handler(event_handler)
+            slot.release()
+            # Starlette skips the background task of a stream that raised,
+            # a failed or abandoned turn can't wait for it to release the session
+            if turn is not None and not completed:
+                turn.release()
+
+    async def finish():
+        slot.release()
+        # the summary is updated after the stream is closed, the next turn waits for it
+        if turn is not None:
+            await turn.finish("".join(answer) if completed else "")
+
+    # the background task covers streams that end before the generator starts
+    return VercelStreamResponse(content=content_generator(), background=BackgroundTask(finish))
 
 
 # non-streaming endpoint - delete if not needed
 @r.post("/request")
 async def chat_request(
+    request: Request,
     data: _ChatData,
-    chat_engine: BaseChatEngine = Depends(get_chat_engine),
+    chat_input: Tuple[str, Optional[SessionTurn], List[ChatMessage]] = Depends(chat_turn),
+    slot: Slot = Depends(chat_request_admission),
+    chat_engine: BaseChatEngine = Depends(get_scoped_chat_engine),
 ) -> _Result:
-    last_message_content, messages = await parse_chat_data(data)
+    last_message_content, turn, messages = chat_input
+    source_mode = data.source_mode or default_source_mode()
+
+    trace = ChatTrace("chat_request")
+    current_chat_trace.set(trace)
 
-    response = await chat_engine.achat(last_message_content, messages)
-    return _Result(
-        result=_Message(role=MessageRole.ASSISTANT, content=response.response),
-        nodes=_SourceNodes.from_source_nodes(response.source_nodes),
+    try:
+        response = await chat_engine.achat(last_message_content, messages)
+        with trace.timer("source_serialization"):
+            nodes = _SourceNodes.from_source_nodes(
+                response.source_nodes, source_mode, query_terms(last_message_content), data.namespaces
+            )
+    except BaseException:
+        if turn is not None:
+            turn.release()
+        raise
+    trace.observe("total", time.perf_counter() - trace.start)
+    result = _json_response(
+        request,
+        _Result(
+            result=_Message(role=MessageRole.ASSISTANT, content=response.response),
+            nodes=nodes,
+            **({"session_id": data.session_id} if data.session_id else {}),
+        ),
     )
+    if turn is not None:
+        # the summary is updated after the response is sent, the next turn waits for it
+        result.background = BackgroundTask(turn.finish, response.response)
+    return result
+
+
+@r.post("/sessions", status_code=status.HTTP_201_CREATED)
+def create_chat_session() -> _Session:
+    """Start a conversation whose history the server keeps, see `_ChatData.session_id`."""
+    return _Session(session_id=chat_sessions.create().id)
+
+
+@r.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_chat_session(session_id: str):
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Chat session {session_id} not found",
+        )
+
+
+@r.get("/sources/{node_id}")
+def chat_source(request: Request, node_id: str, namespace: str = "") -> _SourceNodes:
+    """Full text and metadata of a source, for clients that received ids or snippets."""
+    node = get_source_node(node_id, namespace)
+    if node is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Source {node_id} not found",
+        )
+    return _json_response(request, _SourceNodes.from_source_node(NodeWithScore(node=node)))
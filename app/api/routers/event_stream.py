@@ -0,0 +1,26 @@
+import json
+from typing import Any
+from fastapi.responses import StreamingResponse
+
+
+class EventStreamResponse(StreamingResponse):
+    """
+    Class to stream events to the client as Server-Sent Events
+    """
+
+    HEARTBEAT = ": keep-alive\n\n"
+
+    @classmethod
+    def convert_event(cls, event: str, data: dict):
+        # JSON keeps the data on one line, as SSE requires
+        data_str = json.dumps(data)
+        return f"event: {event}\ndata: {data_str}\n\n"
+
+    def __init__(self, content: Any, **kwargs):
+        super().__init__(
+            content=content,
+            media_type="text/event-stream",
+            # proxies must pass the events on as they come
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            **kwargs,
+        )
@@ -1,56 +1,57 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, File, UploadFile, HTTPException, Depends, Request
+import asyncio
+from typing import Dict, List, Optional
+from collections import Counter
 from pydantic import BaseModel, Field, validator
 import os
 import tempfile
 import shutil
 import logging
-import requests
+import time
+import functools
+import httpx
 import urllib.parse
-from requests.auth import HTTPBasicAuth
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.core.readers import SimpleDirectoryReader
-from llama_index.vector_stores.pinecone import PineconeVectorStore
-from llama_index.core.storage import StorageContext
-from llama_index.core.indices import VectorStoreIndex
 from llama_parse import LlamaParse
-import firebase_admin
-import base64
-from firebase_admin import credentials, firestore
+from app.engine.index import get_vector_store
+from app.engine.ingestion import index_documents
+from app.engine.loaders.memory import load_buffer, new_spool, parses_in_memory
+from app.engine.scope import add_scope_metadata, normalize_folder
+from app.engine.namespaces import group_by_namespace
+from app.engine.ledger import assign_ingest_ids, record_ingestion
+from app.metrics import INGEST_STAGE_SECONDS
+from app.progress import ProgressReporter, current_progress, progress_broker, report
+from app.api.routers.event_stream import EventStreamResponse
+from app.admission import ingest_admission
+from app.clients import http_clients
+from app.uploads import (
+    SUPPORTED_FILE_TYPES,
+    UPLOAD_CHUNK_SIZE,
+    StagedUpload,
+    check_upload,
+    ingest_jobs,
+    max_upload_files,
+    stage_upload,
+)
 
-encoded_key = os.getenv('FIREBASE_PRIVATE_KEY_BASE64')
-
-# Decode the Base64 string
-decoded_key = base64.b64decode(encoded_key).decode('utf-8')
-
-firebase_config = {
-    "type": os.getenv("FIREBASE_TYPE"),
-    "project_id": os.getenv("FIREBASE_PROJECT_ID"),
-    "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
-    "private_key": decoded_key, # Properly format the private key
-    "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
-    "client_id": os.getenv("FIREBASE_CLIENT_ID"),
-    "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
-    "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
-    "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL")
-}
-
-# Initialize Firebase Admin with the constructed configuration
-cred = credentials.Certificate(firebase_config)
-firebase_admin.initialize_app(cred)
-
-# Initialize Firebase
-
-
-db = firestore.client()
 
 # Router setup
 ingest_router = APIRouter()
 
 temp_dir = tempfile.mkdtemp()
 
+# idle progress streams send a comment this often, so proxies keep them open
+PROGRESS_HEARTBEAT_SECONDS = 15
+# streams of ids that no job or process-files call has used by then are closed
+PROGRESS_UNKNOWN_SECONDS = float(os.getenv("INGEST_PROGRESS_UNKNOWN_TIMEOUT", "60"))
+
 class Filenames(BaseModel):
     filenames: List[str] = Field(..., example=["file1.txt", "file2.docx"])
+    # indexes into this tenant's namespace instead of routing by folder
+    tenant_id: Optional[str] = None
+    # chosen by the client, follow the ingestion at /progress/{progress_id}
+    progress_id: Optional[str] = None
 
 class FileLoaderConfig(BaseModel):
     data_dir: str = temp_dir
@@ -64,14 +65,22 @@ class FileLoaderConfig(BaseModel):
             raise ValueError(f"Path '{v}' is not a directory")
         return v
 
+@functools.lru_cache(maxsize=1)
 def llama_parse_parser():
+    """The LlamaParse parser, shared by all ingestions; llama-parse 0.4 opens its own HTTP client per file."""
     if os.getenv("LLAMA_CLOUD_API_KEY") is None:
         raise ValueError("LLAMA_CLOUD_API_KEY environment variable is not set.")
     return LlamaParse(result_type="markdown", verbose=True, language="de")
 
 # Configuration using environment variables
 base_url = os.getenv('WEBDAV_URL') + '/files/' + os.getenv('WEBDAV_LOGIN') + '/'
-auth = HTTPBasicAuth(os.getenv('WEBDAV_LOGIN'), os.getenv('WEBDAV_PASSWORD'))
+auth = httpx.BasicAuth(os.getenv('WEBDAV_LOGIN'), os.getenv('WEBDAV_PASSWORD'))
+
+def _local_path(temp_dir: str, filename: str) -> str:
+    # mirrors the server folders, so that files of the same name in different folders don't collide
+    folder = [part for part in normalize_folder(os.path.dirname(filename)).split("/") if part not in ("", ".", "..")]
+    return os.path.join(temp_dir, *folder, os.path.basename(filename))
+
 
 def check_and_download_file(filename: str, temp_dir: str):
     """Check if the file exists on the server and download it if it does."""
@@ -84,86 +93,309 @@ def check_and_download_file(filename: str, temp_dir: str):
         </d:prop>
     </d:propfind>
     '''
-    with requests.Session() as session:
-        session.auth = auth
-        response = session.request("PROPFIND", url, headers=headers, data=propfind_body)
-        if response.status_code == 207:
-            local_path = os.path.join(temp_dir, os.path.basename(filename))
-            response_get = session.get(url)
+    client = http_clients.client("webdav")
+    response = client.request("PROPFIND", url, headers=headers, content=propfind_body, auth=auth)
+    if response.status_code == 207:
+        local_path = _local_path(temp_dir, filename)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with client.stream("GET", url, auth=auth) as response_get:
             if response_get.status_code == 200:
                 with open(local_path, 'wb') as f:
-                    f.write(response_get.content)
+                    for chunk in response_get.iter_bytes(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
                 return local_path
     return None
 
 
+def download_to_buffer(filename: str):
+    """Download a file from the server into a spooled buffer, or return None if it doesn't exist."""
+    url = base_url + urllib.parse.quote(filename)
+    with http_clients.client("webdav").stream("GET", url, auth=auth) as response:
+        if response.status_code != 200:
+            return None
+        buffer = new_spool()
+        for chunk in response.iter_bytes(UPLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        return buffer
+
+
+def _in_memory(filename: str, use_llama_parse: bool) -> bool:
+    # LlamaParse reads files from disk, the local extractors read buffers
+    return not use_llama_parse and parses_in_memory(filename)
+
+
+def parse_concurrency() -> int:
+    return int(os.getenv("INGEST_PARSE_CONCURRENCY", "4"))
+
+
+def ingest_staged_batch(
+    uploads: List[StagedUpload], folder: str, tenant_id: Optional[str], use_llama_parse: bool
+) -> Dict[str, Dict]:
+    """
+    Parse, index and record staged uploads; returns the result per file name.
+    Files are parsed in parallel with one shared parser. Their nodes are
+    embedded together, so the embedding requests are full batches, and upserted
+    with one vector store per namespace. Runs in a background worker thread.
+    """
+    file_extractor = {}
+    if use_llama_parse:
+        parser = llama_parse_parser()
+        file_extractor = {file_type: parser for file_type in SUPPORTED_FILE_TYPES}
+
+    def parse(upload: StagedUpload):
+        with INGEST_STAGE_SECONDS.time(stage="parse"):
+            if upload.buffer is not None:
+                return load_buffer(upload.filename, upload.buffer)
+            return SimpleDirectoryReader(input_files=[upload.path], file_extractor=file_extractor).load_data()
+
+    results: Dict[str, Dict] = {}
+    documents = []
+    with ThreadPoolExecutor(max_workers=max(1, min(parse_concurrency(), len(uploads)))) as executor:
+        for upload, future in [(upload, executor.submit(parse, upload)) for upload in uploads]:
+            try:
+                parsed = future.result()
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Failed to parse {upload.filename}: {e}", exc_info=True)
+                results[upload.filename] = {"status": "failed", "error": str(e)}
+                report("failed", upload.filename, error=str(e))
+                continue
+            documents.extend(parsed)
+            report("parsed", upload.filename, documents=len(parsed))
+            results[upload.filename] = {"status": "done", "documents": len(parsed), "nodes": 0}
+
+    add_scope_metadata(documents, default_folder=folder, source="upload")
+    assign_ingest_ids(documents)
+    sha256 = {upload.filename: upload.sha256 for upload in uploads}
+    for namespace, group in group_by_namespace(documents, tenant_id).items():
+        nodes = index_documents(group, get_vector_store(namespace), namespace=namespace)
+        with INGEST_STAGE_SECONDS.time(stage="bookkeeping"):
+            for file_name in {document.metadata["file_name"] for document in group}:
+                file_documents = [document for document in group if document.metadata["file_name"] == file_name]
+                file_nodes = [node for node in nodes if node.metadata.get("file_name") == file_name]
+                record_ingestion(namespace, file_documents, file_nodes, sha256=sha256.get(file_name))
+                results[file_name]["nodes"] += len(file_nodes)
+    return results
+
+
+def ingest_staged_upload(upload: StagedUpload, folder: str, tenant_id: Optional[str], use_llama_parse: bool) -> Dict:
+    result = ingest_staged_batch([upload], folder, tenant_id, use_llama_parse)[upload.filename]
+    if result["status"] == "failed":
+        raise RuntimeError(result["error"])
+    return {"documents": result["documents"], "nodes": result["nodes"]}
+
+
+def submit_upload(upload: StagedUpload, folder: str, tenant_id: Optional[str], use_llama_parse: bool) -> Dict:
+    job = ingest_jobs.submit(
+        lambda: ingest_staged_upload(upload, folder, tenant_id, use_llama_parse),
+        cleanup=upload.cleanup,
+        filename=upload.filename,
+        size=upload.size,
+        sha256=upload.sha256,
+    )
+    return {"message": "File accepted for processing", **job.to_dict()}
+
+
+async def _upload_chunks(file: UploadFile):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
 # sinngle file upload
-@ingest_router.post("/upload-file", response_model=dict)
-def upload_file(file: UploadFile = File(...), config: FileLoaderConfig = Depends()):
-    logger = logging.getLogger(__name__)
-    file_path = os.path.join(config.data_dir, file.filename)
+@ingest_router.post(
+    "/upload-file", response_model=dict, status_code=202, dependencies=[Depends(ingest_admission)]
+)
+async def upload_file(
+    file: UploadFile = File(...),
+    folder: str = "",
+    tenant_id: Optional[str] = None,
+    use_llama_parse: bool = True,
+):
+    """
+    Stage the uploaded file and queue it for ingestion; poll `/jobs/{job_id}`
+    for the result.
+    """
+    check_upload(file.filename, file.size)
+    upload = await stage_upload(
+        file.filename, _upload_chunks(file), in_memory=_in_memory(file.filename, use_llama_parse)
+    )
+    logging.getLogger(__name__).info(f"Staged {upload.filename} ({upload.size} bytes, sha256 {upload.sha256})")
+    return submit_upload(upload, folder, tenant_id, use_llama_parse)
+
+
+@ingest_router.post(
+    "/upload-files", response_model=dict, status_code=202, dependencies=[Depends(ingest_admission)]
+)
+async def upload_files(
+    files: List[UploadFile] = File(...),
+    folder: str = "",
+    tenant_id: Optional[str] = None,
+    use_llama_parse: bool = True,
+):
+    """
+    Stage several files and queue them for ingestion as one job. Files that
+    are rejected are reported per file, the others are ingested.
+    """
+    if len(files) > max_upload_files():
+        raise HTTPException(status_code=400, detail=f"At most {max_upload_files()} files per request")
+    uploads: List[StagedUpload] = []
+    # in request order, a rejected duplicate must not hide the accepted file of the same name
+    results: List[Dict] = []
     try:
-        # Save uploaded file
-        with open(file_path, 'wb') as f:
-            shutil.copyfileobj(file.file, f)
-        
-        logger.info(f"Uploaded {file.filename} to {file_path}")
-
-        # Process the file using SimpleDirectoryReader, similar to /process-files
-        if config.use_llama_parse:
-            reader = SimpleDirectoryReader(config.data_dir, recursive=True)
-            parser = llama_parse_parser()
-            supported_file_types = [".pdf", ".doc", ".docx", ".pptx", ".txt", ".rtf", ".pages", ".key", ".epub"]
-            reader.file_extractor = {file_type: parser for file_type in supported_file_types}
-            processed_documents = reader.load_data()
-
-            # Setup Pinecone integration if required
-            if config.use_llama_parse:
-                store = PineconeVectorStore(
-                    api_key=os.getenv("PINECONE_API_KEY"),
-                    index_name=os.getenv("PINECONE_INDEX_NAME"),
-                    environment=os.getenv("PINECONE_ENVIRONMENT"),
+        for file in files:
+            try:
+                name = check_upload(file.filename, file.size)
+                if any(upload.filename == name for upload in uploads):
+                    raise HTTPException(status_code=400, detail="Duplicate file name in this request")
+                upload = await stage_upload(
+                    name, _upload_chunks(file), in_memory=_in_memory(name, use_llama_parse)
+                )
+            except HTTPException as e:
+                results.append(
+                    {"filename": file.filename, "status": "rejected", "status_code": e.status_code, "error": e.detail}
                 )
-            storage_context = StorageContext.from_defaults(vector_store=store)
-            VectorStoreIndex.from_documents(
-            processed_documents,
-            storage_context=storage_context,
-            show_progress=True,  # this will show you a progress bar as the embeddings are created
+                continue
+            uploads.append(upload)
+            results.append(
+                {"filename": upload.filename, "status": "queued", "size": upload.size, "sha256": upload.sha256}
             )
-
-            doc_ref = db.collection('ingestedDocs').document(file.filename)
-            doc_ref.set({
-            'filename': file.filename,
-            'status': 'processed',
-            # Add more metadata as needed
-        })
-
-        return {"message": "File processed and added to Firestore successfully"}
-
-    except Exception as e:
-        logger.error(f"Failed to upload and process file due to an error: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
-
-    finally:
-        # Cleanup the temporary directory
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Cleaned up file at {file_path}")
-
-
-
-@ingest_router.post("/process-files", response_model=dict)
+    except BaseException:
+        for upload in uploads:
+            upload.cleanup()
+        raise
+
+    if not uploads:
+        return {"message": "No file was accepted", "job_id": None, "files": results}
+
+    def cleanup():
+        for upload in uploads:
+            upload.cleanup()
+
+    job = ingest_jobs.submit(
+        lambda: {"files": ingest_staged_batch(uploads, folder, tenant_id, use_llama_parse)},
+        cleanup=cleanup,
+        filenames=[upload.filename for upload in uploads],
+    )
+    return {"message": f"{len(uploads)} files accepted for processing", **job.to_dict(), "files": results}
+
+
+@ingest_router.put(
+    "/upload-file/{filename}", response_model=dict, status_code=202, dependencies=[Depends(ingest_admission)]
+)
+async def upload_file_stream(
+    request: Request,
+    filename: str,
+    folder: str = "",
+    tenant_id: Optional[str] = None,
+    use_llama_parse: bool = True,
+):
+    """
+    Like `/upload-file`, with the file as the raw request body. The body is
+    streamed to disk as it arrives, so oversized uploads are rejected without
+    reading them first.
+    """
+    content_length = request.headers.get("content-length")
+    check_upload(filename, int(content_length) if content_length else None)
+    upload = await stage_upload(filename, request.stream(), in_memory=_in_memory(filename, use_llama_parse))
+    return submit_upload(upload, folder, tenant_id, use_llama_parse)
+
+
+@ingest_router.get("/jobs/{job_id}", response_model=dict)
+async def get_job(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.to_dict()
+
+
+@ingest_router.get("/progress/{progress_id}")
+async def ingest_progress(request: Request, progress_id: str):
+    """
+    Server-Sent Events with the progress of an ingestion job, or of a
+    `/process-files` call with this `progress_id`: one event per file and
+    stage (downloaded, parsed, chunked, embedded, upserted, failed), then
+    `finished`. Subscribing to a job first sends its current state, and
+    subscribing after the end sends the `finished` event. The stream of an id
+    still unknown after INGEST_PROGRESS_UNKNOWN_TIMEOUT seconds is closed with
+    a `finished` event with status `unknown`.
+    """
+    queue = progress_broker.subscribe(progress_id)
+    job = ingest_jobs.get(progress_id)
+    subscribed = time.monotonic()
+
+    async def events():
+        try:
+            if job is not None:
+                yield EventStreamResponse.convert_event("job", job.to_dict())
+                if job.status in ("done", "failed"):
+                    return
+            finished = progress_broker.finished(progress_id)
+            if finished is not None:
+                yield EventStreamResponse.convert_event("finished", finished)
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=PROGRESS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    if (
+                        job is None
+                        and not progress_broker.known(progress_id)
+                        and time.monotonic() - subscribed >= PROGRESS_UNKNOWN_SECONDS
+                    ):
+                        yield EventStreamResponse.convert_event(
+                            "finished",
+                            {"stage": "finished", "file": None, "status": "unknown", "time": time.time()},
+                        )
+                        return
+                    yield EventStreamResponse.HEARTBEAT
+                    continue
+                yield EventStreamResponse.convert_event(event["stage"], event)
+                if event["stage"] == "finished":
+                    return
+        finally:
+            progress_broker.unsubscribe(progress_id, queue)
+
+    return EventStreamResponse(content=events())
+
+
+@ingest_router.post("/process-files", response_model=dict, dependencies=[Depends(ingest_admission)])
 def process_files(data: Filenames, config: FileLoaderConfig = Depends()):
     logger = logging.getLogger(__name__)
     processed_documents = []
+    if data.progress_id:
+        current_progress.set(ProgressReporter(progress_broker, data.progress_id))
+    # a directory of its own, concurrent requests must not read or delete each other's downloads
+    download_dir = tempfile.mkdtemp(dir=config.data_dir)
 
     try:
         # Download all files first
         downloaded_files = []
+        # without LlamaParse, files are parsed as they are downloaded, from memory
+        buffered_documents = []
+        ingested_at = int(time.time())
         for filename in data.filenames:
-            file_path = check_and_download_file(filename, config.data_dir)
+            if _in_memory(filename, config.use_llama_parse):
+                with INGEST_STAGE_SECONDS.time(stage="download"):
+                    buffer = download_to_buffer(filename)
+                if buffer is None:
+                    report("failed", os.path.basename(filename), error="Not found on the server")
+                    continue
+                report("downloaded", os.path.basename(filename))
+                with buffer, INGEST_STAGE_SECONDS.time(stage="parse"):
+                    parsed = load_buffer(filename, buffer)
+                add_scope_metadata(
+                    parsed, default_folder=os.path.dirname(filename), ingested_at=ingested_at, source="nextcloud"
+                )
+                buffered_documents.extend(parsed)
+                continue
+            with INGEST_STAGE_SECONDS.time(stage="download"):
+                file_path = check_and_download_file(filename, download_dir)
             if file_path:
                 downloaded_files.append(file_path)
+                report("downloaded", os.path.basename(filename))
+            else:
+                report("failed", os.path.basename(filename), error="Not found on the server")
         logger.info(f"Downloaded {len(downloaded_files)} files")
 
         # Filter out None values if some files failed to download
@@ -171,50 +403,44 @@ def process_files(data: Filenames, config: FileLoaderConfig = Depends()):
         logger.info(f"Downloaded {len(valid_files)} files out of {len(data.filenames)}")
 
         # Proceed only if files are successfully downloaded
-        if valid_files:
-            reader = SimpleDirectoryReader(config.data_dir, recursive=True)
-            if config.use_llama_parse:
-                parser = llama_parse_parser()
-                supported_file_types = [".pdf", ".doc", ".docx", ".pptx", ".txt", ".rtf", ".pages", ".key", ".epub"]
-                reader.file_extractor = {file_type: parser for file_type in supported_file_types}
-                processed_documents = reader.load_data()
-            logger.info(f"Processed documents: {len(processed_documents)}")
-
-            # Setup Pinecone integration if required
-            if config.use_llama_parse:
-                store = PineconeVectorStore(
-                    api_key=os.getenv("PINECONE_API_KEY"),
-                    index_name=os.getenv("PINECONE_INDEX_NAME"),
-                    environment=os.getenv("PINECONE_ENVIRONMENT"),
+        if valid_files or buffered_documents:
+            # the files the local extractors can't read from memory are parsed from disk either way
+            if valid_files:
+                reader = SimpleDirectoryReader(download_dir, recursive=True)
+                if config.use_llama_parse:
+                    parser = llama_parse_parser()
+                    reader.file_extractor = {file_type: parser for file_type in SUPPORTED_FILE_TYPES}
+                with INGEST_STAGE_SECONDS.time(stage="parse"):
+                    processed_documents = reader.load_data()
+                # downloaded into the folders they have on the server
+                add_scope_metadata(
+                    processed_documents, root=download_dir, ingested_at=ingested_at, source="nextcloud"
                 )
-            storage_context = StorageContext.from_defaults(vector_store=store)
-            VectorStoreIndex.from_documents(
-            processed_documents,
-            storage_context=storage_context,
-            show_progress=True,  # this will show you a progress bar as the embeddings are created
-            )
-            # Store documents metadata in Firestore
-            if processed_documents:
-                # Assuming `processed_documents` are indexed the same as `valid_files`
-                for i, doc in enumerate(processed_documents):
-                    filename = os.path.basename(valid_files[i])
-                    doc_data = {
-                        'filename': filename,
-                        'content': str(doc),  # or any other method to serialize the document
-                        'status': 'processed'
-                    }
-                    doc_ref = db.collection('ingestedDocs').document(filename)
-                    doc_ref.set(doc_data)
-
+            processed_documents.extend(buffered_documents)
+            logger.info(f"Processed documents: {len(processed_documents)}")
+            for file_name, count in Counter(
+                os.path.basename(document.metadata.get("file_name", "")) for document in processed_documents
+            ).items():
+                report("parsed", file_name, documents=count)
+
+            assign_ingest_ids(processed_documents)
+            for namespace, documents in group_by_namespace(processed_documents, data.tenant_id).items():
+                nodes = index_documents(documents, get_vector_store(namespace), show_progress=True, namespace=namespace)
+                # one ledger record per file, with the ingest id of its nodes
+                with INGEST_STAGE_SECONDS.time(stage="bookkeeping"):
+                    record_ingestion(namespace, documents, nodes)
+
+        report("finished", status="done")
         return {"message": "Files processed and data added to Firestore successfully"}
 
    
 
     except Exception as e:
         logger.error(f"Failed to process files due to an error: {e}", exc_info=True)
+        report("failed", error=str(e))
+        report("finished", status="failed", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if os.path.exists(config.data_dir):
-            shutil.rmtree(config.data_dir)
-            logger.info(f"Temporary directory {config.data_dir} cleaned up")
+        shutil.rmtree(download_dir, ignore_errors=True)
+        logger.info(f"Temporary directory {download_dir} cleaned up")
 
@@ -1,10 +1,13 @@
 import asyncio
+import time
 from typing import AsyncGenerator, Dict, Any, List, Optional
 
 from llama_index.core.callbacks.base import BaseCallbackHandler
 from llama_index.core.callbacks.schema import CBEventType
 from pydantic import BaseModel
 
+from app.metrics import current_chat_trace
+
 
 class CallbackEvent(BaseModel):
     event_type: CBEventType
@@ -84,3 +87,74 @@ class EventCallbackHandler(BaseCallbackHandler):
                 yield await asyncio.wait_for(self._aqueue.get(), timeout=0.1)
             except asyncio.TimeoutError:
                 pass
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Process-wide handler that times the llama_index stages of a chat request.
+
+    Events are attributed to the `ChatTrace` of the request that is active in the
+    current context, so the handler can stay registered on the shared callback
+    manager. LLM calls that finish before the retrieval are the question
+    condensation; the answer generation itself is timed by the chat endpoint.
+    """
+
+    def __init__(self):
+        tracked_events = [CBEventType.RETRIEVE, CBEventType.LLM, CBEventType.EMBEDDING]
+        ignored_events = [event for event in CBEventType if event not in tracked_events]
+        super().__init__(ignored_events, ignored_events)
+        self._starts: Dict[str, float] = {}
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        trace = current_chat_trace.get()
+        if trace is not None:
+            if event_type == CBEventType.LLM:
+                # wrapped LLMs (e.g. chat on top of complete) emit nested LLM events
+                trace.open_llm_events += 1
+                if trace.open_llm_events > 1:
+                    return event_id
+            self._starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        start = self._starts.pop(event_id, None)
+        trace = current_chat_trace.get()
+        if trace is None:
+            return
+        if event_type == CBEventType.LLM:
+            trace.open_llm_events = max(trace.open_llm_events - 1, 0)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        match event_type:
+            case CBEventType.LLM:
+                if not trace.retrieved and not trace.condense_timed:
+                    trace.observe("condense", duration)
+            case CBEventType.EMBEDDING:
+                trace.embedding_seconds += duration
+                trace.observe("query_embedding", duration)
+            case CBEventType.RETRIEVE:
+                trace.retrieved = True
+                trace.observe("retrieve", duration - trace.embedding_seconds)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """No-op."""
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """No-op."""
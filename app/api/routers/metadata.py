@@ -3,18 +3,20 @@ from docx import Document as DocxDocument
 from pptx import Presentation
 import os
 import logging
+from contextlib import nullcontext
 
 # Ensure logging is configured in your main application entry
 logging.basicConfig(level=logging.INFO)
 
-def extract_metadata_and_text(file_path):
+def extract_metadata_and_text(file_path, stream=None):
+    # with a file-like stream, file_path only names the file and nothing is read from disk
     filename = os.path.basename(file_path)
     filetype = os.path.splitext(filename)[1].lower()
     title = author = text = None  # Default to None if not found
 
     if filetype == '.pdf':
         try:
-            with open(file_path, "rb") as f:
+            with (open(file_path, "rb") if stream is None else nullcontext(stream)) as f:
                 reader = PdfReader(f)
                 metadata = reader.metadata
                 title = metadata.get('/Title', "Unknown")
@@ -26,7 +28,7 @@ def extract_metadata_and_text(file_path):
 
     elif filetype == '.docx':
         try:
-            doc = DocxDocument(file_path)
+            doc = DocxDocument(file_path if stream is None else stream)
             title = doc.core_properties.title if doc.core_properties.title else "Unknown"
             author = doc.core_properties.author if doc.core_properties.author else "Unknown"
             text = ' '.join([para.text for para in doc.paragraphs if para.text])
@@ -36,7 +38,7 @@ def extract_metadata_and_text(file_path):
 
     elif filetype == '.pptx':
         try:
-            pres = Presentation(file_path)
+            pres = Presentation(file_path if stream is None else stream)
             title = pres.core_properties.title if pres.core_properties.title else "Unknown"
             author = pres.core_properties.author if pres.core_properties.author else "Unknown"
             text = ' '.join([slide.notes_slide.notes_text_frame.text for slide in pres.slides if slide.has_notes_slide and slide.notes_slide.notes_text_frame])
@@ -1,7 +1,7 @@
 import os
-import requests
+import httpx
 import urllib.parse 
-from requests.auth import HTTPBasicAuth
+from app.clients import http_clients
 from xml.etree import ElementTree
 
 # Load environment variables
@@ -10,7 +10,7 @@ load_dotenv()  # This loads the variables from a .env file in the same directory
 
 # Configuration using environment variables
 base_url = os.getenv('WEBDAV_URL') + '/files/' + os.getenv('WEBDAV_LOGIN') + '/'
-auth = HTTPBasicAuth(os.getenv('WEBDAV_LOGIN'), os.getenv('WEBDAV_PASSWORD'))
+auth = httpx.BasicAuth(os.getenv('WEBDAV_LOGIN'), os.getenv('WEBDAV_PASSWORD'))
 download_dir = './data'  # Local directory to save downloaded files
 # Überprüfen, ob das Verzeichnis existiert
 if not os.path.exists(download_dir):
@@ -34,7 +34,7 @@ def list_contents(url):
       </d:prop>
     </d:propfind>
     '''
-    response = requests.request("PROPFIND", url, headers=headers, data=propfind_body, auth=auth)
+    response = http_clients.client("webdav").request("PROPFIND", url, headers=headers, content=propfind_body, auth=auth)
     if response.status_code != 207:
         print(f"Error listing contents for {url}: {response.status_code}")
         return []
@@ -53,7 +53,7 @@ def list_contents(url):
 
 def download_file(url, local_path):
     """Download a file from a WebDAV URL to a local path."""
-    response = requests.get(url, auth=auth)
+    response = http_clients.client("webdav").get(url, auth=auth)
     if response.status_code == 200:
         with open(local_path, 'wb') as file:
             file.write(response.content)
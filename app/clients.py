@@ -0,0 +1,260 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+from app.metrics import counter, gauge, histogram
+
+HTTP_CLIENT_REQUESTS = counter(
+    "http_client_requests_total",
+    "Requests of the shared HTTP clients, by whether they opened a new connection or reused one",
+    ["client", "connection"],
+)
+HTTP_CLIENT_CONNECTIONS = gauge(
+    "http_client_connections",
+    "Open connections of the shared HTTP clients, as of their last request",
+    ["client", "state"],
+)
+HTTP_CLIENT_POOL_WAIT_SECONDS = histogram(
+    "http_client_pool_wait_seconds",
+    "Time a request of a shared HTTP client waited for a connection from the pool",
+    ["client"],
+)
+HTTP_CLIENT_CONNECT_SECONDS = histogram(
+    "http_client_connect_seconds",
+    "Time a shared HTTP client took to open a new connection, TCP connect and TLS handshake",
+    ["client"],
+)
+
+# traced by httpcore when a request opens a new connection, and when it starts sending on one
+_CONNECT_EVENTS = ("connection.connect_tcp.started", "connection.connect_unix_socket.started")
+_SEND_EVENTS = ("http11.send_request_headers.started", "http2.send_request_headers.started")
+
+
+@dataclass
+class PoolConfig:
+    max_connections: int
+    max_keepalive_connections: int
+    timeout: float
+    connect_timeout: float = 5.0
+    keepalive_expiry: float = 30.0
+
+    @classmethod
+    def from_env(cls, name: str, default: "PoolConfig") -> "PoolConfig":
+        """`default`, with the values of HTTP_<NAME>_MAX_CONNECTIONS, ..._MAX_KEEPALIVE and ..._TIMEOUT."""
+        prefix = f"HTTP_{name.upper()}_"
+        return cls(
+            max_connections=int(os.getenv(prefix + "MAX_CONNECTIONS", str(default.max_connections))),
+            max_keepalive_connections=int(
+                os.getenv(prefix + "MAX_KEEPALIVE", str(default.max_keepalive_connections))
+            ),
+            timeout=float(os.getenv(prefix + "TIMEOUT", str(default.timeout))),
+            connect_timeout=default.connect_timeout,
+            keepalive_expiry=default.keepalive_expiry,
+        )
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeouts(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+
+# streamed completions take long, WebDAV requests are short but downloads are large
+POOL_DEFAULTS = {
+    "openai": PoolConfig(max_connections=100, max_keepalive_connections=20, timeout=60.0),
+    "webdav": PoolConfig(max_connections=20, max_keepalive_connections=10, timeout=15.0),
+    "default": PoolConfig(max_connections=20, max_keepalive_connections=5, timeout=30.0),
+}
+
+
+def http2_available() -> bool:
+    # httpx speaks HTTP/2 only with the h2 package, `pip install httpx[http2]`
+    return importlib.util.find_spec("h2") is not None
+
+
+class _RequestTrace:
+    """
+    Tells from httpcore's trace events whether a request reused a connection,
+    how long it waited for one and how long opening a new one took. The wait
+    ends when the request starts connecting or, on a reused connection, sending.
+    """
+
+    def __init__(self, client: str, trace: Optional[Callable] = None):
+        self.client = client
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.connecting: Optional[float] = None
+        self.recorded = False
+
+    def event(self, name: str):
+        if self.recorded:
+            return
+        now = time.perf_counter()
+        if name in _CONNECT_EVENTS and self.connecting is None:
+            self.connecting = now
+            HTTP_CLIENT_POOL_WAIT_SECONDS.observe(now - self.start, client=self.client)
+            return
+        if name not in _SEND_EVENTS:
+            return
+        self.recorded = True
+        if self.connecting is None:
+            HTTP_CLIENT_POOL_WAIT_SECONDS.observe(now - self.start, client=self.client)
+            HTTP_CLIENT_REQUESTS.inc(client=self.client, connection="reused")
+        else:
+            HTTP_CLIENT_CONNECT_SECONDS.observe(now - self.connecting, client=self.client)
+            HTTP_CLIENT_REQUESTS.inc(client=self.client, connection="new")
+
+    def sync_trace(self, name: str, info: Dict):
+        self.event(name)
+        if self.trace is not None:
+            self.trace(name, info)
+
+    async def async_trace(self, name: str, info: Dict):
+        self.event(name)
+        if self.trace is not None:
+            await self.trace(name, info)
+
+
+def _record_connections(client: str, pool: Any):
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    HTTP_CLIENT_CONNECTIONS.set(idle, client=client, state="idle")
+    HTTP_CLIENT_CONNECTIONS.set(len(connections) - idle, client=client, state="active")
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    def __init__(self, client: str, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        trace = _RequestTrace(self.client, request.extensions.get("trace"))
+        request.extensions = {**request.extensions, "trace": trace.sync_trace}
+        try:
+            return super().handle_request(request)
+        finally:
+            _record_connections(self.client, self._pool)
+
+
+class MeteredAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, client: str, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        trace = _RequestTrace(self.client, request.extensions.get("trace"))
+        request.extensions = {**request.extensions, "trace": trace.async_trace}
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            _record_connections(self.client, self._pool)
+
+
+class ClientRegistry:
+    """
+    Process-wide HTTP clients with keep-alive, one per upstream service, so
+    that every subsystem talking to a service shares its connection pool.
+
+    Pool sizes and timeouts come from `POOL_DEFAULTS`, overridable per client
+    with HTTP_<NAME>_MAX_CONNECTIONS, HTTP_<NAME>_MAX_KEEPALIVE and
+    HTTP_<NAME>_TIMEOUT. HTTP/2 is negotiated where the h2 package is
+    installed and the server supports it. Sync clients are shared by all
+    threads; async clients are bound to the event loop they were created on,
+    so there is one per loop. Requests are counted as new or reused
+    connections, with the time they waited for the pool.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.Client] = {}
+        # by event loop, a loop that is gone takes its clients with it
+        self._async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _config(self, name: str) -> PoolConfig:
+        return PoolConfig.from_env(name, POOL_DEFAULTS.get(name, POOL_DEFAULTS["default"]))
+
+    def client(self, name: str) -> httpx.Client:
+        with self._lock:
+            if name not in self._clients or self._clients[name].is_closed:
+                config = self._config(name)
+                self._clients[name] = httpx.Client(
+                    transport=MeteredTransport(name, http2=http2_available(), limits=config.limits()),
+                    timeout=config.timeouts(),
+                )
+            return self._clients[name]
+
+    def async_client(self, name: str) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            if name not in clients or clients[name].is_closed:
+                config = self._config(name)
+                clients[name] = httpx.AsyncClient(
+                    transport=MeteredAsyncTransport(name, http2=http2_available(), limits=config.limits()),
+                    timeout=config.timeouts(),
+                )
+            return clients[name]
+
+    async def aclose(self, name: Optional[str] = None):
+        """Close the async clients of the running loop, or only the one of `name`."""
+        with self._lock:
+            clients = self._async_clients.get(asyncio.get_running_loop(), {})
+            closing = [clients.pop(key) for key in list(clients) if name is None or key == name]
+        for client in closing:
+            await client.aclose()
+
+    def close(self):
+        """Close the sync clients."""
+        with self._lock:
+            closing = list(self._clients.values())
+            self._clients.clear()
+        for client in closing:
+            client.close()
+
+
+http_clients = ClientRegistry()
+
+_pinecone_indexes: Dict[str, Any] = {}
+_pinecone_lock = threading.Lock()
+
+
+def pinecone_index(index_name: str) -> Any:
+    """
+    The Pinecone index client of `index_name`, shared by the vector stores of
+    all namespaces. The Pinecone SDK talks urllib3, not httpx; the index keeps
+    its own pool of keep-alive connections, which is only reused if the
+    index is.
+    """
+    with _pinecone_lock:
+        if index_name not in _pinecone_indexes:
+            from pinecone import Pinecone
+
+            _pinecone_indexes[index_name] = Pinecone(api_key=os.environ["PINECONE_API_KEY"]).Index(index_name)
+        return _pinecone_indexes[index_name]
+
+
+def use_shared_openai_clients(*models: Any):
+    """
+    Point llama-index OpenAI LLMs and embedding models at the shared pools.
+    Must run on the serving event loop, the async client is bound to it.
+    """
+    from openai import AsyncOpenAI, OpenAI
+
+    for model in models:
+        if not hasattr(model, "_get_credential_kwargs"):
+            continue
+        kwargs = {key: value for key, value in model._get_credential_kwargs().items() if key != "http_client"}
+        # llama-index passes the same http_client to the sync and the async client, set them directly
+        model._client = OpenAI(**kwargs, http_client=http_clients.client("openai"))
+        model._aclient = AsyncOpenAI(**kwargs, http_client=http_clients.async_client("openai"))
@@ -1,19 +1,78 @@
 import os
+from typing import Any, Dict, List, Optional
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from app.engine.chat_engine import CHAT_ENGINES, PostprocessingChatEngine, SpeculativeChatEngine
 from app.engine.index import get_index
+from app.engine.postprocessors import AdaptiveTopK, ContextPacker, context_packing_mode, top_k_mode
+from app.engine.retrievers import FanOutRetriever, MultiQueryRetriever, retrieval_mode
 
 
-def get_chat_engine():
+def _silenced(retrievers: List[BaseRetriever]) -> List[BaseRetriever]:
+    # the wrapping retriever reports the retrieval as a whole
+    for retriever in retrievers:
+        retriever.callback_manager = CallbackManager()
+    return retrievers
+
+
+def get_chat_engine(filter: Optional[Dict[str, Any]] = None, namespaces: Optional[List[str]] = None):
+    """
+    `filter` restricts retrieval to matching nodes; it is a metadata filter in
+    Pinecone's query syntax, see `app.engine.scope.Scope.to_filter`.
+    `namespaces` are searched concurrently and their results merged; by
+    default only the default namespace is searched.
+    With CHAT_ENGINE=speculative, retrieval starts with the raw message while
+    the history is condensed, see `SpeculativeChatEngine`. With
+    CONTEXT_PACKING=on, the retrieved chunks are packed into a token budget,
+    see `ContextPacker`. With TOP_K_MODE=adaptive, TOP_K_MAX candidates are
+    retrieved and only as many as the scores call for are kept, see `AdaptiveTopK`.
+    With RETRIEVAL_MODE=multi_query, reformulations of the question are
+    retrieved concurrently and fused, see `MultiQueryRetriever`.
+    """
     system_prompt = os.getenv("SYSTEM_PROMPT")
     top_k = os.getenv("TOP_K", 3)
+    node_postprocessors = []
+    if top_k_mode() == "adaptive":
+        top_k = int(os.getenv("TOP_K_MAX", "10"))
+        node_postprocessors.append(AdaptiveTopK.from_env(max_k=top_k))
+    if context_packing_mode() == "on":
+        node_postprocessors.append(ContextPacker.from_env())
+    namespaces = namespaces or [""]
+    engine = os.getenv("CHAT_ENGINE", "condense_plus_context")
+    if engine not in CHAT_ENGINES:
+        raise ValueError(f"Unsupported CHAT_ENGINE {engine!r}, use one of {CHAT_ENGINES}")
+    # pushed down to the vector store query, both Pinecone and the local store take it
+    vector_store_kwargs = {"filter": filter} if filter else {}
 
-    index = get_index()
-    if index is None:
-        raise Exception(
-            "StorageContext is empty - call 'python app/engine/generate.py' to generate the storage first"
+    retrievers = []
+    for namespace in namespaces:
+        index = get_index(namespace)
+        if index is None:
+            raise Exception(
+                "StorageContext is empty - call 'python app/engine/generate.py' to generate the storage first"
+            )
+        retrievers.append(index.as_retriever(similarity_top_k=int(top_k), vector_store_kwargs=vector_store_kwargs))
+    if retrieval_mode() == "multi_query":
+        retriever = MultiQueryRetriever(
+            _silenced(retrievers),
+            similarity_top_k=int(top_k),
+            max_queries=int(os.getenv("MULTI_QUERY_COUNT", "3")),
+            llm_queries=int(os.getenv("MULTI_QUERY_LLM", "0")),
         )
+    elif len(retrievers) > 1:
+        retriever = FanOutRetriever(_silenced(retrievers), similarity_top_k=int(top_k))
+    else:
+        retriever = retrievers[0]
 
-    return index.as_chat_engine(
-        similarity_top_k=int(top_k),
+    if engine == "speculative":
+        return SpeculativeChatEngine.from_defaults(
+            retriever=retriever,
+            system_prompt=system_prompt,
+            node_postprocessors=node_postprocessors,
+            min_overlap=float(os.getenv("SPECULATIVE_MIN_OVERLAP", "0.6")),
+        )
+    return PostprocessingChatEngine.from_defaults(
+        retriever=retriever,
         system_prompt=system_prompt,
-        chat_mode="condense_plus_context",
+        node_postprocessors=node_postprocessors,
     )
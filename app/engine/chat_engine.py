@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import re
+import time
+from typing import List, Optional, Tuple
+
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.llms import ChatMessage
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from app.engine.retrievers import merge_top_k
+from app.metrics import counter, current_chat_trace
+
+logger = logging.getLogger("uvicorn")
+
+CHAT_ENGINES = ("condense_plus_context", "speculative")
+
+SPECULATIVE_RETRIEVALS = counter(
+    "chat_speculative_retrievals_total",
+    "Speculative retrievals with the raw message, by whether the condensed question needed its own",
+    ["outcome"],
+)
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def same_question(a: str, b: str, min_overlap: float) -> bool:
+    """Whether two questions share at least `min_overlap` of their words (Jaccard)."""
+    words_a = {word.lower() for word in _WORD.findall(a)}
+    words_b = {word.lower() for word in _WORD.findall(b)}
+    if not words_a or not words_b:
+        return words_a == words_b
+    return len(words_a & words_b) / len(words_a | words_b) >= min_overlap
+
+
+class PostprocessingChatEngine(CondensePlusContextChatEngine):
+    """
+    Condense-plus-context chat that applies its node postprocessors in the
+    async methods as well; the installed llama-index only does so in the sync ones.
+    """
+
+    async def _aretrieve_nodes(self, message: str) -> List[NodeWithScore]:
+        return await self._retriever.aretrieve(message)
+
+    async def _aretrieve_context(self, message: str) -> Tuple[str, List[NodeWithScore]]:
+        nodes = await self._aretrieve_nodes(message)
+        for postprocessor in self._node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=QueryBundle(message))
+        context_str = "\n\n".join([n.node.get_content(metadata_mode=MetadataMode.LLM).strip() for n in nodes])
+        return context_str, nodes
+
+
+class SpeculativeChatEngine(PostprocessingChatEngine):
+    """
+    Condense-plus-context chat that doesn't wait for the condensation to retrieve.
+
+    Retrieval with the raw last message starts right away and runs while the
+    LLM condenses the history into a standalone question. If the condensed
+    question differs materially from the message (less than `min_overlap` of
+    their words in common), it is retrieved as well and both candidate lists
+    are merged; otherwise the speculative results are used as they are. Without
+    history there is nothing to condense and the message is retrieved directly.
+    Only the async chat methods speculate.
+
+    An engine serves one request at a time, the speculative retrieval is kept
+    on the instance between the two steps.
+    """
+
+    def __init__(self, *args, min_overlap: float = 0.6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._min_overlap = min_overlap
+        self._speculation: Optional[Tuple[str, asyncio.Task]] = None
+
+    @classmethod
+    def from_defaults(cls, *args, min_overlap: float = 0.6, **kwargs) -> "SpeculativeChatEngine":
+        engine = super().from_defaults(*args, **kwargs)
+        engine._min_overlap = min_overlap
+        return engine
+
+    async def _acondense_question(self, chat_history: List[ChatMessage], latest_message: str) -> str:
+        if self._skip_condense or len(chat_history) == 0:
+            SPECULATIVE_RETRIEVALS.inc(outcome="no_history")
+            return latest_message
+        task = asyncio.create_task(self._retrieve_in_thread(latest_message))
+        self._speculation = (latest_message, task)
+        trace = current_chat_trace.get()
+        if trace is not None:
+            # the retrieval may finish first, the callback handler can't tell the condensation apart
+            trace.condense_timed = True
+        start = time.perf_counter()
+        try:
+            return await super()._acondense_question(chat_history, latest_message)
+        except BaseException:
+            self._speculation = None
+            task.cancel()
+            raise
+        finally:
+            if trace is not None:
+                trace.observe("condense", time.perf_counter() - start)
+
+    async def _retrieve_in_thread(self, message: str) -> List[NodeWithScore]:
+        # vector store queries block, they must not hold up the condensation on the event loop
+        return await asyncio.to_thread(self._retriever.retrieve, message)
+
+    async def _aretrieve_nodes(self, message: str) -> List[NodeWithScore]:
+        if self._speculation is None:
+            return await self._retriever.aretrieve(message)
+        raw_message, task = self._speculation
+        self._speculation = None
+        if same_question(raw_message, message, self._min_overlap):
+            SPECULATIVE_RETRIEVALS.inc(outcome="hit")
+            return await task
+        SPECULATIVE_RETRIEVALS.inc(outcome="miss")
+        logger.debug(f"Condensed question differs from the message, retrieving it too: {message}")
+        speculative, condensed = await asyncio.gather(task, self._retrieve_in_thread(message))
+        # the condensed question is the better query, its results win ties
+        return merge_top_k([condensed, speculative], max(len(condensed), len(speculative)))
@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, NamedTuple, Optional
+
+from llama_index.core.schema import Document
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at INTEGER NOT NULL,
+    finished_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS units (
+    run_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    ingest_id TEXT NOT NULL,
+    documents TEXT,
+    batches_done INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (run_id, key)
+);
+"""
+
+
+class Run(NamedTuple):
+    id: int
+    started_at: int
+
+
+class UnitState(NamedTuple):
+    ingest_id: str
+    # the parsed documents, kept until the unit is done
+    documents: Optional[List[Document]]
+    batches_done: int
+    done: bool
+
+
+class IngestCheckpoint:
+    """
+    Progress of bulk ingestion runs in a local SQLite file.
+
+    A run ingests a list of units (files, or whole loaders). For every unit it
+    records the parsed documents, the number of node batches already upserted
+    and whether the unit is done, so that an interrupted run resumes from the
+    last committed batch without parsing again. A unit whose fingerprint
+    changed since it was started is ingested again from scratch.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def current_run(self) -> Optional[Run]:
+        """The unfinished run, if there is one."""
+        row = self._connection.execute(
+            "SELECT id, started_at FROM runs WHERE finished_at IS NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        return Run(*row) if row else None
+
+    def begin_run(self, restart: bool = False) -> Run:
+        """Resume the unfinished run, or start a new one if there is none or `restart` is set."""
+        run = self.current_run()
+        if run is not None and not restart:
+            return run
+        started_at = int(time.time())
+        with self._connection:
+            if run is not None:
+                self._finish(run)
+            cursor = self._connection.execute("INSERT INTO runs (started_at) VALUES (?)", (started_at,))
+        return Run(cursor.lastrowid, started_at)
+
+    def finish_run(self, run: Run):
+        with self._connection:
+            self._finish(run)
+
+    def _finish(self, run: Run):
+        self._connection.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (int(time.time()), run.id))
+        # finished runs are never resumed, their units are no longer needed
+        self._connection.execute("DELETE FROM units WHERE run_id = ?", (run.id,))
+
+    def peek(self, run: Run, key: str, fingerprint: str) -> Optional[UnitState]:
+        """The state of a unit, None if it wasn't started or has changed since."""
+        row = self._connection.execute(
+            "SELECT fingerprint, ingest_id, documents, batches_done, done FROM units WHERE run_id = ? AND key = ?",
+            (run.id, key),
+        ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        documents = [Document.from_dict(data) for data in json.loads(row[2])] if row[2] else None
+        return UnitState(row[1], documents, row[3], bool(row[4]))
+
+    def unit(self, run: Run, key: str, fingerprint: str) -> UnitState:
+        """The state of a unit, starting it if it wasn't started or has changed since."""
+        state = self.peek(run, key, fingerprint)
+        if state is not None:
+            return state
+        state = UnitState(uuid.uuid4().hex, None, 0, False)
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO units (run_id, key, fingerprint, ingest_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (run.id, key, fingerprint, state.ingest_id, time.time()),
+            )
+        return state
+
+    def _update(self, run: Run, key: str, assignments: str, *values):
+        with self._connection:
+            self._connection.execute(
+                f"UPDATE units SET {assignments}, updated_at = ? WHERE run_id = ? AND key = ?",
+                (*values, time.time(), run.id, key),
+            )
+
+    def save_documents(self, run: Run, key: str, documents: List[Document]):
+        self._update(run, key, "documents = ?", json.dumps([document.to_dict() for document in documents]))
+
+    def commit_batch(self, run: Run, key: str, batches_done: int):
+        self._update(run, key, "batches_done = ?", batches_done)
+
+    def mark_done(self, run: Run, key: str):
+        self._update(run, key, "done = 1, documents = NULL")
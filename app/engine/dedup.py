@@ -0,0 +1,350 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from app.engine.scope import normalize_folder
+from app.metrics import INGEST_STAGE_SECONDS, counter
+
+logger = logging.getLogger("uvicorn")
+
+NEAR_DUPLICATES = counter(
+    "ingest_near_duplicates_total", "Chunks skipped as near-duplicates of an indexed chunk", ["namespace"]
+)
+
+DEDUP_MODES = ("off", "skip")
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# the permutations must be the same in every process that uses an index file
+_PERMUTATION_SEED = 1
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    folder TEXT NOT NULL DEFAULT '',
+    file_name TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    namespace TEXT NOT NULL,
+    folder TEXT NOT NULL DEFAULT '',
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    chunk INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS duplicates (
+    namespace TEXT NOT NULL,
+    folder TEXT NOT NULL DEFAULT '',
+    file_name TEXT NOT NULL,
+    canonical_node_id TEXT NOT NULL,
+    similarity REAL NOT NULL,
+    node TEXT
+);
+"""
+
+# after the migration, indexes files built before folders were recorded lack the column
+INDEXES = """
+DROP INDEX IF EXISTS chunks_by_file;
+DROP INDEX IF EXISTS buckets_lookup;
+DROP INDEX IF EXISTS duplicates_by_file;
+CREATE INDEX IF NOT EXISTS chunks_by_path ON chunks (namespace, folder, file_name);
+CREATE INDEX IF NOT EXISTS buckets_by_folder ON buckets (namespace, folder, band, bucket);
+CREATE INDEX IF NOT EXISTS buckets_by_chunk ON buckets (chunk);
+CREATE INDEX IF NOT EXISTS duplicates_by_path ON duplicates (namespace, folder, file_name);
+CREATE INDEX IF NOT EXISTS duplicates_by_canonical ON duplicates (canonical_node_id);
+"""
+
+# columns added to index files written by earlier versions
+MIGRATIONS = [
+    ("chunks", "folder", "TEXT NOT NULL DEFAULT ''"),
+    ("buckets", "folder", "TEXT NOT NULL DEFAULT ''"),
+    ("duplicates", "folder", "TEXT NOT NULL DEFAULT ''"),
+    ("duplicates", "node", "TEXT"),
+]
+
+
+def dedup_mode() -> str:
+    mode = os.getenv("DEDUP_MODE", "off")
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"Unsupported DEDUP_MODE {mode!r}, use one of {DEDUP_MODES}")
+    return mode
+
+
+def lsh_bands(num_perm: int, threshold: float, false_negative_weight: float = 0.9) -> Tuple[int, int]:
+    """
+    The (bands, rows) split of the signature that minimizes the weighted
+    probability of missing pairs above `threshold` and of comparing pairs below
+    it. Candidates are verified against the full signature, so missed pairs
+    weigh more than extra comparisons.
+    """
+    similarities = np.linspace(0, 1, 201)
+
+    def error(split: Tuple[int, int]) -> float:
+        bands, rows = split
+        candidate = 1 - (1 - similarities**rows) ** bands
+        below = similarities < threshold
+        false_positives = np.trapz(np.where(below, candidate, 0), similarities)
+        false_negatives = np.trapz(np.where(below, 0, 1 - candidate), similarities)
+        return (1 - false_negative_weight) * false_positives + false_negative_weight * false_negatives
+
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(splits, key=error)
+
+
+def shingles(text: str, size: int) -> List[str]:
+    words = [word.lower() for word in _WORD.findall(text)]
+    return [" ".join(words[i : i + size]) for i in range(len(words) - size + 1)]
+
+
+class MinHasher:
+    """MinHash signatures of word shingles, with `num_perm` universal hash permutations."""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(_PERMUTATION_SEED)
+        self._a = rng.randint(1, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """The signature of `text`, None if it is too short to compare."""
+        values = shingles(text, self.shingle_size)
+        if not values:
+            return None
+        hashes = np.fromiter((zlib.crc32(value.encode("utf-8")) for value in values), dtype=np.uint64)
+        # the products wrap around in uint64, which still mixes well enough for MinHash
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return float(np.count_nonzero(a == b)) / len(a)
+
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash LSH index of the chunks ingested into each namespace.
+
+    A chunk whose estimated Jaccard similarity to an indexed chunk of the same
+    namespace and folder reaches `threshold` is a near-duplicate: it is skipped
+    instead of embedded, and recorded with the id of the indexed (canonical)
+    chunk. Chunks of other folders are not compared, a query scoped to the
+    folder must still find the text. The chunks of a file that is ingested
+    again replace its earlier ones, so a re-upload is never a duplicate of itself.
+
+    Skipped chunks are kept in the index. When the file of their canonical
+    chunk is ingested again or removed, they are compared again and those that
+    are no longer near-duplicates are returned to be indexed, so their text
+    stays searchable.
+    """
+
+    def __init__(self, path: str, num_perm: int = 128, threshold: float = 0.85, shingle_size: int = 5):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self._lock = threading.Lock()
+        # ingestion runs in worker threads, the lock serializes them
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        self._connection.executescript(INDEXES)
+        self._check_parameters(num_perm, shingle_size)
+
+    def _migrate(self):
+        # entries from before folders were recorded count as files at the root,
+        # duplicates from before their nodes were kept can't be indexed again
+        with self._connection:
+            for table, column, definition in MIGRATIONS:
+                columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _check_parameters(self, num_perm: int, shingle_size: int):
+        expected = {"num_perm": str(num_perm), "shingle_size": str(shingle_size)}
+        with self._connection:
+            for key, value in expected.items():
+                self._connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        stored = dict(self._connection.execute("SELECT key, value FROM meta").fetchall())
+        for key, value in expected.items():
+            if stored[key] != value:
+                raise ValueError(f"The dedup index was built with {key}={stored[key]}, not {value}")
+
+    def _buckets(self, signature: np.ndarray) -> List[Tuple[int, int]]:
+        buckets = []
+        for band in range(self.bands):
+            digest = hashlib.blake2b(signature[band * self.rows : (band + 1) * self.rows].tobytes(), digest_size=8)
+            buckets.append((band, int.from_bytes(digest.digest(), "big", signed=True)))
+        return buckets
+
+    def _find(
+        self, namespace: str, folder: str, signature: np.ndarray, buckets: List[Tuple[int, int]]
+    ) -> Optional[Tuple[str, float]]:
+        placeholders = ", ".join("(?, ?)" for _ in buckets)
+        rows = self._connection.execute(
+            f"SELECT DISTINCT chunks.node_id, chunks.signature FROM buckets JOIN chunks ON chunks.id = buckets.chunk "
+            f"WHERE buckets.namespace = ? AND buckets.folder = ? "
+            f"AND (buckets.band, buckets.bucket) IN (VALUES {placeholders})",
+            [namespace, folder, *[value for bucket in buckets for value in bucket]],
+        ).fetchall()
+        best = None
+        for node_id, blob in rows:
+            score = similarity(signature, np.frombuffer(blob, dtype=np.uint32))
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (node_id, score)
+        return best
+
+    def _forget_files(self, namespace: str, files: Sequence[Tuple[str, str]]) -> List[BaseNode]:
+        """Drop the entries of `files` and return the near-duplicates of their chunks in other files."""
+        canonical_ids: List[str] = []
+        for folder, file_name in files:
+            key = (namespace, folder, file_name)
+            self._connection.execute(
+                "DELETE FROM duplicates WHERE namespace = ? AND folder = ? AND file_name = ?", key
+            )
+            chunk_ids = "SELECT id FROM chunks WHERE namespace = ? AND folder = ? AND file_name = ?"
+            canonical_ids.extend(
+                row[0]
+                for row in self._connection.execute(
+                    "SELECT node_id FROM chunks WHERE namespace = ? AND folder = ? AND file_name = ?", key
+                )
+            )
+            self._connection.execute(f"DELETE FROM buckets WHERE chunk IN ({chunk_ids})", key)
+            self._connection.execute("DELETE FROM chunks WHERE namespace = ? AND folder = ? AND file_name = ?", key)
+
+        dependents: List[BaseNode] = []
+        lost = 0
+        for start in range(0, len(canonical_ids), 500):
+            batch = canonical_ids[start : start + 500]
+            placeholders = ", ".join("?" for _ in batch)
+            where = f"namespace = ? AND canonical_node_id IN ({placeholders})"
+            rows = self._connection.execute(f"SELECT node FROM duplicates WHERE {where}", [namespace, *batch])
+            for (payload,) in rows.fetchall():
+                if payload is None:
+                    lost += 1
+                else:
+                    dependents.append(metadata_dict_to_node(json.loads(payload)))
+            self._connection.execute(f"DELETE FROM duplicates WHERE {where}", [namespace, *batch])
+        if lost:
+            logger.warning(f"{lost} near-duplicates lost their canonical chunk, re-ingest their files to index them")
+        return dependents
+
+    def _add(self, namespace: str, nodes: List[BaseNode]) -> List[BaseNode]:
+        kept = []
+        for node in nodes:
+            folder, file_name = _file(node)
+            signature = self.hasher.signature(node.get_content(metadata_mode=MetadataMode.NONE))
+            if signature is None:
+                kept.append(node)
+                continue
+            buckets = self._buckets(signature)
+            match = self._find(namespace, folder, signature, buckets)
+            if match is not None:
+                payload = node_to_metadata_dict(node, remove_text=False, flat_metadata=False)
+                self._connection.execute(
+                    "INSERT INTO duplicates (namespace, folder, file_name, canonical_node_id, similarity, node) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (namespace, folder, file_name, match[0], match[1], json.dumps(payload)),
+                )
+                continue
+            cursor = self._connection.execute(
+                "INSERT INTO chunks (namespace, folder, file_name, node_id, signature) VALUES (?, ?, ?, ?, ?)",
+                (namespace, folder, file_name, node.node_id, signature.tobytes()),
+            )
+            self._connection.executemany(
+                "INSERT INTO buckets (namespace, folder, band, bucket, chunk) VALUES (?, ?, ?, ?, ?)",
+                [(namespace, folder, band, bucket, cursor.lastrowid) for band, bucket in buckets],
+            )
+            kept.append(node)
+        return kept
+
+    def filter(self, nodes: List[BaseNode], namespace: str = "") -> Tuple[List[BaseNode], List[BaseNode]]:
+        """
+        The nodes that are not near-duplicates, all of them are compared
+        against each other too, and the near-duplicates of the files' earlier
+        chunks that are distinct now, which must be indexed as well.
+        """
+        with self._lock, self._connection:
+            dependents = self._forget_files(namespace, sorted({_file(node) for node in nodes}))
+            kept = self._add(namespace, nodes)
+            restored = self._add(namespace, dependents)
+        skipped = len(nodes) - len(kept)
+        if skipped:
+            NEAR_DUPLICATES.inc(skipped, namespace=namespace)
+            logger.info(f"Skipped {skipped} of {len(nodes)} chunks as near-duplicates")
+        if restored:
+            logger.info(f"Indexing {len(restored)} chunks whose canonical chunk was replaced")
+        return kept, restored
+
+    def release_files(self, namespace: str, files: Sequence[Tuple[str, str]]) -> List[BaseNode]:
+        """
+        Forget the files, by folder and file name, whose vectors were deleted;
+        returns the near-duplicates of their chunks that must be indexed now.
+        """
+        with self._lock, self._connection:
+            return self._add(namespace, self._forget_files(namespace, sorted(set(files))))
+
+
+def _file(node: BaseNode) -> Tuple[str, str]:
+    return normalize_folder(node.metadata.get("folder")), node.metadata.get("file_name", "")
+
+
+_index: Optional[NearDuplicateIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NearDuplicateIndex(
+                os.getenv("DEDUP_INDEX", "storage/dedup.sqlite"),
+                num_perm=int(os.getenv("DEDUP_NUM_PERM", "128")),
+                threshold=float(os.getenv("DEDUP_THRESHOLD", "0.85")),
+                shingle_size=int(os.getenv("DEDUP_SHINGLE_SIZE", "5")),
+            )
+        return _index
+
+
+def split_near_duplicates(nodes: List[BaseNode], namespace: str = "") -> Tuple[List[BaseNode], List[BaseNode]]:
+    """
+    The nodes to embed: all of them, or only those that aren't near-duplicates
+    with DEDUP_MODE=skip; and the chunks of other files that must be indexed
+    because the chunk they duplicated is being replaced.
+    """
+    if dedup_mode() == "off" or not nodes:
+        return nodes, []
+    with INGEST_STAGE_SECONDS.time(stage="dedup"):
+        return get_near_duplicate_index().filter(nodes, namespace)
+
+
+def filter_near_duplicates(nodes: List[BaseNode], namespace: str = "") -> List[BaseNode]:
+    """The nodes to embed, see `split_near_duplicates`."""
+    kept, restored = split_near_duplicates(nodes, namespace)
+    return kept + restored
+
+
+def release_files(namespace: str, files: Sequence[Tuple[str, str]]) -> List[BaseNode]:
+    """The chunks to index now that the vectors of `files` are deleted, none with DEDUP_MODE=off."""
+    if dedup_mode() == "off" or not files:
+        return []
+    return get_near_duplicate_index().release_files(namespace, files)
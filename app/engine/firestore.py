@@ -0,0 +1,42 @@
+import base64
+import os
+
+_client = None
+
+
+def firebase_config_from_env():
+    encoded_key = os.getenv('FIREBASE_PRIVATE_KEY_BASE64')
+    # Decode the Base64 string
+    decoded_key = base64.b64decode(encoded_key).decode('utf-8')
+    return {
+        "type": os.getenv("FIREBASE_TYPE"),
+        "project_id": os.getenv("FIREBASE_PROJECT_ID"),
+        "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
+        "private_key": decoded_key, # Properly format the private key
+        "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
+        "client_id": os.getenv("FIREBASE_CLIENT_ID"),
+        "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
+        "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
+        "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
+        "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL")
+    }
+
+
+def get_firestore_client():
+    """Initialize Firebase Admin on first use and return the shared Firestore client."""
+    global _client
+    if _client is None:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(firebase_config_from_env())
+            firebase_admin.initialize_app(cred)
+        _client = firestore.client()
+    return _client
+
+
+def set_firestore_client(client):
+    """Replace the Firestore client, e.g. with an in-memory fake for benchmarks."""
+    global _client
+    _client = client
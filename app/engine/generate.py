@@ -3,16 +3,19 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-import mimetypes
+import json
 import logging
-from llama_index.core.storage import StorageContext
-from llama_index.core.indices import VectorStoreIndex
-from llama_index.vector_stores.pinecone import PineconeVectorStore
+import argparse
 from app.settings import init_settings
-from app.engine.loaders import get_documents
-import firebase_admin
-import base64
-from firebase_admin import credentials, firestore
+from app.engine.index import get_vector_store
+from app.engine.ingestion import chunk_documents, embed_nodes, upsert_nodes
+from app.engine.scope import add_scope_metadata, document_path
+from app.engine.namespaces import group_by_namespace
+from app.engine.loaders import DocumentSource, get_document_sources
+from app.engine.ledger import assign_ingest_ids, record_ingestion
+from app.engine.checkpoint import IngestCheckpoint, Run
+from app.engine.dedup import split_near_duplicates
+from app.metrics import INGEST_STAGE_SECONDS
 
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
@@ -44,63 +47,154 @@ def build_pipeline():
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-encoded_key = os.getenv('FIREBASE_PRIVATE_KEY_BASE64')
-
-# Decode the Base64 string
-decoded_key = base64.b64decode(encoded_key).decode('utf-8')
-firebase_config = {
-    "type": os.getenv("FIREBASE_TYPE"),
-    "project_id": os.getenv("FIREBASE_PROJECT_ID"),
-    "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
-    "private_key": decoded_key, # Properly format the private key
-    "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
-    "client_id": os.getenv("FIREBASE_CLIENT_ID"),
-    "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
-    "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
-    "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL")
-}
-#  Initialize Firebase Admin with the constructed configuration
-cred = credentials.Certificate(firebase_config)
-firebase_admin.initialize_app(cred)
-# Initialize Firebase
-db = firestore.client()
-
-def generate_datasource():
-    logger.info("Creating new index")
-    # load the documents and create the index
-    documents = get_documents()
-  
-
-    store = PineconeVectorStore(
-        api_key=os.environ["PINECONE_API_KEY"],
-        index_name=os.environ["PINECONE_INDEX_NAME"],
-        environment=os.environ["PINECONE_ENVIRONMENT"],
-    )
-    storage_context = StorageContext.from_defaults(vector_store=store)
-    VectorStoreIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        show_progress=True,  # this will show you a progress bar as the embeddings are created
-    )
+
+def default_checkpoint_path() -> str:
+    return os.getenv("INGEST_CHECKPOINT", "storage/ingest_checkpoint.sqlite")
+
+
+def default_batch_size() -> int:
+    return int(os.getenv("INGEST_BATCH_SIZE", "100"))
+
+
+def _prepare(documents, ingested_at: int, ingest_id: str, root=None):
+    # folders relative to the data directory of the file loader the documents came from
+    add_scope_metadata(documents, root=root, ingested_at=ingested_at, source="local")
+    # a resumed unit keeps its ingest id, its first batches are already in the index
+    assign_ingest_ids(documents, {document_path(document.metadata): ingest_id for document in documents})
+
+
+def ingest_source(checkpoint: IngestCheckpoint, run: Run, source: DocumentSource, tenant_id=None, batch_size=100):
+    """Ingest one source, unless the run already did; returns the namespaces it was ingested into."""
+    state = checkpoint.unit(run, source.key, source.fingerprint)
+    if state.done:
+        return []
+    documents = state.documents
+    if documents is None:
+        with INGEST_STAGE_SECONDS.time(stage="parse"):
+            documents = source.load()
+        # kept until the unit is done, so that a resumed run doesn't parse again
+        checkpoint.save_documents(run, source.key, documents)
+    elif state.batches_done:
+        logger.info(f"Resuming {source.key} after {state.batches_done} batches")
+    _prepare(documents, run.started_at, state.ingest_id, source.root)
+
+    batch = 0
+    groups = group_by_namespace(documents, tenant_id)
+    for namespace, group in groups.items():
+        store = get_vector_store(namespace)
+        # chunking and deduplication are deterministic, the committed batches are the same nodes again
+        nodes, restored = split_near_duplicates(chunk_documents(group), namespace)
+        # chunks of other files that duplicated this file's earlier chunks, a resumed run wouldn't find them again
+        upsert_nodes(store, embed_nodes(restored))
+        for start in range(0, len(nodes), batch_size):
+            if batch >= state.batches_done:
+                upsert_nodes(store, embed_nodes(nodes[start : start + batch_size]))
+                checkpoint.commit_batch(run, source.key, batch + 1)
+            batch += 1
+        # Dokumentnamen und Dateitypen in Firebase speichern, ein Eintrag pro Datei
+        with INGEST_STAGE_SECONDS.time(stage="bookkeeping"):
+            record_ingestion(namespace, group, nodes)
+        logger.info(f"Indexed {source.key} as {len(nodes)} nodes into namespace {namespace or 'default'}")
+    checkpoint.mark_done(run, source.key)
+    return list(groups)
+
+
+def generate_datasource(tenant_id=None, checkpoint_path=None, batch_size=None, restart=False):
+    """
+    Ingest every configured document source, one file at a time and in
+    batches of `batch_size` nodes. Progress is checkpointed, so running it
+    again after a failure resumes the interrupted run; `restart` starts over.
+    """
+    checkpoint = IngestCheckpoint(checkpoint_path or default_checkpoint_path())
+    batch_size = batch_size or default_batch_size()
+    namespaces = set()
+    try:
+        run = checkpoint.begin_run(restart=restart)
+        sources = get_document_sources()
+        logger.info(f"Ingesting {len(sources)} sources (run {run.id})")
+        for source in sources:
+            namespaces.update(ingest_source(checkpoint, run, source, tenant_id, batch_size))
+        checkpoint.finish_run(run)
+    finally:
+        checkpoint.close()
+    provider = os.getenv("VECTOR_STORE", "pinecone")
+    store = f"Pinecone index {os.getenv('PINECONE_INDEX_NAME')}" if provider == "pinecone" else f"{provider} vector store"
     logger.info(
-        f"Successfully created embeddings and save to your Pinecone index {os.environ['PINECONE_INDEX_NAME']}"
+        f"Successfully created embeddings in the {store}, namespaces: "
+        f"{', '.join(sorted(namespace or 'default' for namespace in namespaces)) or 'none'}"
     )
-      # Dokumentnamen in Firebase speichern
-    # Dokumentnamen und Dateinamen in Firebase speichern
-   
-
-    doc_ref = db.collection('ingestedDocs')
+    logger.info("Document names, filenames, and filetypes saved to Firebase")
 
-    for doc in documents:
-        if 'file_name' in doc.metadata and 'file_type' in doc.metadata:
-            filename = os.path.basename(doc.metadata['file_name'])
-            filetype = mimetypes.guess_extension(doc.metadata['file_type'])
-            doc_ref.add({'filename': filename, 'filetype': filetype})  # Ein neues Dokument für jeden Dateinamen und Dateityp erstellen
 
-    logger.info("Document names, filenames, and filetypes saved to Firebase")
+def plan_datasource(checkpoint_path=None, batch_size=None):
+    """
+    The work a `generate_datasource` call would do, without calling any paid
+    API: sources still to ingest, and the nodes and tokens still to embed.
+    Documents are loaded with the free local readers instead of LlamaParse, so
+    the counts are estimates, and near-duplicates are not left out.
+    """
+    from llama_index.core.utils import get_tokenizer
+
+    checkpoint = IngestCheckpoint(checkpoint_path or default_checkpoint_path())
+    batch_size = batch_size or default_batch_size()
+    tokenizer = get_tokenizer()
+    plan = {
+        "resumes_run": None,
+        "sources": 0,
+        "done": 0,
+        "pending": 0,
+        "documents": 0,
+        "nodes": 0,
+        "embedding_tokens": 0,
+        "not_estimated": [],
+    }
+    try:
+        run = checkpoint.current_run()
+        plan["resumes_run"] = run.id if run else None
+        for source in get_document_sources():
+            plan["sources"] += 1
+            state = checkpoint.peek(run, source.key, source.fingerprint) if run else None
+            if state is not None and state.done:
+                plan["done"] += 1
+                continue
+            plan["pending"] += 1
+            documents = state.documents if state is not None else None
+            if documents is None:
+                try:
+                    documents = source.preview() if source.preview else None
+                except Exception as e:
+                    logger.warning(f"Could not preview {source.key}: {e}")
+                if documents is None:
+                    plan["not_estimated"].append(source.key)
+                    continue
+            _prepare(documents, run.started_at if run else None, "", source.root)
+            nodes = [node for group in group_by_namespace(documents).values() for node in chunk_documents(group)]
+            nodes = nodes[(state.batches_done if state else 0) * batch_size :]
+            plan["documents"] += len(documents)
+            plan["nodes"] += len(nodes)
+            plan["embedding_tokens"] += sum(
+                len(tokenizer(node.get_content(metadata_mode=MetadataMode.EMBED))) for node in nodes
+            )
+    finally:
+        checkpoint.close()
+    return plan
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the configured documents into the vector store.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report the planned work and estimated tokens")
+    parser.add_argument("--restart", action="store_true", help="Abandon an interrupted run instead of resuming it")
+    parser.add_argument("--batch-size", type=int, help="Nodes embedded and upserted per checkpointed batch")
+    parser.add_argument("--checkpoint", help="Checkpoint file, INGEST_CHECKPOINT by default")
+    args = parser.parse_args()
+
     init_settings()
-    generate_datasource()
+    if args.dry_run:
+        print(json.dumps(plan_datasource(args.checkpoint, args.batch_size), indent=2))
+    else:
+        generate_datasource(
+            tenant_id=os.getenv("TENANT_ID"),
+            checkpoint_path=args.checkpoint,
+            batch_size=args.batch_size,
+            restart=args.restart,
+        )
@@ -1,20 +1,92 @@
 import logging
 import os
+import threading
+import urllib.parse
+from typing import List, Optional
 
 from llama_index.core.indices import VectorStoreIndex
-from llama_index.vector_stores.pinecone import PineconeVectorStore
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
 
 
 logger = logging.getLogger("uvicorn")
 
+_local_stores = {}
+_local_stores_lock = threading.Lock()
+_indexes = {}
+_indexes_lock = threading.Lock()
 
-def get_index():
-    logger.info("Connecting to index from Pinecone...")
-    store = PineconeVectorStore(
+
+def _create_quantized_vector_store(persist_dir: str):
+    from app.engine.quantized import QuantizedVectorStore
+
+    search_dim = os.getenv("MATRYOSHKA_DIM")
+    if search_dim is not None:
+        # a short prefix needs a deeper candidate list to keep recall up
+        rescore_candidates = os.getenv("MATRYOSHKA_CANDIDATES", "300")
+    else:
+        rescore_candidates = os.getenv("VECTOR_STORE_RESCORE_CANDIDATES", "100")
+    return QuantizedVectorStore(
+        persist_dir=persist_dir,
+        quantization=os.getenv("VECTOR_STORE_QUANTIZATION", "int8"),
+        rescore_candidates=int(rescore_candidates),
+        search_dim=int(search_dim) if search_dim is not None else None,
+    )
+
+
+def get_quantized_vector_store(namespace: Optional[str] = None):
+    persist_dir = os.getenv("VECTOR_STORE_DIR", "storage/vectors")
+    if namespace:
+        persist_dir = os.path.join(persist_dir, "namespaces", urllib.parse.quote(namespace, safe=""))
+    # the store lives in memory, every caller in the process must share it
+    with _local_stores_lock:
+        if persist_dir not in _local_stores:
+            _local_stores[persist_dir] = _create_quantized_vector_store(persist_dir)
+        return _local_stores[persist_dir]
+
+
+def get_vector_store(namespace: Optional[str] = None) -> BasePydanticVectorStore:
+    """The vector store of `namespace`; the default namespace if it is empty."""
+    provider = os.getenv("VECTOR_STORE", "pinecone")
+    if provider == "quantized":
+        return get_quantized_vector_store(namespace)
+    if provider != "pinecone":
+        raise ValueError(f"Unsupported VECTOR_STORE {provider!r}, use 'pinecone' or 'quantized'")
+    if os.getenv("MATRYOSHKA_DIM") is not None:
+        # Pinecone searches the full vectors, there is no second stage to rerank with
+        raise ValueError("MATRYOSHKA_DIM requires VECTOR_STORE=quantized")
+
+    from llama_index.vector_stores.pinecone import PineconeVectorStore
+
+    from app.clients import pinecone_index
+
+    return PineconeVectorStore(
+        pinecone_index=pinecone_index(os.environ["PINECONE_INDEX_NAME"]),
         api_key=os.environ["PINECONE_API_KEY"],
         index_name=os.environ["PINECONE_INDEX_NAME"],
         environment=os.environ["PINECONE_ENVIRONMENT"],
+        namespace=namespace or None,
     )
-    index = VectorStoreIndex.from_vector_store(store)
-    logger.info("Finished connecting to index from Pinecone.")
-    return index
+
+
+def list_namespaces() -> List[str]:
+    """The namespaces that hold vectors, "" being the default namespace."""
+    if os.getenv("VECTOR_STORE", "pinecone") == "quantized":
+        namespaces_dir = os.path.join(os.getenv("VECTOR_STORE_DIR", "storage/vectors"), "namespaces")
+        names = os.listdir(namespaces_dir) if os.path.isdir(namespaces_dir) else []
+        return [""] + sorted(urllib.parse.unquote(name) for name in names)
+    stats = get_vector_store().client.describe_index_stats()
+    return sorted(stats.namespaces or {})
+
+
+def get_index(namespace: Optional[str] = None):
+    """
+    The index of `namespace`, built once per process: the vector store client
+    and its connection pool are shared by all chat requests.
+    """
+    key = namespace or ""
+    with _indexes_lock:
+        if key not in _indexes:
+            logger.info(f"Connecting to the vector store index (namespace {key or 'default'})...")
+            _indexes[key] = VectorStoreIndex.from_vector_store(get_vector_store(namespace))
+            logger.info("Finished connecting to the vector store index.")
+        return _indexes[key]
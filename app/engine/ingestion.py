@@ -0,0 +1,65 @@
+import logging
+from typing import List, Sequence
+
+from llama_index.core.schema import BaseNode, Document, MetadataMode
+from llama_index.core.settings import Settings
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
+
+from app.engine.dedup import filter_near_duplicates
+from app.metrics import INGEST_STAGE_SECONDS
+from app.progress import report_nodes
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_documents(documents: Sequence[Document]) -> List[BaseNode]:
+    with INGEST_STAGE_SECONDS.time(stage="chunk"):
+        nodes = list(documents)
+        for transformation in Settings.transformations:
+            nodes = transformation(nodes)
+    return nodes
+
+
+def embed_nodes(nodes: List[BaseNode], show_progress: bool = False) -> List[BaseNode]:
+    pending = [node for node in nodes if node.embedding is None]
+    if not pending:
+        return nodes
+    with INGEST_STAGE_SECONDS.time(stage="embed"):
+        embeddings = Settings.embed_model.get_text_embedding_batch(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending],
+            show_progress=show_progress,
+        )
+    for node, embedding in zip(pending, embeddings):
+        node.embedding = embedding
+    return nodes
+
+
+def upsert_nodes(store: BasePydanticVectorStore, nodes: List[BaseNode]) -> List[str]:
+    if not nodes:
+        return []
+    with INGEST_STAGE_SECONDS.time(stage="upsert"):
+        return store.add(nodes)
+
+
+def index_documents(
+    documents: Sequence[Document],
+    store: BasePydanticVectorStore,
+    show_progress: bool = False,
+    namespace: str = "",
+) -> List[BaseNode]:
+    """
+    Chunk, embed and upsert documents into the vector store. This is what
+    `VectorStoreIndex.from_documents` does for a store that keeps the node text,
+    split into separately timed stages. Near-duplicates of chunks already in
+    `namespace` are dropped before embedding if DEDUP_MODE is enabled, and
+    the chunks of other files that duplicated the replaced chunks of these
+    files are indexed with them. Returns the indexed nodes.
+    """
+    nodes = filter_near_duplicates(chunk_documents(documents), namespace)
+    report_nodes("chunked", nodes)
+    embed_nodes(nodes, show_progress=show_progress)
+    report_nodes("embedded", nodes)
+    upsert_nodes(store, nodes)
+    report_nodes("upserted", nodes)
+    logger.info(f"Indexed {len(documents)} documents as {len(nodes)} nodes")
+    return nodes
@@ -0,0 +1,105 @@
+import mimetypes
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.schema import BaseNode, Document
+
+from app.engine.firestore import get_firestore_client
+from app.engine.scope import document_path
+
+# the Firestore collection with one record per ingested file, the authoritative
+# list of what the vector store should contain
+LEDGER_COLLECTION = "ingestedDocs"
+
+INGEST_ID_KEY = "ingest_id"
+
+
+def ledger_key(namespace: str, path: str) -> str:
+    """
+    Firestore document id of the record of the file at `path` (folder and
+    file name, see `document_path`). Files at the root keep their plain file
+    name, the ids of the default namespace have no prefix.
+    """
+    key = urllib.parse.quote(path, safe="") if "/" in path else path
+    if not namespace:
+        return key
+    return f"{urllib.parse.quote(namespace, safe='')}:{key}"
+
+
+def assign_ingest_ids(
+    documents: Sequence[Document], ingest_ids: Optional[Dict[str, str]] = None
+) -> Dict[str, str]:
+    """
+    Tag every document with a fresh id per file, or the one given in
+    `ingest_ids` by `document_path`. Nodes inherit it, so the chunks of an
+    earlier ingestion of the same file can be told apart from the current
+    ones. Runs after `add_scope_metadata`, the folder is part of the file.
+    """
+    ingest_ids = dict(ingest_ids or {})
+    for document in documents:
+        path = document_path(document.metadata)
+        if path not in ingest_ids:
+            ingest_ids[path] = uuid.uuid4().hex
+        document.metadata[INGEST_ID_KEY] = ingest_ids[path]
+        for keys in (document.excluded_embed_metadata_keys, document.excluded_llm_metadata_keys):
+            if INGEST_ID_KEY not in keys:
+                keys.append(INGEST_ID_KEY)
+    return ingest_ids
+
+
+def record_ingestion(namespace: str, documents: Sequence[Document], nodes: List[BaseNode], **fields):
+    """
+    Write one ledger record per file in `documents`, replacing the record of
+    earlier ingestions of the file at the same path. `fields` are added to
+    every record.
+    """
+    node_counts = Counter(document_path(node.metadata) for node in nodes)
+    collection = get_firestore_client().collection(LEDGER_COLLECTION)
+    recorded = set()
+    for document in documents:
+        file_name = document.metadata.get("file_name")
+        path = document_path(document.metadata)
+        if not file_name or path in recorded:
+            continue
+        recorded.add(path)
+        file_type = document.metadata.get("file_type")
+        collection.document(ledger_key(namespace, path)).set(
+            {
+                "filename": file_name,
+                "filetype": mimetypes.guess_extension(file_type) if file_type else None,
+                # the (truncated) first document, as the records always had
+                "content": str(document),
+                "status": "processed",
+                "namespace": namespace,
+                "folder": document.metadata.get("folder", ""),
+                INGEST_ID_KEY: document.metadata.get(INGEST_ID_KEY),
+                "node_count": node_counts[path],
+                "ingested_at": document.metadata.get("ingested_at", int(time.time())),
+                **fields,
+            }
+        )
+
+
+def load_ledger() -> Dict[Tuple[str, str], Optional[str]]:
+    """
+    (namespace, folder and file name) -> the current ingest id of every
+    recorded file. Records written before ingest ids were tracked map to None.
+    """
+    ledger: Dict[Tuple[str, str], Optional[str]] = {}
+    newest: Dict[Tuple[str, str], int] = {}
+    for snapshot in get_firestore_client().collection(LEDGER_COLLECTION).stream():
+        record = snapshot.to_dict() or {}
+        file_name = record.get("filename")
+        if not file_name:
+            continue
+        key = (record.get("namespace") or "", document_path({"folder": record.get("folder"), "file_name": file_name}))
+        ingest_id = record.get(INGEST_ID_KEY)
+        ingested_at = record.get("ingested_at") or 0
+        # legacy generate.py runs added a record per run, the newest tracked one wins
+        if key not in ledger or (ingest_id and (ledger[key] is None or ingested_at >= newest[key])):
+            ledger[key] = ingest_id or ledger.get(key)
+            newest[key] = ingested_at
+    return ledger
@@ -1,9 +1,12 @@
 import os
+import json
 import yaml
 import importlib
 import logging
-from typing import Dict
-from app.engine.loaders.file import FileLoaderConfig, get_file_documents
+from typing import Callable, Dict, List, NamedTuple, Optional
+from llama_index.core.readers import SimpleDirectoryReader
+from llama_index.core.schema import Document
+from app.engine.loaders.file import FileLoaderConfig, get_file_documents, get_file_reader
 from app.engine.loaders.web import WebLoaderConfig, get_web_documents
 from app.engine.loaders.db import DBLoaderConfig, get_db_documents
  # Importieren Sie die neuen Funktionen
@@ -41,3 +44,63 @@ def get_documents():
         documents.extend(document)
 
     return documents
+
+
+class DocumentSource(NamedTuple):
+    """A separately loadable part of the configured documents."""
+
+    key: str
+    # changes whenever the content may have changed
+    fingerprint: str
+    load: Callable[[], List[Document]]
+    # loads the documents without paid parsers, for estimates; None if there is no such way
+    preview: Optional[Callable[[], List[Document]]] = None
+    # the directory the folders of file documents are relative to, None for other sources
+    root: Optional[str] = None
+
+
+def file_sources(reader: SimpleDirectoryReader) -> List[DocumentSource]:
+    """One source per file of `reader`, loaded with its file extractors."""
+    sources = []
+    for input_file in reader.input_files:
+        stat = os.stat(input_file)
+        sources.append(
+            DocumentSource(
+                key=f"file:{os.path.abspath(input_file)}",
+                fingerprint=f"{stat.st_size}:{stat.st_mtime_ns}",
+                load=lambda path=input_file: SimpleDirectoryReader(
+                    input_files=[path], file_extractor=reader.file_extractor, file_metadata=reader.file_metadata
+                ).load_data(),
+                preview=lambda path=input_file: SimpleDirectoryReader(
+                    input_files=[path], file_metadata=reader.file_metadata
+                ).load_data(),
+                root=str(reader.input_dir),
+            )
+        )
+    return sources
+
+
+def get_document_sources() -> List[DocumentSource]:
+    """
+    The documents of `get_documents`, split into sources that can be ingested
+    and checkpointed one by one: one per file for the file loader, one per
+    loader otherwise.
+    """
+    sources = []
+    for loader_type, loader_config in load_configs().items():
+        match loader_type:
+            case "file":
+                sources.extend(file_sources(get_file_reader(FileLoaderConfig(**loader_config))))
+                continue
+            case "web":
+                load = lambda config=loader_config: get_web_documents(WebLoaderConfig(**config))
+            case "db":
+                load = lambda config=loader_config: get_db_documents(
+                    configs=[DBLoaderConfig(**cfg) for cfg in config]
+                )
+            case _:
+                raise ValueError(f"Invalid loader type: {loader_type}")
+        # the content behind a crawl or query can't be fingerprinted, only its configuration
+        fingerprint = json.dumps(loader_config, sort_keys=True, default=str)
+        sources.append(DocumentSource(key=loader_type, fingerprint=fingerprint, load=load))
+    return sources
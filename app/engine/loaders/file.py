@@ -29,7 +29,7 @@ def llama_parse_parser():
 llama_parser = llama_parse_parser() if os.getenv("LLAMA_CLOUD_API_KEY") else None
 
 
-def get_file_documents(config: FileLoaderConfig):
+def get_file_reader(config: FileLoaderConfig) -> SimpleDirectoryReader:
     reader = SimpleDirectoryReader(
         config.data_dir,
         recursive=True,
@@ -46,4 +46,8 @@ def get_file_documents(config: FileLoaderConfig):
             ".docx": lambda path: {"text": Document(path).text, "filename": os.path.basename(path), "filetype": ".docx"},  # Sie müssen die geeignete Bibliothek für die Verarbeitung von .docx-Dateien verwenden
             # Fügen Sie hier weitere Dateitypen hinzu...
         }
-    return reader.load_data()
\ No newline at end of file
+    return reader
+
+
+def get_file_documents(config: FileLoaderConfig):
+    return get_file_reader(config).load_data()
@@ -0,0 +1,106 @@
+import mimetypes
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import BinaryIO, Callable, Dict, List
+
+from llama_index.core.schema import Document
+
+# the file types parsed from in-memory buffers, by the local extractors
+BUFFER_FILE_TYPES = (".pdf", ".docx", ".pptx", ".txt", ".md", ".csv", ".html")
+
+
+def spool_max_bytes() -> int:
+    """Buffers larger than INGEST_SPOOL_BYTES are moved from memory to a temporary file."""
+    return int(os.getenv("INGEST_SPOOL_BYTES", str(16 * 1024 * 1024)))
+
+
+def new_spool() -> tempfile.SpooledTemporaryFile:
+    return tempfile.SpooledTemporaryFile(max_size=spool_max_bytes())
+
+
+def spilled(spool: tempfile.SpooledTemporaryFile) -> bool:
+    """Whether the buffer has moved to a temporary file, whose writes block."""
+    return spool._rolled  # type: ignore[attr-defined]
+
+
+def parses_in_memory(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in BUFFER_FILE_TYPES
+
+
+def _pdf_pages(stream: BinaryIO) -> List[Dict]:
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(stream)
+    # one document per page, like the default PDF reader
+    return [
+        {"text": page.extract_text() or "", "metadata": {"page_label": reader.page_labels[i]}}
+        for i, page in enumerate(reader.pages)
+    ]
+
+
+def _docx(stream: BinaryIO) -> List[Dict]:
+    from docx import Document as DocxDocument
+
+    paragraphs = [paragraph.text for paragraph in DocxDocument(stream).paragraphs if paragraph.text]
+    return [{"text": "\n".join(paragraphs), "metadata": {}}]
+
+
+def _pptx_slides(stream: BinaryIO) -> List[Dict]:
+    from pptx import Presentation
+
+    slides = []
+    for number, slide in enumerate(Presentation(stream).slides, start=1):
+        texts = [shape.text_frame.text for shape in slide.shapes if shape.has_text_frame and shape.text_frame.text]
+        if slide.has_notes_slide and slide.notes_slide.notes_text_frame is not None:
+            texts.append(slide.notes_slide.notes_text_frame.text)
+        slides.append({"text": "\n".join(texts), "metadata": {"page_label": str(number)}})
+    return slides
+
+
+def _text(stream: BinaryIO) -> List[Dict]:
+    return [{"text": stream.read().decode("utf-8", errors="replace"), "metadata": {}}]
+
+
+# like SimpleDirectoryReader, the file attributes are kept out of the embedded and prompted text;
+# there is no file_path here, so the file name stays in as the context of the chunks
+FILE_METADATA_EXCLUDED = ["file_type", "file_size", "creation_date", "last_modified_date"]
+
+# python-docx, python-pptx and PyPDF2 all read from file objects
+_EXTRACTORS: Dict[str, Callable[[BinaryIO], List[Dict]]] = {
+    ".pdf": _pdf_pages,
+    ".docx": _docx,
+    ".pptx": _pptx_slides,
+}
+
+
+def load_buffer(filename: str, stream: BinaryIO) -> List[Document]:
+    """
+    Parse a file from a file object, without writing it to disk first. The
+    documents carry the same file metadata as those of `SimpleDirectoryReader`.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in BUFFER_FILE_TYPES:
+        raise ValueError(f"Unsupported file type {extension!r} for in-memory parsing")
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    extractor = _EXTRACTORS.get(extension)
+    parts = extractor(stream) if extractor else _text(stream)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    metadata = {
+        "file_name": os.path.basename(filename),
+        "file_type": mimetypes.guess_type(filename)[0],
+        "file_size": size,
+        "creation_date": today,
+        "last_modified_date": today,
+    }
+    return [
+        Document(
+            text=part["text"],
+            metadata={**part["metadata"], **metadata},
+            excluded_embed_metadata_keys=list(FILE_METADATA_EXCLUDED),
+            excluded_llm_metadata_keys=list(FILE_METADATA_EXCLUDED),
+        )
+        for part in parts
+    ]
@@ -0,0 +1,159 @@
+import bisect
+import math
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilters
+
+# metadata keys that get posting lists by default, the ones scoped retrieval filters on
+DEFAULT_INDEXED_KEYS = (
+    "doc_id",
+    "file_name",
+    "file_type",
+    "file_extension",
+    "folder",
+    "folders",
+    "ingested_at",
+)
+
+OPERATORS = {
+    FilterOperator.EQ: "$eq",
+    FilterOperator.NE: "$ne",
+    FilterOperator.GT: "$gt",
+    FilterOperator.GTE: "$gte",
+    FilterOperator.LT: "$lt",
+    FilterOperator.LTE: "$lte",
+    FilterOperator.IN: "$in",
+    FilterOperator.NIN: "$nin",
+}
+
+
+def filters_to_dict(filters: MetadataFilters) -> Dict[str, Any]:
+    """Convert llama_index metadata filters to the Pinecone style filter dict."""
+    clauses = []
+    for metadata_filter in filters.filters:
+        if metadata_filter.operator not in OPERATORS:
+            raise ValueError(f"Filter operator {metadata_filter.operator} is not supported")
+        clauses.append({metadata_filter.key: {OPERATORS[metadata_filter.operator]: metadata_filter.value}})
+    condition = "$or" if filters.condition == FilterCondition.OR else "$and"
+    return {condition: clauses}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _compare(value: Any, operator: str, expected: Any) -> bool:
+    values = value if isinstance(value, list) else [value]
+    if operator == "$eq":
+        return expected in values
+    if operator == "$ne":
+        return expected not in values
+    if operator == "$in":
+        return any(v in expected for v in values)
+    if operator == "$nin":
+        return not any(v in expected for v in values)
+    if value is None or isinstance(value, list):
+        return False
+    try:
+        if operator == "$gt":
+            return value > expected
+        if operator == "$gte":
+            return value >= expected
+        if operator == "$lt":
+            return value < expected
+        if operator == "$lte":
+            return value <= expected
+    except TypeError:
+        return False
+    raise ValueError(f"Filter operator {operator} is not supported")
+
+
+class MetadataIndex:
+    """
+    Posting lists of the rows holding each value of the indexed metadata keys,
+    and a column of numeric values per key for range filters. Evaluates
+    Pinecone style filter dicts ($eq, $ne, $in, $nin, $gt, $gte, $lt, $lte,
+    $and, $or) to boolean row masks without touching the rows' metadata. Keys
+    that are not indexed fall back to checking every row.
+
+    A list value is indexed under each of its elements, so `$eq` on a list
+    means membership, like in Pinecone.
+    """
+
+    def __init__(self, keys: Iterable[str] = DEFAULT_INDEXED_KEYS):
+        self.keys = set(keys)
+        self._postings: Dict[str, Dict[Any, List[int]]] = {key: {} for key in self.keys}
+        self._numbers: Dict[str, array] = {}
+
+    def add(self, row: int, metadata: Dict[str, Any]):
+        for key in self.keys.intersection(metadata):
+            value = metadata[key]
+            for element in value if isinstance(value, list) else [value]:
+                self._postings[key].setdefault(element, []).append(row)
+            if _is_number(value):
+                column = self._numbers.setdefault(key, array("d"))
+                if len(column) <= row:
+                    column.extend([math.nan] * (row + 1 - len(column)))
+                column[row] = value
+
+    def mask(
+        self,
+        filter: Dict[str, Any],
+        size: int,
+        row_metadata: Callable[[int], Optional[Dict[str, Any]]],
+    ) -> np.ndarray:
+        """Rows among the first `size` that match `filter`; `row_metadata` serves the fallback."""
+        mask = np.ones(size, dtype=bool)
+        for key, condition in filter.items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self.mask(clause, size, row_metadata)
+            elif key == "$or":
+                alternatives = np.zeros(size, dtype=bool)
+                for clause in condition:
+                    alternatives |= self.mask(clause, size, row_metadata)
+                mask &= alternatives
+            else:
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                for operator, expected in condition.items():
+                    mask &= self._operator_mask(key, operator, expected, size, row_metadata)
+        return mask
+
+    def _rows(self, key: str, value: Any, size: int) -> List[int]:
+        rows = self._postings[key].get(value, [])
+        # rows are appended in order, anything past `size` was added after the query started
+        return rows[: bisect.bisect_left(rows, size)]
+
+    def _operator_mask(self, key, operator, expected, size, row_metadata) -> np.ndarray:
+        if key in self._postings and operator in ("$eq", "$ne", "$in", "$nin"):
+            values = expected if operator in ("$in", "$nin") else [expected]
+            mask = np.zeros(size, dtype=bool)
+            for value in values:
+                rows = self._rows(key, value, size)
+                if rows:
+                    mask[np.asarray(rows)] = True
+            return ~mask if operator in ("$ne", "$nin") else mask
+
+        if key in self._numbers and operator in ("$gt", "$gte", "$lt", "$lte"):
+            column = np.full(size, np.nan)
+            values = np.frombuffer(self._numbers[key][:size], dtype=np.float64)
+            column[: len(values)] = values
+            # comparisons with NaN are False, so rows without the key never match
+            with np.errstate(invalid="ignore"):
+                if operator == "$gt":
+                    return column > expected
+                if operator == "$gte":
+                    return column >= expected
+                if operator == "$lt":
+                    return column < expected
+                return column <= expected
+
+        mask = np.zeros(size, dtype=bool)
+        for row in range(size):
+            metadata = row_metadata(row)
+            if metadata is not None and key in metadata:
+                mask[row] = _compare(metadata[key], operator, expected)
+        return mask
@@ -0,0 +1,36 @@
+import os
+from typing import Dict, List, Optional, Sequence
+
+from llama_index.core.schema import Document
+
+NAMESPACE_ROUTINGS = ("none", "root_folder")
+
+
+def namespace_routing() -> str:
+    routing = os.getenv("NAMESPACE_ROUTING", "none")
+    if routing not in NAMESPACE_ROUTINGS:
+        raise ValueError(f"Unsupported NAMESPACE_ROUTING {routing!r}, use one of {NAMESPACE_ROUTINGS}")
+    return routing
+
+
+def document_namespace(document: Document, tenant_id: Optional[str] = None) -> str:
+    """
+    The namespace a document is indexed into: the explicit tenant id if there
+    is one, else its root folder with NAMESPACE_ROUTING=root_folder, else the
+    default namespace (""). The folder comes from `add_scope_metadata`.
+    """
+    if tenant_id:
+        return tenant_id
+    if namespace_routing() == "root_folder":
+        folder = document.metadata.get("folder", "")
+        return folder.split("/")[0] if folder else ""
+    return ""
+
+
+def group_by_namespace(
+    documents: Sequence[Document], tenant_id: Optional[str] = None
+) -> Dict[str, List[Document]]:
+    groups: Dict[str, List[Document]] = {}
+    for document in documents:
+        groups.setdefault(document_namespace(document, tenant_id), []).append(document)
+    return groups
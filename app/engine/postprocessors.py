@@ -0,0 +1,355 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+from llama_index.core.settings import Settings
+
+from app.metrics import counter, histogram
+
+logger = logging.getLogger("uvicorn")
+
+CONTEXT_PACKING_MODES = ("off", "on")
+TOP_K_MODES = ("fixed", "adaptive")
+
+CONTEXT_TOKENS_SAVED = counter(
+    "chat_context_tokens_saved_total", "Context tokens left out of chat prompts by context packing", ["reason"]
+)
+ADAPTIVE_TOP_K = histogram(
+    "chat_adaptive_top_k", "Number of retrieved chunks kept by adaptive top-k", buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+# shorter matches between the end of a chunk and the start of another are coincidences
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 4000
+# the least room worth filling with the start of a chunk that doesn't fit
+MIN_TRUNCATED_TOKENS = 64
+
+
+def context_packing_mode() -> str:
+    mode = os.getenv("CONTEXT_PACKING", "off")
+    if mode not in CONTEXT_PACKING_MODES:
+        raise ValueError(f"Unsupported CONTEXT_PACKING {mode!r}, use one of {CONTEXT_PACKING_MODES}")
+    return mode
+
+
+def top_k_mode() -> str:
+    mode = os.getenv("TOP_K_MODE", "fixed")
+    if mode not in TOP_K_MODES:
+        raise ValueError(f"Unsupported TOP_K_MODE {mode!r}, use one of {TOP_K_MODES}")
+    return mode
+
+
+def model_tokenizer() -> Callable[[str], List]:
+    """The tokenizer of MODEL, or llama-index's default one for models tiktoken doesn't know."""
+    import tiktoken
+    from llama_index.core.utils import get_tokenizer
+
+    try:
+        return tiktoken.encoding_for_model(os.getenv("MODEL") or "").encode
+    except KeyError:
+        return get_tokenizer()
+
+
+def model_encoding():
+    """The tiktoken encoding of MODEL, cl100k_base (llama-index's default) for models tiktoken doesn't know."""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(os.getenv("MODEL") or "")
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """Token counts of texts, in a bounded LRU cache keyed by a digest of the text."""
+
+    def __init__(self, tokenizer: Callable[[str], List], max_size: int = 10000):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+        count = len(self.tokenizer(text))
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return count
+
+
+_token_counters: Dict[str, TokenCounter] = {}
+_token_counters_lock = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    model = os.getenv("MODEL") or ""
+    with _token_counters_lock:
+        if model not in _token_counters:
+            _token_counters[model] = TokenCounter(model_tokenizer())
+        return _token_counters[model]
+
+
+def text_overlap(a: str, b: str) -> int:
+    """Length of the longest end of `a` that `b` starts with, 0 below MIN_OVERLAP_CHARS."""
+    if len(b) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = b[:MIN_OVERLAP_CHARS]
+    # the earliest match is the longest overlap
+    start = a.find(probe, max(0, len(a) - MAX_OVERLAP_CHARS))
+    while start != -1:
+        if b.startswith(a[start:]):
+            return len(a) - start
+        start = a.find(probe, start + 1)
+    return 0
+
+
+def _normalized(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _document_key(node: NodeWithScore) -> Optional[str]:
+    return node.node.ref_doc_id or node.node.metadata.get("file_name")
+
+
+def _has_offsets(node: NodeWithScore) -> bool:
+    start, end = node.node.start_char_idx, node.node.end_char_idx
+    # the offsets are only usable if the text is exactly that span of the document
+    return start is not None and end is not None and end - start == len(node.node.get_content())
+
+
+def _joined(first: NodeWithScore, second: NodeWithScore, overlap: int) -> NodeWithScore:
+    node = first.node.copy()
+    node.text = first.node.get_content() + second.node.get_content()[overlap:]
+    if _has_offsets(first) and _has_offsets(second):
+        node.end_char_idx = max(first.node.end_char_idx, second.node.end_char_idx)
+    return NodeWithScore(node=node, score=max(first.score or 0.0, second.score or 0.0))
+
+
+def merge_adjacent(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    """
+    Join chunks of the same document that overlap or follow each other into
+    one, keeping the shared text once. Chunks with character offsets are
+    joined by them; others when the end of one is the start of another.
+    """
+    groups: "OrderedDict[Optional[str], List[NodeWithScore]]" = OrderedDict()
+    for node in nodes:
+        groups.setdefault(_document_key(node), []).append(node)
+
+    merged = []
+    for key, group in groups.items():
+        if key is None or len(group) == 1 or not all(isinstance(node.node, TextNode) for node in group):
+            merged.extend(group)
+            continue
+        if all(_has_offsets(node) for node in group):
+            group = sorted(group, key=lambda node: node.node.start_char_idx)
+            current = group[0]
+            for node in group[1:]:
+                if node.node.start_char_idx <= current.node.end_char_idx:
+                    overlap = current.node.end_char_idx - node.node.start_char_idx
+                    if overlap >= len(node.node.get_content()):
+                        current = NodeWithScore(node=current.node, score=max(current.score or 0.0, node.score or 0.0))
+                    else:
+                        current = _joined(current, node, overlap)
+                else:
+                    merged.append(current)
+                    current = node
+            merged.append(current)
+            continue
+        pending = list(group)
+        while pending:
+            current = pending.pop(0)
+            joined = True
+            while joined:
+                joined = False
+                for i, node in enumerate(pending):
+                    if overlap := text_overlap(current.node.get_content(), node.node.get_content()):
+                        current = _joined(current, node, overlap)
+                    elif overlap := text_overlap(node.node.get_content(), current.node.get_content()):
+                        current = _joined(node, current, overlap)
+                    else:
+                        continue
+                    del pending[i]
+                    joined = True
+                    break
+            merged.append(current)
+    return sorted(merged, key=lambda node: node.score or 0.0, reverse=True)
+
+
+def drop_contained(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    """
+    Leave out chunks whose text is part of another chunk, e.g. the same
+    paragraph in two copies of a file. The containing chunk keeps the better score.
+    """
+    texts = [_normalized(node.node.get_content()) for node in nodes]
+    kept: List[int] = []
+    for i in range(len(nodes)):
+        container = next((j for j in kept if texts[i] in texts[j]), None)
+        if container is not None:
+            continue
+        # a longer chunk further down replaces the ones it contains
+        contained = [j for j in kept if texts[j] in texts[i]]
+        if contained:
+            best = max([nodes[i].score or 0.0] + [nodes[j].score or 0.0 for j in contained])
+            nodes[i] = NodeWithScore(node=nodes[i].node, score=best)
+            kept = [j for j in kept if j not in contained]
+        kept.append(i)
+    return sorted((nodes[i] for i in kept), key=lambda node: node.score or 0.0, reverse=True)
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """
+    Assembles the retrieved chunks into the prompt context: chunks of the same
+    document that overlap or are adjacent are merged, chunks contained in
+    others are dropped, and the best-scored chunks are packed into
+    `token_budget` tokens of the target model. The first chunk that doesn't
+    fit is cut to the remaining room if there is enough of it, lower-scored
+    chunks that still fit are added after it.
+    """
+
+    token_budget: int = Field(description="Maximum number of context tokens.")
+    _count_tokens: Callable[[str], int] = PrivateAttr()
+    _encoding: Any = PrivateAttr()
+
+    def __init__(
+        self,
+        token_budget: int,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        encoding: Any = None,
+        **kwargs,
+    ):
+        super().__init__(token_budget=token_budget, **kwargs)
+        self._count_tokens = count_tokens or get_token_counter()
+        # cuts oversized chunks, with encode and decode
+        self._encoding = encoding or model_encoding()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextPacker"
+
+    @classmethod
+    def from_env(cls) -> "ContextPacker":
+        """CONTEXT_TOKEN_BUDGET, by default a quarter of the LLM's context window."""
+        budget = os.getenv("CONTEXT_TOKEN_BUDGET")
+        return cls(token_budget=int(budget) if budget else Settings.llm.metadata.context_window // 4)
+
+    def _tokens(self, node: NodeWithScore) -> int:
+        return self._count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM))
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        if not nodes:
+            return nodes
+        retrieved_tokens = sum(self._tokens(node) for node in nodes)
+        nodes = drop_contained(merge_adjacent(nodes))
+        deduplicated_tokens = sum(self._tokens(node) for node in nodes)
+
+        packed: List[NodeWithScore] = []
+        used = 0
+        truncated = False
+        for node in nodes:
+            tokens = self._tokens(node)
+            room = self.token_budget - used
+            if tokens > room:
+                if truncated or (packed and room < MIN_TRUNCATED_TOKENS):
+                    continue
+                node = self._truncated(node, room)
+                if node is None:
+                    # not even the metadata fits
+                    continue
+                tokens = self._tokens(node)
+                truncated = True
+            packed.append(node)
+            used += tokens
+
+        CONTEXT_TOKENS_SAVED.inc(retrieved_tokens - deduplicated_tokens, reason="overlap")
+        CONTEXT_TOKENS_SAVED.inc(max(deduplicated_tokens - used, 0), reason="budget")
+        return packed
+
+    def _truncated(self, node: NodeWithScore, max_tokens: int) -> Optional[NodeWithScore]:
+        """The node cut to `max_tokens` with its metadata, None if no text fits."""
+        truncated = node.node.copy()
+        truncated.text = ""
+        room = max_tokens - self._count_tokens(truncated.get_content(metadata_mode=MetadataMode.LLM))
+        tokens = self._encoding.encode(node.node.get_content(), disallowed_special=())
+        # token counts are not quite additive at the seam, cut a little more if they are off
+        while room > 0:
+            # a token cut in the middle of a character decodes to a replacement character
+            truncated.text = self._encoding.decode(tokens[:room]).rstrip("\ufffd")
+            excess = self._count_tokens(truncated.get_content(metadata_mode=MetadataMode.LLM)) - max_tokens
+            if excess <= 0:
+                break
+            room -= excess
+        if room <= 0 or not truncated.text.strip():
+            return None
+        return NodeWithScore(node=truncated, score=node.score)
+
+
+class AdaptiveTopK(BaseNodePostprocessor):
+    """
+    Keeps as many of the over-fetched candidates as the question needs.
+
+    Candidates scoring below `score_floor` are dropped, then the list is cut at
+    the largest relative drop between consecutive scores if that drop is at
+    least `min_gap`, e.g. 0.9, 0.88, 0.71 is cut after the second result. At
+    least `min_k` and at most `max_k` results are kept, in the order of the
+    retriever. Results without scores are kept up to `max_k`.
+    """
+
+    min_k: int = Field(description="Results kept regardless of their scores.")
+    max_k: int = Field(description="Results kept at most.")
+    score_floor: float = Field(description="Similarity below which results are dropped.")
+    min_gap: float = Field(description="Relative score drop that ends the results.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AdaptiveTopK"
+
+    @classmethod
+    def from_env(cls, max_k: int) -> "AdaptiveTopK":
+        return cls(
+            min_k=int(os.getenv("TOP_K_MIN", "1")),
+            max_k=max_k,
+            score_floor=float(os.getenv("TOP_K_SCORE_FLOOR", "0.7")),
+            min_gap=float(os.getenv("TOP_K_MIN_GAP", "0.1")),
+        )
+
+    def cutoff(self, scores: List[float]) -> int:
+        """The number of results to keep, given the scores of those above the floor."""
+        k = min(len(scores), self.max_k)
+        best_gap, cut = 0.0, k
+        for i in range(max(self.min_k, 1), k):
+            previous = scores[i - 1]
+            gap = (previous - scores[i]) / previous if previous > 0 else 0.0
+            if gap > best_gap:
+                best_gap, cut = gap, i
+        return cut if best_gap >= self.min_gap else k
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        if any(node.score is None for node in nodes):
+            return nodes[: self.max_k]
+        scores = [round(node.score, 4) for node in nodes]
+        # fused retrievers don't order by score, the first min_k stay whatever their scores
+        above = nodes[: self.min_k] + [node for node in nodes[self.min_k :] if node.score >= self.score_floor]
+        k = self.cutoff([node.score for node in above])
+        ADAPTIVE_TOP_K.observe(k)
+        logger.info(f"Adaptive top-k kept {k} of {len(nodes)} results, scores {scores}")
+        return above[:k]
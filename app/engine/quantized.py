@@ -0,0 +1,496 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from app.engine.metadata_index import MetadataIndex, filters_to_dict
+
+logger = logging.getLogger("uvicorn")
+
+QUANTIZATIONS = ("int8", "float16")
+VECTORS_FILE = "vectors.f32"
+NODES_FILE = "nodes.jsonl"
+
+# rows scored per block, so the coarse search never materialises a float32 copy of the matrix
+SCORE_BLOCK_ROWS = 16384
+# below this share of matching rows, only the matching rows are scored
+SPARSE_FILTER_FRACTION = 0.25
+# int8 scales get some headroom so that a few new outliers don't force a requantization
+INT8_HEADROOM = 1.1
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class QuantizedVectorStore(BasePydanticVectorStore):
+    """
+    Local vector store that keeps scalar quantized embeddings in memory.
+
+    The coarse top-k search runs on an int8 (per-dimension symmetric scale) or
+    float16 copy of the normalized embeddings, which is 4x or 2x smaller than
+    float32. Only this search matrix shrinks: the node text and metadata are
+    kept in memory as they are and usually outweigh it, `memory_bytes` counts
+    both. The best `rescore_candidates` rows are then rescored against the
+    full-precision vectors, which stay on disk in `persist_dir` and are
+    memory-mapped. Similarities are cosine similarities.
+
+    With `search_dim` set, the coarse search only uses the first `search_dim`
+    dimensions of every embedding (Matryoshka retrieval). This only makes sense
+    for models trained for truncation, such as OpenAI's text-embedding-3 models.
+    The codes are rebuilt from the full vectors on start, so `search_dim` and
+    `quantization` can be changed without reindexing.
+
+    Metadata filters, given as `VectorStoreQuery.filters` or as a Pinecone style
+    `filter` dict in the query kwargs, are resolved on a `MetadataIndex` before
+    the search; when they leave few rows, only those rows are scored.
+
+    The store is persisted as an append-only node log next to the vectors and
+    reloaded on start. Deleted rows stay on disk until `compact` rewrites both. It is meant for a single process; several workers must
+    not write to the same directory.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+
+    persist_dir: str = Field(description="Directory with the full-precision vectors and the node log.")
+    quantization: str = Field(default="int8", description="One of 'int8' or 'float16'.")
+    rescore_candidates: int = Field(
+        default=100, description="Rows rescored at full precision, at least similarity_top_k."
+    )
+    search_dim: Optional[int] = Field(
+        default=None, description="Leading dimensions used by the coarse search, all if unset."
+    )
+
+    _lock: threading.RLock = PrivateAttr()
+    _vectors_file: str = PrivateAttr(default=VECTORS_FILE)
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scale: Optional[np.ndarray] = PrivateAttr(default=None)
+    _vectors: Optional[np.memmap] = PrivateAttr(default=None)
+    _alive: np.ndarray = PrivateAttr()
+    _ids: List[str] = PrivateAttr(default_factory=list)
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    _metadata: List[Optional[Dict]] = PrivateAttr(default_factory=list)
+    _payload_sizes: List[int] = PrivateAttr(default_factory=list)
+    _payload_bytes: int = PrivateAttr(default=0)
+    _metadata_index: MetadataIndex = PrivateAttr(default_factory=MetadataIndex)
+
+    def __init__(
+        self,
+        persist_dir: str,
+        quantization: str = "int8",
+        rescore_candidates: int = 100,
+        search_dim: Optional[int] = None,
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization {quantization!r}, use one of {QUANTIZATIONS}")
+        super().__init__(
+            persist_dir=persist_dir,
+            quantization=quantization,
+            rescore_candidates=rescore_candidates,
+            search_dim=search_dim,
+        )
+        self._lock = threading.RLock()
+        self._alive = np.zeros(0, dtype=bool)
+        os.makedirs(persist_dir, exist_ok=True)
+        self._load()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "QuantizedVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.persist_dir, self._vectors_file)
+
+    @property
+    def _nodes_path(self) -> str:
+        return os.path.join(self.persist_dir, NODES_FILE)
+
+    def __len__(self) -> int:
+        return int(self._alive[: self._size].sum())
+
+    def matrix_bytes(self) -> int:
+        """Bytes of the in-memory search matrix."""
+        if self._codes is None:
+            return 0
+        return self._codes[: self._size].nbytes + (self._scale.nbytes if self._scale is not None else 0)
+
+    def payload_bytes(self) -> int:
+        """Bytes of the node text and metadata of the live rows, measured as their JSON size."""
+        return self._payload_bytes
+
+    def memory_bytes(self) -> int:
+        """Bytes held in memory: the search matrix plus the node payloads."""
+        return self.matrix_bytes() + self.payload_bytes()
+
+    def search_rows(self, query_embedding: List[float], top_k: int, rescore: bool = True) -> List[str]:
+        """Ids of the `top_k` nearest rows, optionally without the full-precision rescoring."""
+        if rescore:
+            result = self.query(VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=top_k))
+            return result.ids
+        query_vector = _normalize(np.asarray([query_embedding], dtype=np.float32))
+        scores = self._coarse_scores(self._codes, self._scale, self._prefix(query_vector)[0], self._size)
+        scores[~self._alive[: self._size]] = -np.inf
+        return [self._ids[row] for row in np.argsort(-scores)[:top_k]]
+
+    def get_nodes(self, node_ids: List[str]) -> List[BaseNode]:
+        """The stored nodes with the given ids, skipping unknown and deleted ones."""
+        with self._lock:
+            rows = [self._rows[node_id] for node_id in node_ids if node_id in self._rows]
+            return [metadata_dict_to_node(self._metadata[row]) for row in rows if self._alive[row]]
+
+    def node_metadata(self) -> List[Tuple[str, Dict]]:
+        """(node id, metadata) of every stored node."""
+        with self._lock:
+            return [
+                (self._ids[row], self._metadata[row])
+                for row in np.flatnonzero(self._alive[: self._size])
+            ]
+
+    def dead_rows(self) -> int:
+        """Deleted rows that still take space on disk and in memory until `compact`."""
+        return self._size - len(self)
+
+    def _reset(self):
+        self._dim = None
+        self._size = 0
+        self._codes = self._scale = self._vectors = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._ids, self._rows, self._ref_doc_ids, self._metadata = [], {}, [], []
+        self._payload_sizes, self._payload_bytes = [], 0
+        self._metadata_index = MetadataIndex()
+
+    def _load(self):
+        if not os.path.exists(self._nodes_path):
+            return
+        entries = []
+        with open(self._nodes_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+        header = next((entry for entry in entries if "dim" in entry), None)
+        if header is None:
+            return
+        dim = header["dim"]
+        # compaction writes the vectors to a new file and names it in the header
+        self._vectors_file = header.get("vectors", VECTORS_FILE)
+        self._set_dim(dim)
+        row_bytes = 4 * dim
+        vectors_size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        rows_on_disk = vectors_size // row_bytes
+        kept, dropped = [], 0
+        for entry in entries:
+            if "delete" in entry:
+                self._mark_deleted(entry["delete"])
+            elif "delete_nodes" in entry:
+                self._mark_nodes_deleted(entry["delete_nodes"])
+            elif "id" in entry:
+                if len(self._ids) >= rows_on_disk:
+                    # a row only counts once both its vector and its log entry were written
+                    dropped += 1
+                    continue
+                self._append_row(entry["id"], entry["ref_doc_id"], entry["metadata"])
+            kept.append(entry)
+        if vectors_size > len(self._ids) * row_bytes:
+            # vectors written by an add that crashed before its log entries, later adds would pair with them
+            logger.warning(f"Dropping {vectors_size // row_bytes - len(self._ids)} vectors without a log entry")
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(len(self._ids) * row_bytes)
+        if dropped:
+            # log entries without a vector would pair with the vectors of later adds
+            logger.warning(f"Dropping {dropped} log entries without a vector")
+            self._rewrite_log(kept)
+        self._remap(len(self._ids))
+        self._requantize()
+        logger.info(f"Loaded {len(self)} vectors ({self.quantization}) from {self.persist_dir}")
+
+    def _rewrite_log(self, entries: List[Dict]):
+        tmp_nodes_path = self._nodes_path + ".tmp"
+        with open(tmp_nodes_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_nodes_path, self._nodes_path)
+
+    def _append_row(self, node_id: str, ref_doc_id: Optional[str], metadata: Dict):
+        if node_id in self._rows:
+            # upserting an existing id replaces it
+            self._alive[self._rows[node_id]] = False
+            self._drop_payload(self._rows[node_id])
+        row = len(self._ids)
+        self._ids.append(node_id)
+        self._rows[node_id] = row
+        self._ref_doc_ids.append(ref_doc_id)
+        self._metadata.append(metadata)
+        self._payload_sizes.append(len(json.dumps(metadata)))
+        self._payload_bytes += self._payload_sizes[row]
+        self._metadata_index.add(row, metadata)
+        if row >= len(self._alive):
+            alive = np.zeros(max(1024, 2 * len(self._alive)), dtype=bool)
+            alive[: len(self._alive)] = self._alive
+            self._alive = alive
+        self._alive[row] = True
+
+    def _mark_deleted(self, ref_doc_id: str):
+        for row, row_ref_doc_id in enumerate(self._ref_doc_ids):
+            if row_ref_doc_id == ref_doc_id and self._alive[row]:
+                self._alive[row] = False
+                self._drop_payload(row)
+                self._rows.pop(self._ids[row], None)
+
+    def _mark_nodes_deleted(self, node_ids: List[str]):
+        for node_id in node_ids:
+            row = self._rows.pop(node_id, None)
+            if row is not None:
+                self._alive[row] = False
+                self._drop_payload(row)
+
+    def _drop_payload(self, row: int):
+        self._metadata[row] = None
+        self._payload_bytes -= self._payload_sizes[row]
+        self._payload_sizes[row] = 0
+
+    def _set_dim(self, dim: int):
+        if self.search_dim is not None and not 0 < self.search_dim < dim:
+            raise ValueError(f"search_dim must be between 1 and {dim - 1}, got {self.search_dim}")
+        self._dim = dim
+
+    @property
+    def _coarse_dim(self) -> int:
+        return self.search_dim or self._dim
+
+    def _prefix(self, vectors: np.ndarray) -> np.ndarray:
+        """The vectors the coarse search runs on: renormalized prefixes with `search_dim`."""
+        if self.search_dim is None:
+            return vectors
+        return _normalize(vectors[:, : self.search_dim])
+
+    def _remap(self, size: int):
+        self._size = size
+        if size == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(size, self._dim))
+
+    @property
+    def _codes_dtype(self):
+        return np.float16 if self.quantization == "float16" else np.int8
+
+    def _quantize(self, vectors: np.ndarray, scale: Optional[np.ndarray]) -> np.ndarray:
+        if self.quantization == "float16":
+            return vectors.astype(np.float16)
+        return np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+
+    def _ensure_capacity(self, size: int):
+        if size > len(self._codes):
+            codes = np.zeros((max(size, 2 * len(self._codes)), self._coarse_dim), dtype=self._codes_dtype)
+            codes[: len(self._codes)] = self._codes
+            self._codes = codes
+
+    def _requantize(self):
+        """Rebuild the quantized matrix from the full-precision vectors on disk."""
+        if self._size == 0:
+            return
+        scale = None
+        if self.quantization == "int8":
+            absmax = np.zeros(self._coarse_dim, dtype=np.float32)
+            for start in range(0, self._size, SCORE_BLOCK_ROWS):
+                block = self._prefix(np.asarray(self._vectors[start : start + SCORE_BLOCK_ROWS]))
+                absmax = np.maximum(absmax, np.abs(block).max(axis=0))
+            scale = np.maximum(absmax * INT8_HEADROOM, 1e-12) / 127
+        # built aside and swapped in, concurrent queries keep using the old matrix and scale
+        codes = np.zeros((max(self._size, 1024), self._coarse_dim), dtype=self._codes_dtype)
+        for start in range(0, self._size, SCORE_BLOCK_ROWS):
+            block = self._prefix(np.asarray(self._vectors[start : start + SCORE_BLOCK_ROWS]))
+            codes[start : start + len(block)] = self._quantize(block, scale)
+        self._codes, self._scale = codes, scale
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = _normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            if self._dim is None:
+                self._set_dim(vectors.shape[1])
+                with open(self._nodes_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"dim": self._dim}) + "\n")
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Expected embeddings of dimension {self._dim}, got {vectors.shape[1]}")
+
+            # vectors first: on load, log entries without a vector are dropped
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._nodes_path, "a", encoding="utf-8") as f:
+                for node in nodes:
+                    metadata = node_to_metadata_dict(node, remove_text=False, flat_metadata=self.flat_metadata)
+                    self._append_row(node.node_id, node.ref_doc_id, metadata)
+                    f.write(json.dumps({"id": node.node_id, "ref_doc_id": node.ref_doc_id, "metadata": metadata}) + "\n")
+
+            start = self._size
+            self._remap(start + len(nodes))
+            coarse = self._prefix(vectors)
+            needs_refit = self._codes is None or (
+                self.quantization == "int8"
+                and bool((np.abs(coarse).max(axis=0) > self._scale * 127).any())
+            )
+            if needs_refit:
+                self._requantize()
+            else:
+                self._ensure_capacity(self._size)
+                self._codes[start : self._size] = self._quantize(coarse, self._scale)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            self._mark_deleted(ref_doc_id)
+            with open(self._nodes_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"delete": ref_doc_id}) + "\n")
+
+    def delete_nodes(self, node_ids: List[str]) -> None:
+        """Delete nodes by id, unknown ids are ignored."""
+        if not node_ids:
+            return
+        with self._lock:
+            self._mark_nodes_deleted(node_ids)
+            with open(self._nodes_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"delete_nodes": list(node_ids)}) + "\n")
+
+    def compact(self) -> int:
+        """
+        Rewrite the vectors and the node log without the deleted rows and
+        return how many rows were dropped. The new vectors go to a new file and
+        the new log, which names it, replaces the old one in a single rename, so
+        a crash leaves either the old or the new store intact.
+        """
+        with self._lock:
+            dropped = self.dead_rows()
+            if self._dim is None or dropped == 0:
+                return 0
+            rows = np.flatnonzero(self._alive[: self._size])
+            old_vectors_path = self._vectors_path
+            vectors_file = f"vectors.{uuid.uuid4().hex[:12]}.f32"
+            with open(os.path.join(self.persist_dir, vectors_file), "wb") as f:
+                for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+                    f.write(np.asarray(self._vectors[rows[start : start + SCORE_BLOCK_ROWS]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            tmp_nodes_path = self._nodes_path + ".tmp"
+            with open(tmp_nodes_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"dim": self._dim, "vectors": vectors_file}) + "\n")
+                for row in rows:
+                    entry = {"id": self._ids[row], "ref_doc_id": self._ref_doc_ids[row], "metadata": self._metadata[row]}
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_nodes_path, self._nodes_path)
+
+            # queries running now keep their snapshot of the old rows and memory map
+            self._reset()
+            self._load()
+            if os.path.exists(old_vectors_path) and old_vectors_path != self._vectors_path:
+                os.remove(old_vectors_path)
+        logger.info(f"Compacted {self.persist_dir}: dropped {dropped} deleted rows")
+        return dropped
+
+    def _candidate_mask(self, query: VectorStoreQuery, size: int, filter: Optional[Dict]) -> np.ndarray:
+        mask = self._alive[:size].copy()
+        # the index passes an empty node id list when it has no docstore, that means no restriction
+        if query.node_ids:
+            allowed = np.zeros(size, dtype=bool)
+            rows = [self._rows[node_id] for node_id in query.node_ids if node_id in self._rows]
+            allowed[[row for row in rows if row < size]] = True
+            mask &= allowed
+        if query.doc_ids:
+            doc_ids = set(query.doc_ids)
+            mask &= np.fromiter((ref in doc_ids for ref in self._ref_doc_ids[:size]), dtype=bool, count=size)
+        for metadata_filter in (filters_to_dict(query.filters) if query.filters else None, filter):
+            if metadata_filter:
+                mask &= self._metadata_index.mask(metadata_filter, size, self._metadata.__getitem__)
+        return mask
+
+    @staticmethod
+    def _coarse_scores(
+        codes: np.ndarray, scale: Optional[np.ndarray], query_vector: np.ndarray, size: int
+    ) -> np.ndarray:
+        """Approximate similarities of the first `size` rows, from the quantized matrix."""
+        # folding the int8 scale into the query avoids dequantizing the matrix
+        scaled = query_vector * scale if scale is not None else query_vector
+        scores = np.empty(size, dtype=np.float32)
+        for start in range(0, size, SCORE_BLOCK_ROWS):
+            block = codes[start : min(start + SCORE_BLOCK_ROWS, size)]
+            scores[start : start + len(block)] = block.astype(np.float32) @ scaled
+        return scores
+
+    @staticmethod
+    def _coarse_scores_of_rows(
+        codes: np.ndarray, scale: Optional[np.ndarray], query_vector: np.ndarray, rows: np.ndarray
+    ) -> np.ndarray:
+        scaled = query_vector * scale if scale is not None else query_vector
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+            block = codes[rows[start : start + SCORE_BLOCK_ROWS]]
+            scores[start : start + len(block)] = block.astype(np.float32) @ scaled
+        return scores
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        with self._lock:
+            size = self._size
+            ids, metadata = self._ids, self._metadata
+            codes, scale, vectors = self._codes, self._scale, self._vectors
+            mask = self._candidate_mask(query, size, kwargs.get("filter")) if size else None
+        if not size or query.query_embedding is None or not mask.any():
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        query_vector = _normalize(np.asarray([query.query_embedding], dtype=np.float32))
+        coarse_query = self._prefix(query_vector)[0]
+        query_vector = query_vector[0]
+        top_k = query.similarity_top_k
+        matching = int(mask.sum())
+        num_candidates = min(max(self.rescore_candidates, top_k), matching)
+
+        if matching <= size * SPARSE_FILTER_FRACTION:
+            rows = np.flatnonzero(mask)
+            scores = self._coarse_scores_of_rows(codes, scale, coarse_query, rows)
+            candidates = rows[np.argpartition(-scores, num_candidates - 1)[:num_candidates]]
+        else:
+            scores = self._coarse_scores(codes, scale, coarse_query, size)
+            scores[~mask] = -np.inf
+            candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        # sorted reads are sequential on the memory-mapped file
+        candidates.sort()
+        exact = np.asarray(vectors[candidates]) @ query_vector
+        order = np.argsort(-exact)[:top_k]
+
+        # rows deleted since the snapshot have lost their metadata, read it under the lock and skip them
+        with self._lock:
+            results = [(ids[row], metadata[row], score) for row, score in zip(candidates[order], exact[order])]
+        results = [result for result in results if result[1] is not None]
+        return VectorStoreQueryResult(
+            nodes=[metadata_dict_to_node(row_metadata) for _, row_metadata, _ in results],
+            similarities=[float(score) for _, _, score in results],
+            ids=[node_id for node_id, _, _ in results],
+        )
@@ -0,0 +1,209 @@
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.settings import Settings
+
+
+def merge_top_k(results: List[List[NodeWithScore]], top_k: int) -> List[NodeWithScore]:
+    """Merge ranked lists by score; nodes found in several lists keep their best score."""
+    best = {}
+    for nodes in results:
+        for node in nodes:
+            current = best.get(node.node.node_id)
+            if current is None or (node.score or 0.0) > (current.score or 0.0):
+                best[node.node.node_id] = node
+    return sorted(best.values(), key=lambda node: node.score or 0.0, reverse=True)[:top_k]
+
+
+class FanOutRetriever(BaseRetriever):
+    """
+    Queries several retrievers concurrently and merges their results into one
+    top-k list. Used to search several namespaces at once; their scores are
+    comparable because every namespace uses the same embedding model.
+
+    The query is embedded once and shared. The vector store queries are
+    blocking, so each one runs in a worker thread.
+    """
+
+    def __init__(
+        self,
+        retrievers: List[BaseRetriever],
+        similarity_top_k: int,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        self._retrievers = retrievers
+        self._similarity_top_k = similarity_top_k
+        super().__init__(callback_manager=callback_manager or Settings.callback_manager)
+
+    def _with_embedding(self, query_bundle: QueryBundle) -> QueryBundle:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = Settings.embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        return query_bundle
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query_bundle = self._with_embedding(query_bundle)
+        with ThreadPoolExecutor(max_workers=len(self._retrievers)) as executor:
+            results = list(executor.map(lambda retriever: retriever.retrieve(query_bundle), self._retrievers))
+        return merge_top_k(results, self._similarity_top_k)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await Settings.embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        results = await asyncio.gather(
+            *[asyncio.to_thread(retriever.retrieve, query_bundle) for retriever in self._retrievers]
+        )
+        return merge_top_k(list(results), self._similarity_top_k)
+
+
+RETRIEVAL_MODES = ("single", "multi_query")
+
+def retrieval_mode() -> str:
+    mode = os.getenv("RETRIEVAL_MODE", "single")
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unsupported RETRIEVAL_MODE {mode!r}, use one of {RETRIEVAL_MODES}")
+    return mode
+
+
+# the constant of reciprocal rank fusion, damps the weight of the top ranks
+RRF_K = 60
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_CONJUNCTION = re.compile(r"\s+(?:and|or|und|oder)\s+|[;?]\s*", re.IGNORECASE)
+
+# words that carry no meaning for retrieval, in the languages of the documents
+STOPWORDS = frozenset(
+    """
+    a about an and are as at be but by can could did do does for from had has have how i in is it its me my
+    of on or our should than that the their them there these they this to was we were what when where which
+    who why will with would you your
+    aber als am an auch auf aus bei bin bis da das dass dem den der des die dies diese dieser du durch ein
+    eine einem einen einer es für gibt hat ich ihr im in ist ja kann können man mit nach nicht noch nur ob
+    oder sich sie sind so über um und uns von vor was welche welcher welches wenn wer werden wie wir wird
+    wo zu zum zur
+    """.split()
+)
+
+
+def rule_based_queries(query: str, max_queries: int) -> List[str]:
+    """
+    The query and cheap reformulations of it: its keywords alone and, for
+    questions that combine several, each part on its own.
+    """
+    queries = [query]
+    keywords = [word for word in _WORD.findall(query) if word.lower() not in STOPWORDS]
+    if keywords:
+        queries.append(" ".join(keywords))
+    parts = [part.strip() for part in _CONJUNCTION.split(query) if part and part.strip()]
+    if len(parts) > 1:
+        for part in parts:
+            # "A and B" only splits into questions if both sides say something
+            if len([word for word in _WORD.findall(part) if word.lower() not in STOPWORDS]) >= 2:
+                queries.append(part)
+
+    unique = []
+    seen = set()
+    for candidate in queries:
+        key = " ".join(word.lower() for word in _WORD.findall(candidate))
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(candidate)
+    return unique[:max_queries]
+
+
+LLM_QUERIES_PROMPT = PromptTemplate(
+    "Write {count} different search queries that would find documents answering the question below, "
+    "using other words and the likely terms of such documents. Answer with one query per line and nothing else.\n\n"
+    "Question: {question}\n"
+)
+
+
+def reciprocal_rank_fusion(results: List[List[NodeWithScore]], top_k: int, k: int = RRF_K) -> List[NodeWithScore]:
+    """
+    Fuse ranked lists by the sum of 1 / (k + rank) of every node. The fused
+    nodes keep their best similarity as score, the order is the fused one.
+    """
+    fused: Dict[str, float] = {}
+    best: Dict[str, NodeWithScore] = {}
+    for nodes in results:
+        for rank, node in enumerate(nodes, start=1):
+            node_id = node.node.node_id
+            fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (k + rank)
+            if node_id not in best or (node.score or 0.0) > (best[node_id].score or 0.0):
+                best[node_id] = node
+    ranked = sorted(fused, key=lambda node_id: fused[node_id], reverse=True)
+    return [best[node_id] for node_id in ranked[:top_k]]
+
+
+class MultiQueryRetriever(FanOutRetriever):
+    """
+    Retrieves with several reformulations of the query and fuses the results
+    with reciprocal rank fusion, for vague questions a single query misses.
+
+    The reformulations are rule based, plus `llm_queries` written by the LLM
+    if set. They are embedded in one batch, and every (query, retriever) pair
+    is queried concurrently, so the latency stays close to that of a single
+    retrieval. Each retriever's results for a query are merged by score first,
+    as in `FanOutRetriever`.
+    """
+
+    def __init__(
+        self,
+        retrievers: List[BaseRetriever],
+        similarity_top_k: int,
+        max_queries: int = 3,
+        llm_queries: int = 0,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        self._max_queries = max_queries
+        self._llm_queries = llm_queries
+        super().__init__(retrievers, similarity_top_k, callback_manager=callback_manager)
+
+    def _with_llm_queries(self, queries: List[str], answer: str) -> List[str]:
+        lines = [line.strip(" -*0123456789.\t") for line in answer.splitlines()]
+        known = {candidate.lower() for candidate in queries}
+        return queries + [line for line in lines if line and line.lower() not in known][: self._llm_queries]
+
+    def _fuse(self, results: List[List[NodeWithScore]], queries: List[str]) -> List[NodeWithScore]:
+        per_query = [
+            merge_top_k(results[i * len(self._retrievers) : (i + 1) * len(self._retrievers)], self._similarity_top_k)
+            for i in range(len(queries))
+        ]
+        return reciprocal_rank_fusion(per_query, self._similarity_top_k)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        queries = rule_based_queries(query_bundle.query_str, self._max_queries)
+        if self._llm_queries:
+            answer = Settings.llm.predict(LLM_QUERIES_PROMPT, count=self._llm_queries, question=query_bundle.query_str)
+            queries = self._with_llm_queries(queries, answer)
+        # OpenAI embeds queries and texts alike, so the queries can share a batch
+        embeddings = Settings.embed_model.get_text_embedding_batch(queries)
+        bundles = [QueryBundle(query, embedding=embedding) for query, embedding in zip(queries, embeddings)]
+        pairs = [(bundle, retriever) for bundle in bundles for retriever in self._retrievers]
+        with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+            results = list(executor.map(lambda pair: pair[1].retrieve(pair[0]), pairs))
+        return self._fuse(results, queries)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        queries = rule_based_queries(query_bundle.query_str, self._max_queries)
+        if self._llm_queries:
+            answer = await Settings.llm.apredict(
+                LLM_QUERIES_PROMPT, count=self._llm_queries, question=query_bundle.query_str
+            )
+            queries = self._with_llm_queries(queries, answer)
+        embeddings = await Settings.embed_model.aget_text_embedding_batch(queries)
+        bundles = [QueryBundle(query, embedding=embedding) for query, embedding in zip(queries, embeddings)]
+        results = await asyncio.gather(
+            *[asyncio.to_thread(retriever.retrieve, bundle) for bundle in bundles for retriever in self._retrievers]
+        )
+        return self._fuse(list(results), queries)
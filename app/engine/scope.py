@@ -0,0 +1,120 @@
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index.core.schema import Document
+from pydantic import BaseModel, Field
+
+# metadata written at ingestion time so that retrieval can be scoped
+SCOPE_METADATA_KEYS = ["folder", "folders", "file_extension", "ingested_at", "ingest_source"]
+
+# where a document was ingested from; only "nextcloud" folders are paths on Nextcloud
+INGEST_SOURCES = ("nextcloud", "upload", "local")
+
+
+def normalize_folder(folder: Optional[str]) -> str:
+    return "/".join(part for part in (folder or "").replace("\\", "/").split("/") if part)
+
+
+def normalize_file_type(file_type: str) -> str:
+    return file_type.strip().lower().lstrip(".")
+
+
+def document_path(metadata: Dict[str, Any]) -> str:
+    """Folder and file name of a document or node, which tells same-named files in different folders apart."""
+    return "/".join(filter(None, [normalize_folder(metadata.get("folder")), metadata.get("file_name", "")]))
+
+
+def folder_ancestors(folder: str) -> List[str]:
+    """'a/b/c' -> ['a', 'a/b', 'a/b/c'], so that a folder prefix is a single membership test."""
+    parts = normalize_folder(folder).split("/") if folder else []
+    return ["/".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def _local_folder(document: Document, root: str) -> str:
+    file_path = document.metadata.get("file_path")
+    if not file_path:
+        return ""
+    folder = os.path.relpath(os.path.dirname(os.path.abspath(file_path)), os.path.abspath(root))
+    return "" if folder == "." or folder.startswith("..") else folder
+
+
+def add_scope_metadata(
+    documents: Sequence[Document],
+    folders: Optional[Dict[str, str]] = None,
+    default_folder: str = "",
+    root: Optional[str] = None,
+    ingested_at: Optional[int] = None,
+    source: Optional[str] = None,
+) -> Sequence[Document]:
+    """
+    Add the folder, folder ancestors, file extension and ingestion time to the
+    metadata of every document, and strip the directory from its file name. `folders` maps file names to their folder on
+    the server. Other documents get their directory relative to `root` if it
+    is given, and `default_folder` otherwise. `source` is one of INGEST_SOURCES.
+    """
+    ingested_at = int(time.time()) if ingested_at is None else ingested_at
+    for document in documents:
+        # this llama-index version stores the full path as the file name
+        file_name = os.path.basename(document.metadata.get("file_name", ""))
+        if "file_name" in document.metadata:
+            document.metadata["file_name"] = file_name
+        if folders and file_name in folders:
+            folder = folders[file_name]
+        elif root is not None:
+            folder = _local_folder(document, root)
+        else:
+            folder = default_folder
+        folder = normalize_folder(folder)
+        document.metadata["folder"] = folder
+        if folder:
+            # Pinecone rejects empty lists, root documents simply have no ancestors
+            document.metadata["folders"] = folder_ancestors(folder)
+        document.metadata["file_extension"] = normalize_file_type(os.path.splitext(file_name)[1])
+        document.metadata["ingested_at"] = ingested_at
+        if source is not None:
+            document.metadata["ingest_source"] = source
+        # bookkeeping only, keep it out of the embedded and prompted text
+        for keys in (document.excluded_embed_metadata_keys, document.excluded_llm_metadata_keys):
+            keys.extend(key for key in SCOPE_METADATA_KEYS if key not in keys)
+    return documents
+
+
+class Scope(BaseModel):
+    """Optional restriction of the retrieval to a part of the index."""
+
+    folder: Optional[str] = Field(None, description="Folder prefix, e.g. 'Projects/Alpha'")
+    file_types: Optional[List[str]] = Field(None, description="Extensions or MIME types, e.g. ['pdf', 'docx']")
+    filenames: Optional[List[str]] = Field(None, description="File names without folder")
+    ingested_after: Optional[datetime] = None
+    ingested_before: Optional[datetime] = None
+
+    def to_filter(self) -> Optional[Dict[str, Any]]:
+        """
+        The scope as a metadata filter in Pinecone's query syntax, which the
+        local vector store understands as well. None if nothing is restricted.
+        """
+        clauses: List[Dict[str, Any]] = []
+        folder = normalize_folder(self.folder)
+        if folder:
+            clauses.append({"folders": {"$eq": folder}})
+        if self.file_types:
+            extensions = sorted({normalize_file_type(t) for t in self.file_types if "/" not in t})
+            mime_types = sorted({t.strip().lower() for t in self.file_types if "/" in t})
+            alternatives = []
+            if extensions:
+                alternatives.append({"file_extension": {"$in": extensions}})
+            if mime_types:
+                alternatives.append({"file_type": {"$in": mime_types}})
+            clauses.append(alternatives[0] if len(alternatives) == 1 else {"$or": alternatives})
+        if self.filenames:
+            clauses.append({"file_name": {"$in": sorted(set(self.filenames))}})
+        if self.ingested_after:
+            clauses.append({"ingested_at": {"$gte": int(self.ingested_after.timestamp())}})
+        if self.ingested_before:
+            clauses.append({"ingested_at": {"$lte": int(self.ingested_before.timestamp())}})
+
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
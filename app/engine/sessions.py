@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.settings import Settings
+
+from app.metrics import counter, gauge
+
+logger = logging.getLogger("uvicorn")
+
+CHAT_SESSIONS = gauge("chat_sessions", "Chat sessions kept on the server")
+CHAT_SESSIONS_EVICTED = counter("chat_sessions_evicted_total", "Chat sessions dropped by the session store", ["reason"])
+CHAT_SESSION_SUMMARIES = counter("chat_session_summaries_total", "Rolling summary updates of chat sessions")
+
+SUMMARY_PROMPT = PromptTemplate(
+    "Below is the summary of a conversation so far, followed by newer messages of the same conversation.\n"
+    "Write an updated summary of the whole conversation in at most {max_words} words. Keep the questions "
+    "asked, the facts and names established in the answers and anything the user asked to remember; "
+    "leave out pleasantries.\n\n"
+    "Summary so far:\n{summary}\n\n"
+    "Newer messages:\n{messages}\n\n"
+    "Updated summary:"
+)
+
+
+class ChatSession:
+    """
+    The history of a conversation kept on the server: a rolling summary of
+    the older turns and the most recent messages verbatim. Turns of one
+    session run one at a time, under `lock`.
+    """
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.summary = ""
+        self.messages: List[ChatMessage] = []
+        self.turns = 0
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def chat_history(self) -> List[ChatMessage]:
+        """The history to send with the next message, bounded by the summary and message limits."""
+        if not self.summary:
+            return list(self.messages)
+        summary = ChatMessage(role=MessageRole.SYSTEM, content=f"Summary of the earlier conversation: {self.summary}")
+        return [summary, *self.messages]
+
+
+async def update_summary(session: ChatSession, max_messages: int, max_words: int):
+    """
+    Fold the oldest messages into the summary once there are more than
+    `max_messages`, keeping the newest half. Every message is summarized
+    once, so a turn costs the same however long the conversation is.
+    """
+    if len(session.messages) <= max_messages:
+        return
+    keep = max_messages // 2
+    folded, recent = session.messages[: len(session.messages) - keep], session.messages[len(session.messages) - keep :]
+    messages = "\n".join(f"{message.role.value}: {message.content}" for message in folded)
+    summary = await Settings.llm.apredict(
+        SUMMARY_PROMPT, summary=session.summary or "(none)", messages=messages, max_words=max_words
+    )
+    session.summary = summary.strip()
+    session.messages = recent
+    CHAT_SESSION_SUMMARIES.inc()
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of chat sessions. Sessions unused for `ttl`
+    seconds expire, and the least recently used one is dropped when there are
+    more than `max_sessions`. A turn waits at most `turn_timeout` seconds for
+    the previous turn of its session.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int,
+        ttl: float,
+        max_messages: int = 8,
+        summary_words: int = 200,
+        turn_timeout: float = 60.0,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.summary_words = summary_words
+        self.turn_timeout = turn_timeout
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        return cls(
+            max_sessions=int(os.getenv("CHAT_SESSIONS_MAX", "1000")),
+            ttl=float(os.getenv("CHAT_SESSION_TTL", "3600")),
+            max_messages=int(os.getenv("CHAT_SESSION_MESSAGES", "8")),
+            summary_words=int(os.getenv("CHAT_SESSION_SUMMARY_WORDS", "200")),
+            turn_timeout=float(os.getenv("CHAT_SESSION_TURN_TIMEOUT", "60")),
+        )
+
+    def _expire(self):
+        now = time.monotonic()
+        # the least recently used sessions come first
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            CHAT_SESSIONS_EVICTED.inc(reason="expired")
+        CHAT_SESSIONS.set(len(self._sessions))
+
+    def create(self) -> ChatSession:
+        self._expire()
+        session = ChatSession(uuid.uuid4().hex)
+        self._sessions[session.id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            CHAT_SESSIONS_EVICTED.inc(reason="capacity")
+        CHAT_SESSIONS.set(len(self._sessions))
+        return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        deleted = self._sessions.pop(session_id, None) is not None
+        CHAT_SESSIONS.set(len(self._sessions))
+        return deleted
+
+    async def record_turn(self, session: ChatSession, question: str, answer: str):
+        """Add a finished turn to the session and update its summary if needed."""
+        session.messages.append(ChatMessage(role=MessageRole.USER, content=question))
+        session.messages.append(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+        session.turns += 1
+        session.last_used = time.monotonic()
+        try:
+            await update_summary(session, self.max_messages, self.summary_words)
+        except Exception as e:
+            # the messages stay verbatim and the next turn tries again, up to a point
+            logger.warning(f"Updating the summary of chat session {session.id} failed: {e}")
+            del session.messages[: -2 * self.max_messages]
+
+    async def begin_turn(self, session: ChatSession, question: str) -> "SessionTurn":
+        """
+        Wait for the previous turn of the session to finish and start the next
+        one, raises asyncio.TimeoutError after `turn_timeout` seconds.
+        """
+        await asyncio.wait_for(session.lock.acquire(), timeout=self.turn_timeout)
+        return SessionTurn(self, session, question)
+
+
+class SessionTurn:
+    """A turn holding the lock of its session. Finishing or releasing it more than once is a no-op."""
+
+    def __init__(self, store: SessionStore, session: ChatSession, question: str):
+        self.store = store
+        self.session = session
+        self.question = question
+        self._released = False
+
+    async def finish(self, answer: str):
+        """Record the answer, if there is one, and release the session."""
+        if self._released:
+            return
+        try:
+            if answer:
+                await self.store.record_turn(self.session, self.question, answer)
+        finally:
+            self.release()
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.session.lock.release()
+
+
+chat_sessions = SessionStore.from_env()
@@ -0,0 +1,114 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from app.engine.index import get_vector_store
+
+SOURCE_MODES = ("ids", "snippet", "full")
+
+# metadata a client needs to label a snippet, everything else is left to the sources endpoint
+SNIPPET_METADATA_KEYS = ("file_name", "file_type", "page_label", "folder")
+
+_WORD = re.compile(r"\w{3,}", re.UNICODE)
+
+SNIPPET_CHARS = int(os.getenv("SOURCE_SNIPPET_CHARS", "300"))
+
+
+def default_source_mode() -> str:
+    mode = os.getenv("SOURCE_PAYLOAD_MODE", "full")
+    if mode not in SOURCE_MODES:
+        raise ValueError(f"Unsupported SOURCE_PAYLOAD_MODE {mode!r}, use one of {SOURCE_MODES}")
+    return mode
+
+
+def query_terms(query: str) -> List[str]:
+    return sorted({word.lower() for word in _WORD.findall(query)}, key=len, reverse=True)
+
+
+def highlight_offsets(text: str, terms: List[str]) -> List[Tuple[int, int]]:
+    """Sorted, non-overlapping (start, end) offsets of the query terms in `text`."""
+    if not terms:
+        return []
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    return [match.span() for match in pattern.finditer(text)]
+
+
+def snippet(text: str, terms: List[str], max_chars: int) -> Tuple[str, int, List[Tuple[int, int]]]:
+    """
+    A window of at most `max_chars` characters of `text` around the first
+    query term, its offset in `text` and the highlights relative to the window.
+    """
+    highlights = highlight_offsets(text, terms)
+    if len(text) <= max_chars:
+        return text, 0, highlights
+    start = 0
+    if highlights:
+        # a bit of context before the first match
+        start = max(0, min(highlights[0][0] - max_chars // 4, len(text) - max_chars))
+        whitespace = text.rfind(" ", 0, start)
+        if whitespace != -1 and start - whitespace < 20:
+            start = whitespace + 1
+    end = start + max_chars
+    window = [(s - start, e - start) for s, e in highlights if s >= start and e <= end]
+    return text[start:end], start, window
+
+
+class SourceCache:
+    """
+    Bounded LRU cache of the nodes recently sent as sources, for lazy
+    full-text fetches. Keyed by namespace and node id, a node is only served
+    to requests for the namespace it was retrieved from.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._nodes: "OrderedDict[Tuple[str, str], BaseNode]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, namespace: str, node: BaseNode):
+        key = (namespace, node.node_id)
+        with self._lock:
+            self._nodes[key] = node
+            self._nodes.move_to_end(key)
+            while len(self._nodes) > self.max_size:
+                self._nodes.popitem(last=False)
+
+    def get(self, namespace: str, node_id: str) -> Optional[BaseNode]:
+        key = (namespace, node_id)
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._nodes.move_to_end(key)
+            return node
+
+
+source_cache = SourceCache(int(os.getenv("SOURCE_CACHE_SIZE", "2048")))
+
+
+def fetch_node(node_id: str, namespace: str = "") -> Optional[BaseNode]:
+    """Fetch a node by id from the vector store, None if it does not exist."""
+    store = get_vector_store(namespace)
+    if hasattr(store, "get_nodes"):
+        nodes = store.get_nodes([node_id])
+        return nodes[0] if nodes else None
+
+    # Pinecone keeps the serialized node in the vector metadata
+    response = store.client.fetch(ids=[node_id], namespace=namespace or None)
+    vector = response.vectors.get(node_id) if response.vectors else None
+    if vector is None or not vector.metadata:
+        return None
+    return metadata_dict_to_node(vector.metadata)
+
+
+def get_source_node(node_id: str, namespace: str = "") -> Optional[BaseNode]:
+    node = source_cache.get(namespace, node_id)
+    if node is None:
+        node = fetch_node(node_id, namespace)
+        if node is not None:
+            source_cache.put(namespace, node)
+    return node
@@ -0,0 +1,252 @@
+"""
+Garbage collection of orphaned and superseded vectors.
+
+Reconciles every namespace of the vector store against the `ingestedDocs`
+ledger in Firestore and deletes the vectors of
+
+- orphaned files, which have no ledger record in the vector's namespace (or,
+  with --nextcloud, were ingested from Nextcloud and no longer exist there), and
+- superseded ingestions, whose ingest id differs from the one the ledger
+  records for their file, i.e. the chunks left behind by a re-upload.
+
+    python -m app.engine.vector_gc --dry-run
+    python -m app.engine.vector_gc --max-deletes-per-second 50 --interval 86400
+
+Deletes are sent in batches at a bounded rate. Vectors without a file name
+are never touched, and neither are vectors ingested less than --grace-seconds
+ago, so that a file being ingested right now is not mistaken for an orphan.
+With DEDUP_MODE=skip, the chunks that were skipped as near-duplicates of
+an orphaned file's chunks are embedded and upserted, their text would not be
+searchable otherwise. The local vector store is compacted after a run. With VECTOR_STORE=quantized
+the job must run while the server is stopped, the server keeps the store in
+memory.
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+import urllib.parse
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from app.engine.dedup import dedup_mode, release_files
+from app.engine.index import get_vector_store, list_namespaces
+from app.engine.ingestion import embed_nodes, upsert_nodes
+from app.engine.ledger import INGEST_ID_KEY, load_ledger
+from app.engine.scope import document_path, normalize_folder
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+class DeleteThrottle:
+    """Spaces out delete batches so that at most `rate` vectors are deleted per second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._started = time.monotonic()
+        self._deleted = 0
+
+    def wait(self, count: int):
+        if self.rate > 0:
+            delay = self._started + self._deleted / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self._deleted += count
+
+
+def iter_vectors(store, namespace: str, batch_size: int) -> Iterator[List[Tuple[str, Dict]]]:
+    """Batches of (vector id, metadata) of every vector in the namespace."""
+    if hasattr(store, "node_metadata"):
+        items = store.node_metadata()
+        for start in range(0, len(items), batch_size):
+            yield items[start : start + batch_size]
+        return
+
+    # listing ids is only supported by Pinecone serverless indexes
+    for ids in store.client.list(namespace=namespace or None, limit=batch_size):
+        response = store.client.fetch(ids=ids, namespace=namespace or None)
+        yield [(vector_id, vector.metadata or {}) for vector_id, vector in response.vectors.items()]
+
+
+def delete_vectors(store, namespace: str, ids: List[str]):
+    if hasattr(store, "delete_nodes"):
+        store.delete_nodes(ids)
+    else:
+        store.client.delete(ids=ids, namespace=namespace or None)
+
+
+class NextcloudManifest:
+    """The files on Nextcloud, by folder and file name."""
+
+    def __init__(self, paths: Set[str]):
+        self.paths = paths
+
+    def contains(self, metadata: Dict) -> bool:
+        return document_path(metadata) in self.paths
+
+
+async def load_nextcloud_manifest(root: str = "") -> NextcloudManifest:
+    from app.webdav import close_webdav_lister, get_webdav_lister
+
+    lister = get_webdav_lister()
+    try:
+        return await _walk(lister, normalize_folder(root))
+    finally:
+        await close_webdav_lister()
+
+
+async def _walk(lister, root: str) -> NextcloudManifest:
+    base_path = urllib.parse.urlparse(lister.base_url).path
+    paths: Set[str] = set()
+    directories = [root]
+    while directories:
+        listings = await asyncio.gather(*[lister.list(directory + "/" if directory else "") for directory in directories])
+        next_directories = []
+        for directory, items in zip(directories, listings):
+            for item in items:
+                path = normalize_folder(urllib.parse.unquote(item["href"] or "")[len(base_path) :])
+                if path == directory:
+                    continue
+                if item["type"] == "directory":
+                    next_directories.append(path)
+                else:
+                    paths.add(path)
+        directories = next_directories
+    return NextcloudManifest(paths)
+
+
+def classify(
+    metadata: Dict,
+    namespace: str,
+    ledger: Dict[Tuple[str, str], Optional[str]],
+    manifest: Optional[NextcloudManifest],
+    ingested_before: int,
+) -> Optional[str]:
+    """'orphaned', 'superseded' or None if the vector is kept."""
+    file_name = metadata.get("file_name")
+    if not file_name or metadata.get("ingested_at", 0) > ingested_before:
+        return None
+    key = (namespace, document_path(metadata))
+    if key not in ledger:
+        return "orphaned"
+    # uploads and local files have no path on Nextcloud, neither have vectors from before sources were recorded
+    if manifest is not None and metadata.get("ingest_source") == "nextcloud" and not manifest.contains(metadata):
+        return "orphaned"
+    current = ledger[key]
+    # records written before ingest ids were tracked can't tell ingestions apart
+    if current is not None and metadata.get(INGEST_ID_KEY) != current:
+        return "superseded"
+    return None
+
+
+def collect_namespace(
+    namespace: str,
+    ledger: Dict[Tuple[str, str], Optional[str]],
+    manifest: Optional[NextcloudManifest],
+    throttle: DeleteThrottle,
+    batch_size: int = 100,
+    grace_seconds: int = 3600,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    store = get_vector_store(namespace)
+    ingested_before = int(time.time()) - grace_seconds
+    report = {"scanned": 0, "orphaned": 0, "superseded": 0, "deleted": 0, "restored": 0, "compacted": 0}
+    doomed: List[str] = []
+    orphaned_files: Set[Tuple[str, str]] = set()
+    # classify everything first, deleting while listing could skip pages
+    for batch in iter_vectors(store, namespace, batch_size):
+        report["scanned"] += len(batch)
+        for vector_id, metadata in batch:
+            verdict = classify(metadata, namespace, ledger, manifest, ingested_before)
+            if verdict is not None:
+                report[verdict] += 1
+                doomed.append(vector_id)
+            if verdict == "orphaned":
+                orphaned_files.add((normalize_folder(metadata.get("folder")), metadata["file_name"]))
+
+    if not dry_run:
+        for start in range(0, len(doomed), batch_size):
+            ids = doomed[start : start + batch_size]
+            throttle.wait(len(ids))
+            delete_vectors(store, namespace, ids)
+            report["deleted"] += len(ids)
+        # a superseded file was ingested again, which already indexed the near-duplicates of its old chunks
+        restored = release_files(namespace, sorted(orphaned_files))
+        for start in range(0, len(restored), batch_size):
+            upsert_nodes(store, embed_nodes(restored[start : start + batch_size]))
+            report["restored"] += len(restored[start : start + batch_size])
+        if hasattr(store, "compact"):
+            report["compacted"] = store.compact()
+    return report
+
+
+def collect(
+    namespaces: Optional[List[str]] = None,
+    use_nextcloud: bool = False,
+    max_deletes_per_second: float = 100.0,
+    batch_size: int = 100,
+    grace_seconds: int = 3600,
+    dry_run: bool = False,
+) -> Dict[str, Dict[str, int]]:
+    """Run one collection over `namespaces` (all of them by default) and return a report per namespace."""
+    ledger = load_ledger()
+    if not ledger:
+        # an unreachable or empty ledger would make every vector look orphaned
+        raise RuntimeError("The ingestedDocs ledger is empty, refusing to collect")
+    manifest = asyncio.run(load_nextcloud_manifest()) if use_nextcloud else None
+    if namespaces is None:
+        namespaces = sorted(set(list_namespaces()) | {namespace for namespace, _ in ledger})
+
+    throttle = DeleteThrottle(max_deletes_per_second)
+    reports = {}
+    for namespace in namespaces:
+        report = collect_namespace(namespace, ledger, manifest, throttle, batch_size, grace_seconds, dry_run)
+        logger.info(f"Namespace {namespace or 'default'}: {report}")
+        reports[namespace] = report
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--namespace", action="append", dest="namespaces", help="Namespace to collect, repeatable; all by default")
+    parser.add_argument("--nextcloud", action="store_true", help="Also treat files from Nextcloud that are missing there as orphaned")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be deleted")
+    parser.add_argument("--max-deletes-per-second", type=float, default=100.0)
+    parser.add_argument("--batch-size", type=int, default=100, help="Vectors per list, fetch and delete request")
+    parser.add_argument("--grace-seconds", type=int, default=3600, help="Never delete vectors ingested more recently")
+    parser.add_argument("--interval", type=float, help="Run every INTERVAL seconds instead of once")
+    args = parser.parse_args()
+    if dedup_mode() != "off":
+        from app.settings import init_settings
+
+        # the embedding model, for the near-duplicates of deleted chunks
+        init_settings()
+    while True:
+        try:
+            reports = collect(
+                args.namespaces,
+                use_nextcloud=args.nextcloud,
+                max_deletes_per_second=args.max_deletes_per_second,
+                batch_size=args.batch_size,
+                grace_seconds=args.grace_seconds,
+                dry_run=args.dry_run,
+            )
+            reclaimed = sum(report["deleted"] for report in reports.values())
+            print(json.dumps({"reclaimed": reclaimed, "dry_run": args.dry_run, "namespaces": reports}, indent=2))
+        except Exception as e:
+            if args.interval is None:
+                raise
+            logger.error(f"Vector garbage collection failed: {e}", exc_info=True)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
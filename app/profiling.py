@@ -0,0 +1,221 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+logger = logging.getLogger("uvicorn")
+
+Frame = Tuple[str, str, int]
+
+# innermost frames of threads that are blocked waiting, e.g. idle threadpool workers
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "concurrent/futures/thread.py")
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of the event loop thread, and of any other thread
+    that is not idle, every `interval` seconds from a background thread.
+
+    Stacks are sampled per thread, not per request: the event loop runs the
+    coroutines of every request and the threadpool workers serve them all, so
+    a profile also holds the samples of the requests served concurrently.
+    """
+
+    def __init__(self, loop_thread_id: int, interval: float, max_duration: float):
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.max_duration = max_duration
+        self.samples: Dict[str, Counter] = {}
+        self.start_time = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.start_time
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if time.perf_counter() - self.start_time > self.max_duration:
+                break
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id != self.loop_thread_id and frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                name = "event-loop" if thread_id == self.loop_thread_id else names.get(thread_id, str(thread_id))
+                self.samples.setdefault(name, Counter())[tuple(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """Collapsed stacks, the input format of flamegraph.pl and inferno."""
+        lines = []
+        for thread, stacks in self.samples.items():
+            for stack, count in stacks.items():
+                frames = ";".join(f"{name} ({os.path.basename(file)}:{line})" for name, file, line in stack)
+                lines.append(f"{thread};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str) -> Dict:
+        frames: List[Dict] = []
+        frame_index: Dict[Frame, int] = {}
+        profiles = []
+        for thread, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.items():
+                indices = []
+                for frame in stack:
+                    if frame not in frame_index:
+                        frame_index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                    indices.append(frame_index[frame])
+                samples.append(indices)
+                weights.append(count * self.interval)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": self.duration,
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "ragbacker",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in, per-request sampling profiler.
+
+    A request is profiled when it carries `X-Profile: speedscope|folded` (or the
+    `profile` query parameter) together with an `X-Profile-Token` header that
+    matches `PROFILING_TOKEN`. Profiling is disabled when no token is configured.
+    The profile spans the whole response, including streamed bodies, and is
+    written to `PROFILING_DIR`; the file name is returned in `X-Profile-File`.
+
+    Only one request is profiled at a time and at most
+    `PROFILING_MAX_PER_MINUTE` profiles are taken; other requests are served
+    without profiling. The profile includes whatever else the process ran
+    meanwhile, see `SamplingProfiler`; profile on an otherwise idle instance.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.token = os.getenv("PROFILING_TOKEN")
+        self.directory = os.getenv("PROFILING_DIR", "profiles")
+        # never sample faster than once per millisecond
+        self.interval = max(float(os.getenv("PROFILING_INTERVAL_MS", "5")), 1.0) / 1000
+        self.max_duration = float(os.getenv("PROFILING_MAX_SECONDS", "120"))
+        self.max_per_minute = int(os.getenv("PROFILING_MAX_PER_MINUTE", "6"))
+        self.path_prefixes = tuple(os.getenv("PROFILING_PATHS", "/api/chat,/api/ingest").split(","))
+        self._busy = threading.Lock()
+        self._recent: Deque[float] = deque()
+
+    def _requested_format(self, scope) -> Optional[str]:
+        if not self.token or scope["type"] != "http":
+            return None
+        if not scope["path"].startswith(self.path_prefixes):
+            return None
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        requested = headers.get("x-profile")
+        if requested is None:
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            requested = query.get("profile", [None])[0]
+        if not requested:
+            return None
+        if not hmac.compare_digest(headers.get("x-profile-token", ""), self.token):
+            logger.warning(f"Rejected profiling request for {scope['path']}: invalid token")
+            return None
+        return "folded" if requested == "folded" else "speedscope"
+
+    def _acquire(self) -> bool:
+        if not self._busy.acquire(blocking=False):
+            return False
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+        if len(self._recent) >= self.max_per_minute:
+            self._busy.release()
+            return False
+        self._recent.append(now)
+        return True
+
+    async def __call__(self, scope, receive, send):
+        output_format = self._requested_format(scope)
+        if output_format is None or not self._acquire():
+            await self.app(scope, receive, send)
+            return
+
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-")
+        extension = "folded" if output_format == "folded" else "speedscope.json"
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method'].lower()}-{slug}-{uuid.uuid4().hex[:8]}.{extension}"
+        profiler = SamplingProfiler(threading.get_ident(), self.interval, self.max_duration)
+        stopped = False
+
+        def write():
+            try:
+                profiler.stop()
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, filename)
+                with open(path, "w") as f:
+                    if output_format == "folded":
+                        f.write(profiler.folded())
+                    else:
+                        json.dump(profiler.speedscope(f"{scope['method']} {scope['path']}"), f)
+                logger.info(f"Wrote request profile to {path} ({profiler.duration:.2f}s)")
+            finally:
+                self._busy.release()
+
+        async def finish():
+            nonlocal stopped
+            if stopped:
+                return
+            stopped = True
+            # off the event loop; the thread finishes and releases the profiler even if this is cancelled
+            await asyncio.to_thread(write)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-file", filename.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                await finish()
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            await finish()
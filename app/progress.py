@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.schema import BaseNode
+
+# the stages reported per file; "finished" ends the stream of a job
+PROGRESS_STAGES = ("downloaded", "parsed", "chunked", "embedded", "upserted", "failed", "finished")
+
+
+class ProgressBroker:
+    """
+    Fans ingestion progress events out to the subscribers of a job.
+
+    Events are published from worker threads and delivered to asyncio queues
+    on the subscribers' event loops. Publishing to a job nobody subscribed to
+    is a dictionary lookup, so reporting costs nothing while nobody listens.
+    A subscriber that falls more than `max_queue` events behind loses events.
+
+    The jobs being reported are known, and the `finished` events of the last
+    `history` jobs are kept whether anybody listens or not, for the
+    subscribers that come late. All of it is in process memory, a subscriber
+    only sees the ingestions of its own worker; `app.single_worker` makes sure
+    there is just one.
+    """
+
+    def __init__(self, max_queue: int = 1000, history: int = 1000):
+        self.max_queue = max_queue
+        self.history = history
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._running: Counter = Counter()
+        self._finished: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def active(self, key: str) -> bool:
+        return key in self._subscribers
+
+    def start(self, key: str):
+        with self._lock:
+            self._running[key] += 1
+            self._finished.pop(key, None)
+
+    def finish(self, key: str, event: Dict):
+        """Keep the `finished` event of a job and publish it."""
+        with self._lock:
+            self._running[key] -= 1
+            if self._running[key] <= 0:
+                del self._running[key]
+            self._finished[key] = event
+            self._finished.move_to_end(key)
+            while len(self._finished) > self.history:
+                self._finished.popitem(last=False)
+        self.publish(key, event)
+
+    def known(self, key: str) -> bool:
+        """Whether a job is being reported under `key` or has finished."""
+        with self._lock:
+            return key in self._running or key in self._finished
+
+    def finished(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            return self._finished.get(key)
+
+    def subscribe(self, key: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(key, []).append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, key: str, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = [subscriber for subscriber in self._subscribers.get(key, []) if subscriber[1] is not queue]
+            if subscribers:
+                self._subscribers[key] = subscribers
+            else:
+                self._subscribers.pop(key, None)
+
+    def publish(self, key: str, event: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, event)
+            except RuntimeError:
+                # the subscriber's loop is closed, it is gone
+                self.unsubscribe(key, queue)
+
+
+def _offer(queue: asyncio.Queue, event: Dict):
+    if not queue.full():
+        queue.put_nowait(event)
+
+
+class ProgressReporter:
+    """
+    Publishes the progress of one job, only while somebody is subscribed to
+    it; the `finished` event is always kept by the broker.
+    """
+
+    def __init__(self, broker: ProgressBroker, key: str):
+        self.broker = broker
+        self.key = key
+        broker.start(key)
+
+    def emit(self, stage: str, file_name: Optional[str] = None, **fields):
+        if stage == "finished":
+            self.broker.finish(self.key, {"stage": stage, "file": file_name, **fields, "time": time.time()})
+            return
+        if not self.broker.active(self.key):
+            return
+        self.broker.publish(self.key, {"stage": stage, "file": file_name, **fields, "time": time.time()})
+
+    def emit_nodes(self, stage: str, nodes: Sequence[BaseNode]):
+        """One event per file with the number of its nodes that reached `stage`."""
+        if not self.broker.active(self.key):
+            return
+        for file_name, count in Counter(node.metadata.get("file_name") for node in nodes).items():
+            self.emit(stage, file_name, nodes=count)
+
+
+progress_broker = ProgressBroker()
+
+current_progress: ContextVar[Optional[ProgressReporter]] = ContextVar("current_progress", default=None)
+
+
+def report(stage: str, file_name: Optional[str] = None, **fields):
+    """Report a stage of the ingestion running in this context, if it is being followed."""
+    reporter = current_progress.get()
+    if reporter is not None:
+        reporter.emit(stage, file_name, **fields)
+
+
+def report_nodes(stage: str, nodes: Sequence[BaseNode]):
+    reporter = current_progress.get()
+    if reporter is not None:
+        reporter.emit_nodes(stage, nodes)
@@ -0,0 +1,42 @@
+import fcntl
+import logging
+import os
+import tempfile
+from typing import IO, Optional
+
+logger = logging.getLogger("uvicorn")
+
+_lock_file: Optional[IO] = None
+
+
+def lock_path() -> str:
+    # one lock per port, separate instances on the same host don't block each other
+    default = os.path.join(tempfile.gettempdir(), f"ragbacker-{os.getenv('APP_PORT', '8000')}.lock")
+    return os.getenv("WORKER_LOCK_FILE", default)
+
+
+def acquire_worker_lock():
+    """
+    Make sure this is the only worker process of the app. The ingest job
+    queue, the progress of ingestions and the chat sessions are kept in
+    process memory, a second worker would answer their ids with 404. The
+    lock is released when the process exits.
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return
+    path = lock_path()
+    lock_file = open(path, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(
+            f"Another worker of the app holds {path}. Jobs, ingestion progress and chat sessions "
+            f"are kept in process memory, run a single worker (gunicorn -w 1)"
+        )
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    _lock_file = lock_file
+    logger.info(f"Running as the single worker, lock {path}")
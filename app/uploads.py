@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, status
+
+from app.engine.loaders.memory import new_spool, spilled
+from app.metrics import counter, gauge
+from app.progress import ProgressReporter, current_progress, progress_broker
+
+logger = logging.getLogger("uvicorn")
+
+INGEST_JOBS_QUEUED = gauge("ingest_jobs_queued", "Ingestion jobs waiting for a worker")
+INGEST_JOBS = counter("ingest_jobs_total", "Finished ingestion jobs", ["status"])
+
+# the file types parsed with LlamaParse
+SUPPORTED_FILE_TYPES = [".pdf", ".doc", ".docx", ".pptx", ".txt", ".rtf", ".pages", ".key", ".epub"]
+# plus those the default readers handle well enough
+DEFAULT_ALLOWED_EXTENSIONS = SUPPORTED_FILE_TYPES + [".md", ".csv", ".html"]
+
+# bytes read from the request per write to the staging file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def max_upload_bytes() -> int:
+    return int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+
+
+def max_upload_files() -> int:
+    return int(os.getenv("UPLOAD_MAX_FILES", "50"))
+
+
+def allowed_extensions() -> List[str]:
+    configured = os.getenv("UPLOAD_ALLOWED_EXTENSIONS")
+    if not configured:
+        return DEFAULT_ALLOWED_EXTENSIONS
+    return ["." + extension.strip().lower().lstrip(".") for extension in configured.split(",") if extension.strip()]
+
+
+def staging_dir() -> str:
+    return os.getenv("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "ragbacker-uploads"))
+
+
+class StagedUpload:
+    """
+    An uploaded file with its size and SHA-256, either in its own staging
+    directory (`path`) or in a memory buffer that spills to disk when it grows
+    large (`buffer`).
+    """
+
+    def __init__(
+        self, filename: str, path: Optional[str], size: int, sha256: str, buffer: Optional[BinaryIO] = None
+    ):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.buffer = buffer
+
+    @property
+    def directory(self) -> Optional[str]:
+        return os.path.dirname(self.path) if self.path else None
+
+    def cleanup(self):
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.path:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def check_upload(filename: Optional[str], content_length: Optional[int] = None) -> str:
+    """Reject an upload by its name and announced size before reading it; returns the safe file name."""
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The upload has no file name")
+    extension = os.path.splitext(name)[1].lower()
+    if extension not in allowed_extensions():
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported file type {extension or '(none)'!r}, use one of {allowed_extensions()}",
+        )
+    if content_length is not None and content_length > max_upload_bytes():
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"The upload is larger than {max_upload_bytes()} bytes",
+        )
+    return name
+
+
+async def _write_chunks(f: BinaryIO, chunks: AsyncIterator[bytes], digest, in_memory: bool) -> int:
+    size = 0
+    limit = max_upload_bytes()
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"The upload is larger than {limit} bytes",
+            )
+        digest.update(chunk)
+        if in_memory and not spilled(f):
+            f.write(chunk)
+        else:
+            # disk writes block, keep them off the event loop
+            await asyncio.to_thread(f.write, chunk)
+    return size
+
+
+async def stage_upload(filename: str, chunks: AsyncIterator[bytes], in_memory: bool = False) -> StagedUpload:
+    """
+    Stream `chunks` into a new staging directory, or with `in_memory` into a
+    buffer that only spills to disk above INGEST_SPOOL_BYTES, hashing them on
+    the way. Aborts with 413 as soon as the size limit is exceeded.
+    """
+    name = check_upload(filename)
+    digest = hashlib.sha256()
+    if in_memory:
+        buffer = new_spool()
+        try:
+            size = await _write_chunks(buffer, chunks, digest, in_memory=True)
+        except BaseException:
+            buffer.close()
+            raise
+        return StagedUpload(name, None, size, digest.hexdigest(), buffer=buffer)
+
+    os.makedirs(staging_dir(), exist_ok=True)
+    directory = tempfile.mkdtemp(dir=staging_dir())
+    path = os.path.join(directory, name)
+    try:
+        with open(path, "wb") as f:
+            size = await _write_chunks(f, chunks, digest, in_memory=False)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return StagedUpload(name, path, size, digest.hexdigest())
+
+
+class Job:
+    def __init__(self, job_id: str, description: Dict):
+        self.id = job_id
+        self.description = description
+        self.status = "queued"
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            **self.description,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    Runs blocking ingestion work in the background, `workers` jobs at a time.
+
+    Jobs wait in a bounded queue; when it is full, `submit` rejects new work
+    with 503. The status of the last `history` jobs can be looked up by id.
+    Workers are started on the first submit, on the running event loop.
+    """
+
+    def __init__(self, workers: int, max_queue: int, history: int = 1000):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.history = history
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls, workers: int, max_queue: int) -> "JobQueue":
+        return cls(
+            workers=int(os.getenv("INGEST_WORKERS", workers)),
+            max_queue=int(os.getenv("INGEST_JOB_QUEUE", max_queue)),
+        )
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def submit(self, work: Callable[[], Dict], cleanup: Optional[Callable[[], None]] = None, **description) -> Job:
+        """Queue `work` to run in a worker thread; `cleanup` runs after it in any case."""
+        self._start()
+        if self._queue.full():
+            if cleanup is not None:
+                cleanup()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many queued ingestion jobs, please retry later",
+                headers={"Retry-After": "30"},
+            )
+        job = Job(uuid.uuid4().hex, description)
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.history:
+            self._jobs.popitem(last=False)
+        self._queue.put_nowait((job, work, cleanup))
+        INGEST_JOBS_QUEUED.set(self._queue.qsize())
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _work(self):
+        while True:
+            job, work, cleanup = await self._queue.get()
+            INGEST_JOBS_QUEUED.set(self._queue.qsize())
+            job.status = "processing"
+            # the worker thread inherits the reporter with the context
+            reporter = ProgressReporter(progress_broker, job.id)
+            current_progress.set(reporter)
+            try:
+                job.result = await asyncio.to_thread(self._run, work, cleanup)
+                job.status = "done"
+            except Exception as e:
+                logger.error(f"Ingestion job {job.id} failed: {e}", exc_info=True)
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                INGEST_JOBS.inc(status=job.status)
+                reporter.emit("finished", status=job.status, result=job.result, error=job.error)
+                self._queue.task_done()
+
+    @staticmethod
+    def _run(work: Callable[[], Dict], cleanup: Optional[Callable[[], None]]) -> Dict:
+        # cleans up in the worker thread, a cancelled task must not pull files from under it
+        try:
+            return work()
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+
+ingest_jobs = JobQueue.from_env(workers=2, max_queue=100)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.metrics import gauge
+
+logger = logging.getLogger("uvicorn")
+
+WARMUP_MODES = ("on", "off")
+
+APP_READY = gauge("app_ready", "1 once the startup warm-up has finished and the app takes traffic")
+WARMUP_STEP_SECONDS = gauge(
+    "app_warmup_step_seconds", "Duration of the steps of the startup warm-up", ["step", "outcome"]
+)
+
+
+def warmup_mode() -> str:
+    mode = os.getenv("WARMUP", "on")
+    if mode not in WARMUP_MODES:
+        raise ValueError(f"Unsupported WARMUP {mode!r}, use one of {WARMUP_MODES}")
+    return mode
+
+
+def _import_modules():
+    # the first import of these takes seconds, a chat request shouldn't pay for it
+    import tiktoken  # noqa: F401
+    from llama_index.core.chat_engine import CondensePlusContextChatEngine  # noqa: F401
+    from llama_index.core.node_parser import SentenceSplitter  # noqa: F401
+
+    if os.getenv("VECTOR_STORE", "pinecone") == "pinecone":
+        from llama_index.vector_stores.pinecone import PineconeVectorStore  # noqa: F401
+
+
+def _load_tokenizers():
+    from llama_index.core.utils import get_tokenizer
+
+    from app.engine.postprocessors import get_token_counter
+
+    get_tokenizer()("warm-up")
+    get_token_counter()("warm-up")
+
+
+def _build_index():
+    from app.engine.index import get_index
+
+    index = get_index()
+    if os.getenv("VECTOR_STORE", "pinecone") == "pinecone":
+        # opens the connection pool of the Pinecone client
+        index.vector_store.client.describe_index_stats()
+
+
+async def _open_connections():
+    from llama_index.core.settings import Settings
+
+    from app.webdav import get_webdav_lister
+
+    # llama-index keeps one sync and one async OpenAI client per model, each with its own pool;
+    # retrieving the model is free and does the TLS handshake
+    for model in (Settings.llm, Settings.embed_model):
+        name = getattr(model, "model", None) or getattr(model, "model_name")
+        await asyncio.to_thread(lambda: model._get_client().models.retrieve(name))
+        await model._get_aclient().models.retrieve(name)
+    if os.getenv("WEBDAV_URL"):
+        await get_webdav_lister().list("")
+
+
+async def _build_chat_engine():
+    from app.engine import get_chat_engine
+
+    engine = await asyncio.to_thread(get_chat_engine)
+    query = os.getenv("WARMUP_QUERY")
+    if query:
+        # embeds the query and searches the index, without calling the LLM
+        await engine._retriever.aretrieve(query)
+
+
+class Warmup:
+    """
+    Prepares the app for its first requests: imports the lazily imported
+    modules, loads the tokenizers, builds the index of the default namespace,
+    opens the pooled connections to OpenAI, Pinecone and WebDAV, builds a chat
+    engine and, if WARMUP_QUERY is set, retrieves it. A step that fails is
+    logged and skipped, the request that needs it will fail or warm it up.
+    The app is ready once all steps have run.
+    """
+
+    def __init__(self):
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.steps: Dict[str, Dict] = {}
+        APP_READY.set(0)
+
+    @property
+    def ready(self) -> bool:
+        return self.finished is not None
+
+    def to_dict(self) -> Dict:
+        return {
+            "ready": self.ready,
+            "seconds": round((self.finished or time.time()) - self.started, 3) if self.started else None,
+            "steps": self.steps,
+        }
+
+    async def _step(self, name: str, step: Callable[[], Awaitable]):
+        start = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {e}")
+            outcome, error = "failed", str(e)
+        else:
+            outcome, error = "done", None
+        seconds = time.perf_counter() - start
+        WARMUP_STEP_SECONDS.set(seconds, step=name, outcome=outcome)
+        self.steps[name] = {"status": outcome, "seconds": round(seconds, 3)}
+        if error:
+            self.steps[name]["error"] = error
+
+    async def run(self):
+        self.started = time.time()
+        if warmup_mode() == "on":
+            await self._step("imports", lambda: asyncio.to_thread(_import_modules))
+            await self._step("tokenizers", lambda: asyncio.to_thread(_load_tokenizers))
+            await self._step("index", lambda: asyncio.to_thread(_build_index))
+            await self._step("connections", _open_connections)
+            await self._step("chat_engine", _build_chat_engine)
+            logger.info(f"Warm-up finished in {time.time() - self.started:.1f}s")
+        self.finished = time.time()
+        APP_READY.set(1)
+
+
+warmup = Warmup()
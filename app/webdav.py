@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import time
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from xml.etree import ElementTree
+
+import httpx
+
+from app.clients import http_clients
+
+logger = logging.getLogger("uvicorn")
+
+NAMESPACE = {"d": "DAV:"}
+
+LISTING_PROPFIND_BODY = """<?xml version="1.0"?>
+<d:propfind xmlns:d="DAV:">
+  <d:prop>
+    <d:resourcetype/>
+    <d:getcontenttype/>
+    <d:getcontentlength/>
+    <d:getlastmodified/>
+    <d:getetag/>
+  </d:prop>
+</d:propfind>
+"""
+
+ETAG_PROPFIND_BODY = """<?xml version="1.0"?>
+<d:propfind xmlns:d="DAV:">
+  <d:prop>
+    <d:getetag/>
+  </d:prop>
+</d:propfind>
+"""
+
+
+class WebDAVError(Exception):
+    def __init__(self, url: str, status_code: int):
+        self.url = url
+        self.status_code = status_code
+        super().__init__(f"Error listing contents for {url}: {status_code}")
+
+
+class _Listing:
+    def __init__(self, items: List[Dict], etag: Optional[str], ttl: float):
+        self.items = items
+        self.etag = etag
+        self.expires_at = time.monotonic() + ttl
+
+
+def _prop_text(response: ElementTree.Element, name: str) -> Optional[str]:
+    element = response.find(f".//d:{name}", NAMESPACE)
+    return element.text if element is not None else None
+
+
+def parse_listing(content: bytes) -> List[Dict]:
+    """Parse a Depth: 1 PROPFIND multistatus body into listing items."""
+    tree = ElementTree.fromstring(content)
+    items = []
+    for response in tree.findall(".//d:response", NAMESPACE):
+        resource_type = response.find(".//d:resourcetype", NAMESPACE)
+        is_collection = (
+            resource_type is not None
+            and resource_type.find(".//d:collection", NAMESPACE) is not None
+        )
+        size = _prop_text(response, "getcontentlength")
+        items.append(
+            {
+                "href": _prop_text(response, "href"),
+                "type": "directory" if is_collection else "file",
+                "content_type": _prop_text(response, "getcontenttype"),
+                "size": int(size) if size else None,
+                "modified": _prop_text(response, "getlastmodified"),
+                "etag": _prop_text(response, "getetag"),
+            }
+        )
+    return items
+
+
+class WebDAVLister:
+    """
+    Async directory listing on the shared WebDAV client of `app.clients`.
+
+    Listings are cached per directory for `ttl` seconds. Once expired, the
+    directory ETag is revalidated with a cheap Depth: 0 PROPFIND and the cached
+    listing is reused if it did not change. Expired listings are kept for
+    revalidation for `stale_ttl` more seconds, and at most `max_entries`
+    listings are kept, the least recently used are dropped. Concurrent
+    listings of the same directory share a single upstream request.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        auth: httpx.Auth,
+        ttl: float = 30.0,
+        client: Optional[httpx.AsyncClient] = None,
+        max_entries: int = 1024,
+        stale_ttl: float = 300.0,
+    ):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._auth = auth
+        self._own_client = client
+        # directories are chosen by the clients, the cache must not grow with them
+        self._cache: "OrderedDict[str, _Listing]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        # the shared WebDAV pool of the running loop, unless a client was passed
+        return self._own_client or http_clients.async_client("webdav")
+
+    def _url(self, directory: str) -> str:
+        return self.base_url + urllib.parse.quote(directory)
+
+    def _store(self, directory: str, listing: _Listing):
+        self._cache[directory] = listing
+        self._cache.move_to_end(directory)
+        now = time.monotonic()
+        for key in [key for key, cached in self._cache.items() if cached.expires_at + self.stale_ttl <= now]:
+            del self._cache[key]
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def list(self, directory: str) -> List[Dict]:
+        cached = self._cache.get(directory)
+        if cached is not None and cached.expires_at + self.stale_ttl <= time.monotonic():
+            # too old to revalidate
+            self._cache.pop(directory, None)
+            cached = None
+        if cached is not None and cached.expires_at > time.monotonic():
+            self._cache.move_to_end(directory)
+            return cached.items
+
+        task = self._inflight.get(directory)
+        if task is None:
+            task = asyncio.create_task(self._refresh(directory, cached))
+            self._inflight[directory] = task
+            task.add_done_callback(lambda _: self._inflight.pop(directory, None))
+        # shield so that one cancelled caller doesn't abort the shared request
+        return await asyncio.shield(task)
+
+    async def _refresh(self, directory: str, cached: Optional[_Listing]) -> List[Dict]:
+        url = self._url(directory)
+        if cached is not None and cached.etag:
+            etag = await self._fetch_etag(url)
+            if etag == cached.etag:
+                self._store(directory, _Listing(cached.items, etag, self.ttl))
+                return cached.items
+
+        response = await self._client.request(
+            "PROPFIND",
+            url,
+            headers={"Depth": "1", "Content-Type": "application/xml"},
+            content=LISTING_PROPFIND_BODY,
+            auth=self._auth,
+        )
+        if response.status_code != 207:
+            raise WebDAVError(url, response.status_code)
+        items = parse_listing(response.content)
+        # the first entry of a Depth: 1 listing is the directory itself
+        etag = items[0]["etag"] if items else None
+        self._store(directory, _Listing(items, etag, self.ttl))
+        return items
+
+    async def _fetch_etag(self, url: str) -> Optional[str]:
+        try:
+            response = await self._client.request(
+                "PROPFIND",
+                url,
+                headers={"Depth": "0", "Content-Type": "application/xml"},
+                content=ETAG_PROPFIND_BODY,
+                auth=self._auth,
+            )
+        except httpx.HTTPError as e:
+            logger.warning(f"ETag revalidation failed for {url}: {e}")
+            return None
+        if response.status_code != 207:
+            return None
+        items = parse_listing(response.content)
+        return items[0]["etag"] if items else None
+
+    def invalidate(self, directory: Optional[str] = None):
+        if directory is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(directory, None)
+
+    async def aclose(self):
+        if self._own_client is not None:
+            await self._own_client.aclose()
+        else:
+            await http_clients.aclose("webdav")
+
+
+_lister: Optional[WebDAVLister] = None
+
+
+def get_webdav_lister() -> WebDAVLister:
+    global _lister
+    if _lister is None:
+        login = os.getenv("WEBDAV_LOGIN")
+        _lister = WebDAVLister(
+            base_url=os.getenv("WEBDAV_URL") + "/files/" + login + "/",
+            auth=httpx.BasicAuth(login, os.getenv("WEBDAV_PASSWORD")),
+            ttl=float(os.getenv("WEBDAV_LISTING_TTL", "30")),
+            max_entries=int(os.getenv("WEBDAV_LISTING_CACHE_SIZE", "1024")),
+            stale_ttl=float(os.getenv("WEBDAV_LISTING_STALE_TTL", "300")),
+        )
+    return _lister
+
+
+async def close_webdav_lister():
+    global _lister
+    if _lister is not None:
+        await _lister.aclose()
+        _lister = None
@@ -0,0 +1,196 @@
+"""
+Offline benchmark of the chat path.
+
+Swaps `Settings.llm`, `Settings.embed_model` and the Pinecone index for the
+deterministic fakes in `benchmarks.fakes`, serves the real chat router with
+uvicorn on a local port and drives `/api/chat` and `/api/chat/request` at the
+given concurrency levels:
+
+    python -m benchmarks.chat --concurrency 1 8 32 --requests 64 --output bench/chat.json
+
+Latency and time-to-first-token are measured on the client. CPU time is the
+process CPU time (server and client share the process) divided by the number of
+requests. Results are written as JSON so runs can be compared between commits.
+"""
+
+import argparse
+import asyncio
+import resource
+import time
+import tracemalloc
+from typing import Dict, List
+
+import httpx
+from fastapi import FastAPI
+from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex
+
+import app.engine
+from app.api.routers.chat import chat_router
+from app.api.routers.messaging import MetricsCallbackHandler
+from app.engine.ingestion import chunk_documents, embed_nodes
+from benchmarks.fakes import VOCABULARY, FakeEmbedding, FakeLLM, FakeVectorStore
+from benchmarks.utils import git_revision, start_server, summarize, write_report
+
+QUESTION = "When is the payment due according to the contract?"
+
+
+def build_index(args) -> VectorStoreIndex:
+    documents = []
+    for i in range(args.documents):
+        words = [VOCABULARY[(i * 7 + j * 3) % len(VOCABULARY)] for j in range(args.words_per_document)]
+        documents.append(Document(text=" ".join(words), metadata={"file_name": f"doc_{i}.md"}))
+
+    # embed the corpus without the simulated latency
+    Settings.embed_model = FakeEmbedding(embed_dim=args.embed_dim, latency=0.0)
+    nodes = embed_nodes(chunk_documents(documents))
+    Settings.embed_model = FakeEmbedding(embed_dim=args.embed_dim, latency=args.embed_latency)
+
+    store = FakeVectorStore(latency=args.store_latency)
+    storage_context = StorageContext.from_defaults(vector_store=store)
+    return VectorStoreIndex(nodes, storage_context=storage_context)
+
+
+def build_app(index: VectorStoreIndex) -> FastAPI:
+    # get_chat_engine stays real, only the Pinecone connection is replaced
+    app.engine.get_index = lambda *args, **kwargs: index
+    bench_app = FastAPI()
+    bench_app.include_router(chat_router, prefix="/api/chat")
+    return bench_app
+
+
+def chat_payload(i: int, history: int) -> Dict:
+    messages = []
+    for turn in range(history):
+        messages.append({"role": "user", "content": f"Earlier question {turn} of client {i}"})
+        messages.append({"role": "assistant", "content": "Earlier answer"})
+    messages.append({"role": "user", "content": QUESTION})
+    return {"messages": messages}
+
+
+async def run_request(client: httpx.AsyncClient, path: str, payload: Dict) -> Dict[str, float]:
+    start = time.perf_counter()
+    ttft = None
+    if path == "/api/chat":
+        async with client.stream("POST", path, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith("0:"):
+                    ttft = time.perf_counter() - start
+    else:
+        response = await client.post(path, json=payload)
+        response.raise_for_status()
+    latency = time.perf_counter() - start
+    return {"latency": latency, "ttft": ttft if ttft is not None else latency}
+
+
+async def run_level(base_url: str, path: str, concurrency: int, args) -> Dict:
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+    samples: List[Dict[str, float]] = []
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            try:
+                samples.append(await run_request(client, path, chat_payload(i, args.history)))
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        if args.trace_memory:
+            tracemalloc.start()
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        traced_peak = None
+        if args.trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    cpu_seconds = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    completed = len(samples)
+    result = {
+        "endpoint": path,
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": errors,
+        "throughput_rps": completed / elapsed if elapsed else 0.0,
+        "latency_s": summarize([s["latency"] for s in samples]),
+        "ttft_s": summarize([s["ttft"] for s in samples]),
+        "cpu_s_per_request": cpu_seconds / completed if completed else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": cpu_end.ru_maxrss / 1024,
+    }
+    if traced_peak is not None:
+        result["peak_traced_mb_per_inflight_request"] = traced_peak / 1024 / 1024 / concurrency
+    return result
+
+
+async def run(args) -> Dict:
+    Settings.llm = FakeLLM(
+        latency=args.llm_latency,
+        tokens_per_second=args.tokens_per_second,
+        num_tokens=args.answer_tokens,
+    )
+    Settings.callback_manager.add_handler(MetricsCallbackHandler())
+    server = start_server(build_app(build_index(args)))
+    base_url = f"http://127.0.0.1:{server.config.port}"
+
+    results = []
+    try:
+        for path in args.endpoints:
+            # warm up connection pools and lazy imports before measuring
+            async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+                await run_request(client, path, chat_payload(0, 0))
+            for concurrency in args.concurrency:
+                level = await run_level(base_url, path, concurrency, args)
+                print(
+                    f"{path} c={concurrency}: p50={level['latency_s']['p50']:.3f}s "
+                    f"p99={level['latency_s']['p99']:.3f}s ttft_p50={level['ttft_s']['p50']:.3f}s "
+                    f"{level['throughput_rps']:.1f} req/s"
+                )
+                results.append(level)
+    finally:
+        server.should_exit = True
+
+    return {
+        "benchmark": "chat",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--endpoints", nargs="+", default=["/api/chat", "/api/chat/request"])
+    parser.add_argument("--history", type=int, default=0, help="Previous turns sent with each request")
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--words-per-document", type=int, default=400)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=64)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--store-latency", type=float, default=0.05)
+    parser.add_argument("--trace-memory", action="store_true", help="Track allocations with tracemalloc (slow)")
+    parser.add_argument("--output", default="bench/chat.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    write_report(asyncio.run(run(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Synthetic PDF, DOCX, PPTX and Markdown documents, and a local stand-in for the
+Nextcloud WebDAV server that serves them.
+"""
+
+import os
+import random
+import threading
+import urllib.parse
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from xml.sax.saxutils import escape
+
+from benchmarks.fakes import VOCABULARY
+from benchmarks.utils import free_port
+
+FILE_TYPES = ("pdf", "docx", "pptx", "md")
+
+
+def _paragraphs(rng: random.Random, count: int, words: int) -> List[str]:
+    return [" ".join(rng.choice(VOCABULARY) for _ in range(words)) + "." for _ in range(count)]
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, paragraphs: List[str], paragraphs_per_page: int = 8):
+    """Write a minimal uncompressed PDF with one text object per paragraph."""
+    pages = [
+        paragraphs[i : i + paragraphs_per_page]
+        for i in range(0, len(paragraphs), paragraphs_per_page)
+    ] or [[]]
+    font_id, info_id = 3, 4
+    title = _pdf_escape(os.path.basename(path))
+    objects = {
+        1: "<< /Type /Catalog /Pages 2 0 R >>",
+        font_id: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        info_id: f"<< /Title ({title}) /Author (benchmark) >>",
+    }
+    kids = []
+    next_id = 5
+    for page in pages:
+        lines = ["BT /F1 10 Tf 40 800 Td 12 TL"]
+        lines += [f"({_pdf_escape(paragraph)}) Tj T*" for paragraph in page]
+        lines.append("ET")
+        stream = "\n".join(lines)
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        objects[content_id] = f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream"
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        kids.append(f"{page_id} 0 R")
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    body = b"%PDF-1.4\n"
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(body)
+        body += f"{object_id} 0 obj\n{objects[object_id]}\nendobj\n".encode("latin-1")
+    xref_offset = len(body)
+    size = max(objects) + 1
+    xref = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+    xref += [f"{offsets.get(i, 0):010d} 00000 n \n" for i in range(1, size)]
+    body += "".join(xref).encode("latin-1")
+    body += f"trailer\n<< /Size {size} /Root 1 0 R /Info {info_id} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(body)
+
+
+def write_docx(path: str, paragraphs: List[str]):
+    from docx import Document
+
+    document = Document()
+    document.core_properties.title = os.path.basename(path)
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_pptx(path: str, paragraphs: List[str], paragraphs_per_slide: int = 4):
+    from pptx import Presentation
+
+    presentation = Presentation()
+    layout = presentation.slide_layouts[1]
+    for i in range(0, len(paragraphs), paragraphs_per_slide):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {i // paragraphs_per_slide + 1}"
+        text = "\n".join(paragraphs[i : i + paragraphs_per_slide])
+        slide.placeholders[1].text = text
+        # the local extractor reads the speaker notes
+        slide.notes_slide.notes_text_frame.text = text
+    presentation.save(path)
+
+
+def write_markdown(path: str, paragraphs: List[str]):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {os.path.basename(path)}\n\n")
+        f.write("\n\n".join(paragraphs) + "\n")
+
+
+def generate_corpus(
+    directory: str,
+    files_per_type: int,
+    paragraphs: int = 40,
+    words_per_paragraph: int = 60,
+    file_types=FILE_TYPES,
+    seed: int = 0,
+) -> List[str]:
+    """Write `files_per_type` documents of each type and return their file names."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    writers = {"pdf": write_pdf, "docx": write_docx, "pptx": write_pptx, "md": write_markdown}
+    names = []
+    for file_type in file_types:
+        for i in range(files_per_type):
+            name = f"synthetic_{i:05d}.{file_type}"
+            writers[file_type](os.path.join(directory, name), _paragraphs(rng, paragraphs, words_per_paragraph))
+            names.append(name)
+    return names
+
+
+class _WebDAVHandler(BaseHTTPRequestHandler):
+    root: str = ""
+    prefix: str = ""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _local_path(self):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        if not path.startswith(self.prefix):
+            return None
+        local = os.path.normpath(os.path.join(self.root, path[len(self.prefix) :]))
+        if not local.startswith(os.path.normpath(self.root)):
+            return None
+        return local
+
+    def _response_xml(self, href: str, local: str) -> str:
+        if os.path.isdir(local):
+            props = "<d:resourcetype><d:collection/></d:resourcetype>"
+        else:
+            props = f"<d:resourcetype/><d:getcontentlength>{os.path.getsize(local)}</d:getcontentlength>"
+        stat = os.stat(local)
+        props += f"<d:getlastmodified>{formatdate(stat.st_mtime, usegmt=True)}</d:getlastmodified>"
+        props += f'<d:getetag>"{int(stat.st_mtime_ns)}"</d:getetag>'
+        return (
+            f"<d:response><d:href>{escape(urllib.parse.quote(href))}</d:href>"
+            f"<d:propstat><d:prop>{props}</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+        )
+
+    def do_PROPFIND(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        local = self._local_path()
+        if local is None or not os.path.exists(local):
+            self.send_response(404)
+            self.end_headers()
+            return
+        href = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        responses = [self._response_xml(href, local)]
+        if os.path.isdir(local) and self.headers.get("Depth") == "1":
+            for name in sorted(os.listdir(local)):
+                responses.append(self._response_xml(href.rstrip("/") + "/" + name, os.path.join(local, name)))
+        body = ('<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">' + "".join(responses) + "</d:multistatus>").encode()
+        self.send_response(207)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        local = self._local_path()
+        if local is None or not os.path.isfile(local):
+            self.send_response(404)
+            self.end_headers()
+            return
+        with open(local, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LocalWebDAVServer:
+    """
+    Serves `root` at `http://127.0.0.1:<port>/remote.php/dav/files/<login>/`,
+    the layout the ingestion code expects from Nextcloud.
+    """
+
+    def __init__(self, root: str, login: str = "bench"):
+        self.login = login
+        handler = type(
+            "WebDAVHandler",
+            (_WebDAVHandler,),
+            {"root": root, "prefix": f"/remote.php/dav/files/{login}/"},
+        )
+        self._server = ThreadingHTTPServer(("127.0.0.1", free_port()), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/remote.php/dav"
+
+    def __enter__(self) -> "LocalWebDAVServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,272 @@
+"""
+Deterministic, offline stand-ins for the OpenAI LLM, the OpenAI embeddings,
+the Pinecone vector store, LlamaParse and Firestore. Latencies and token rates
+are configurable so the benchmarks exercise the real request path with
+realistic timing.
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.llms import CustomLLM
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.readers.base import BaseReader
+from llama_index.core.schema import Document
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+
+VOCABULARY = (
+    "the contract states that payment is due within thirty days of invoice "
+    "delivery and both parties agree to the terms described in section four"
+).split()
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class FakeLLM(CustomLLM):
+    """Streams a deterministic answer after `latency` seconds at `tokens_per_second`."""
+
+    latency: float = Field(default=0.3, description="Seconds until the first token.")
+    tokens_per_second: float = Field(default=50.0)
+    num_tokens: int = Field(default=64, description="Tokens per answer.")
+    context_window: int = Field(default=16384)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.num_tokens,
+            is_chat_model=True,
+            model_name="fake",
+        )
+
+    def _tokens(self, prompt: str) -> List[str]:
+        rng = random.Random(_seed(prompt))
+        return [rng.choice(VOCABULARY) + " " for _ in range(self.num_tokens)]
+
+    @property
+    def _token_interval(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.latency + self._token_interval * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens(prompt)))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            time.sleep(self.latency)
+            text = ""
+            for token in self._tokens(prompt):
+                time.sleep(self._token_interval)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.latency + self._token_interval * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens(prompt)))
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        async def gen() -> CompletionResponseAsyncGen:
+            await asyncio.sleep(self.latency)
+            text = ""
+            for token in self._tokens(prompt):
+                await asyncio.sleep(self._token_interval)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = await self.acomplete(self.messages_to_prompt(messages), formatted=True)
+        return ChatResponse(
+            message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text)
+        )
+
+    @llm_chat_callback()
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        completion = await self.astream_complete(self.messages_to_prompt(messages), formatted=True)
+
+        async def gen() -> ChatResponseAsyncGen:
+            async for response in completion:
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text),
+                    delta=response.delta,
+                )
+
+        return gen()
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        completion = self.stream_complete(self.messages_to_prompt(messages), formatted=True)
+
+        def gen() -> ChatResponseGen:
+            for response in completion:
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text),
+                    delta=response.delta,
+                )
+
+        return gen()
+
+
+class FakeEmbedding(BaseEmbedding):
+    """Hash-seeded unit vectors; identical texts always get identical embeddings."""
+
+    embed_dim: int = Field(default=1536)
+    latency: float = Field(default=0.05, description="Seconds per embedding request.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _vector(self, text: str) -> List[float]:
+        rng = random.Random(_seed(text))
+        vector = [rng.gauss(0.0, 1.0) for _ in range(self.embed_dim)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._vector(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self._vector(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._vector(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # one request per batch, like the OpenAI API
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+
+class FakeVectorStore(SimpleVectorStore):
+    """
+    In-memory store that sleeps `latency` seconds per query and
+    `upsert_latency` seconds per upsert. The sleep is blocking on purpose: the
+    Pinecone store has no async query either.
+    """
+
+    def __init__(self, latency: float = 0.05, upsert_latency: float = 0.0, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.upsert_latency = upsert_latency
+
+    def add(self, nodes: List[Any], **kwargs: Any) -> List[str]:
+        time.sleep(self.upsert_latency)
+        return super().add(nodes, **kwargs)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        time.sleep(self.latency)
+        return super().query(query, **kwargs)
+
+
+class FakeParser(BaseReader):
+    """
+    Stand-in for LlamaParse. PDF, DOCX and PPTX go through the local extractors
+    in `app.api.routers.metadata`, plus `latency` seconds per file to account for
+    the parsing round-trip.
+    """
+
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+
+    def load_data(self, file, extra_info: Optional[Dict] = None, **kwargs: Any) -> List[Document]:
+        from app.api.routers.metadata import extract_metadata_and_text
+
+        time.sleep(self.latency)
+        path = str(file)
+        if path.endswith((".pdf", ".docx", ".pptx")):
+            text = extract_metadata_and_text(path)["text"]
+        else:
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                text = f.read()
+        return [Document(text=text, metadata=extra_info or {})]
+
+
+class _FakeDocumentReference:
+    def __init__(self, collection: "_FakeCollection", document_id: str):
+        self._collection = collection
+        self.id = document_id
+
+    def set(self, data: Dict):
+        time.sleep(self._collection.latency)
+        self._collection.documents[self.id] = dict(data)
+
+    def get(self):
+        return self._collection.documents.get(self.id)
+
+    def to_dict(self) -> Optional[Dict]:
+        return self.get()
+
+
+class _FakeCollection:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.documents: Dict[str, Dict] = {}
+
+    def document(self, document_id: str) -> _FakeDocumentReference:
+        return _FakeDocumentReference(self, document_id)
+
+    def add(self, data: Dict):
+        reference = self.document(uuid.uuid4().hex)
+        reference.set(data)
+        return None, reference
+
+    def stream(self):
+        return [self.document(document_id) for document_id in list(self.documents)]
+
+
+class FakeFirestore:
+    """In-memory subset of the Firestore client API used by the ingestion code."""
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.collections: Dict[str, _FakeCollection] = {}
+
+    def collection(self, name: str) -> _FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = _FakeCollection(self.latency)
+        return self.collections[name]
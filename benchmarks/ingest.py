@@ -0,0 +1,207 @@
+"""
+Offline benchmark of the ingestion paths.
+
+Generates a synthetic PDF/DOCX/PPTX/Markdown corpus, serves it from a local
+stand-in WebDAV server and runs `upload_file`, `upload_files` (batches),
+`process_files` and `generate_datasource` against fake LlamaParse, embedding, vector-store and
+Firestore backends:
+
+    python -m benchmarks.ingest --files-per-type 25 --output bench/ingest.json
+
+Reports files/s, chunks/s, peak RSS and the per-stage time from the
+`ingest_stage_seconds` histogram for every scenario.
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import httpx
+from fastapi import FastAPI
+from llama_index.core import Settings
+from llama_index.core.readers import SimpleDirectoryReader
+
+from app.engine.firestore import set_firestore_client
+from app.metrics import INGEST_STAGE_SECONDS
+from benchmarks.corpus import FILE_TYPES, LocalWebDAVServer, generate_corpus
+from benchmarks.fakes import FakeEmbedding, FakeFirestore, FakeParser, FakeVectorStore
+from benchmarks.utils import git_revision, start_server, write_report
+
+SCENARIOS = ("upload_file", "upload_files", "process_files", "generate_datasource")
+
+
+def stage_breakdown(before: Dict, after: Dict) -> Dict[str, Dict[str, float]]:
+    stages = {}
+    for key, (count, total) in after.items():
+        previous_count, previous_total = before.get(key, (0, 0.0))
+        if count > previous_count:
+            stages[key[0]] = {"count": count - previous_count, "seconds": total - previous_total}
+    return stages
+
+
+def measure(name: str, files: int, store: FakeVectorStore, run: Callable[[], None]) -> Dict:
+    chunks_before = len(store._data.embedding_dict)
+    stages_before = INGEST_STAGE_SECONDS.totals()
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    chunks = len(store._data.embedding_dict) - chunks_before
+    result = {
+        "scenario": name,
+        "files": files,
+        "chunks": chunks,
+        "seconds": elapsed,
+        "files_per_s": files / elapsed if elapsed else 0.0,
+        "chunks_per_s": chunks / elapsed if elapsed else 0.0,
+        # ru_maxrss is in kilobytes on Linux and never decreases
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stage_breakdown(stages_before, INGEST_STAGE_SECONDS.totals()),
+    }
+    print(
+        f"{name}: {files} files, {chunks} chunks in {elapsed:.2f}s "
+        f"({result['files_per_s']:.1f} files/s, {result['chunks_per_s']:.1f} chunks/s)"
+    )
+    return result
+
+
+def run(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="ingest-bench-")
+    corpus_dir = os.path.join(workdir, "corpus")
+    names = generate_corpus(
+        corpus_dir,
+        args.files_per_type,
+        paragraphs=args.paragraphs,
+        file_types=args.file_types,
+        seed=args.seed,
+    )
+    print(f"Generated {len(names)} files in {corpus_dir}")
+
+    Settings.embed_model = FakeEmbedding(embed_dim=args.embed_dim, latency=args.embed_latency)
+    Settings.chunk_size = args.chunk_size
+    store = FakeVectorStore(latency=0.0, upsert_latency=args.upsert_latency)
+    firestore = FakeFirestore(latency=args.firestore_latency)
+    set_firestore_client(firestore)
+    parser = FakeParser(latency=args.parse_latency)
+
+    results = []
+    with LocalWebDAVServer(corpus_dir) as webdav:
+        # the ingest router reads its WebDAV configuration at import time
+        os.environ["WEBDAV_URL"] = webdav.url
+        os.environ["WEBDAV_LOGIN"] = webdav.login
+        os.environ["WEBDAV_PASSWORD"] = "bench"
+        os.environ.setdefault("PINECONE_INDEX_NAME", "bench")
+        from app.api.routers import ingest
+        from app.engine import generate
+        from app.engine.loaders import file_sources
+
+        ingest.llama_parse_parser = lambda: parser
+        ingest.get_vector_store = lambda *args, **kwargs: store
+        generate.get_vector_store = lambda *args, **kwargs: store
+
+        bench_app = FastAPI()
+        bench_app.include_router(ingest.ingest_router, prefix="/api/ingest")
+        server = start_server(bench_app)
+        client = httpx.Client(base_url=f"http://127.0.0.1:{server.config.port}", timeout=None)
+
+        def wait_for_job(job_id: str):
+            while True:
+                job = client.get(f"/api/ingest/jobs/{job_id}").json()
+                if job["status"] == "failed":
+                    raise RuntimeError(f"Ingestion job failed: {job['error']}")
+                if job["status"] == "done":
+                    return
+                time.sleep(0.01)
+
+        def upload_files():
+            job_ids = []
+            for name in names:
+                with open(os.path.join(corpus_dir, name), "rb") as f:
+                    response = client.post("/api/ingest/upload-file", files={"file": (name, f)})
+                response.raise_for_status()
+                job_ids.append(response.json()["job_id"])
+            # uploads are processed in the background, the scenario ends when all jobs are done
+            for job_id in job_ids:
+                wait_for_job(job_id)
+
+        def upload_batches():
+            job_ids = []
+            for i in range(0, len(names), args.batch_size):
+                batch = names[i : i + args.batch_size]
+                handles = [open(os.path.join(corpus_dir, name), "rb") for name in batch]
+                try:
+                    files = [("files", (name, f)) for name, f in zip(batch, handles)]
+                    response = client.post("/api/ingest/upload-files", files=files)
+                finally:
+                    for f in handles:
+                        f.close()
+                response.raise_for_status()
+                job_ids.append(response.json()["job_id"])
+            for job_id in job_ids:
+                wait_for_job(job_id)
+
+        def process_files():
+            for i in range(0, len(names), args.batch_size):
+                batch = names[i : i + args.batch_size]
+                client.post("/api/ingest/process-files", json={"filenames": batch}).raise_for_status()
+
+        def generate_datasource():
+            def get_document_sources():
+                extractor = {f".{file_type}": parser for file_type in ("pdf", "docx", "pptx")}
+                return file_sources(SimpleDirectoryReader(corpus_dir, recursive=True, file_extractor=extractor))
+
+            generate.get_document_sources = get_document_sources
+            # a fresh checkpoint, so that every repetition ingests the whole corpus
+            generate.generate_datasource(checkpoint_path=os.path.join(tempfile.mkdtemp(), "checkpoint.sqlite"))
+
+        scenarios = {
+            "upload_file": upload_files,
+            "upload_files": upload_batches,
+            "process_files": process_files,
+            "generate_datasource": generate_datasource,
+        }
+        try:
+            for name in args.scenarios:
+                results.append(measure(name, len(names), store, scenarios[name]))
+        finally:
+            client.close()
+            server.should_exit = True
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "ingest",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files-per-type", type=int, default=10)
+    parser.add_argument("--file-types", nargs="+", default=list(FILE_TYPES), choices=FILE_TYPES)
+    parser.add_argument("--paragraphs", type=int, default=40, help="Paragraphs per document")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--batch-size", type=int, default=20, help="Files per process-files and upload-files request")
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--parse-latency", type=float, default=0.2, help="Seconds per parsed file")
+    parser.add_argument("--embed-latency", type=float, default=0.1, help="Seconds per embedding batch")
+    parser.add_argument("--upsert-latency", type=float, default=0.05, help="Seconds per upsert call")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="Seconds per Firestore write")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench/ingest.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    write_report(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
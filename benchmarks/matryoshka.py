@@ -0,0 +1,118 @@
+"""
+Recall and latency of two-stage Matryoshka retrieval.
+
+For every (search dimension, full dimension) pair, loads a corpus into
+`QuantizedVectorStore` with `search_dim` set, and compares its top-k, before and
+after rescoring the candidates with the full vectors, to an exact
+full-dimension search:
+
+    python -m benchmarks.matryoshka --dims 1536 --search-dims 128 256 512 --output bench/matryoshka.json
+
+By default the corpus is synthetic, with the variance concentrated in the
+leading dimensions like in embeddings trained for truncation. Real embeddings
+of shape (vectors, dim) can be passed as a `.npy` file with `--embeddings`.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from typing import Dict
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from app.engine.quantized import QUANTIZATIONS, QuantizedVectorStore
+from benchmarks.quantization import exact_top_k, measure
+from benchmarks.utils import git_revision, write_report
+
+
+def matryoshka_embeddings(count: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """Clustered unit vectors whose per-dimension scale decays, so prefixes keep most of the signal."""
+    decay = (1 + np.arange(dim, dtype=np.float32) / 32) ** -0.75
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, size=count)] * 0.5
+    vectors += rng.normal(size=(count, dim)).astype(np.float32)
+    vectors *= decay
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def run(args) -> Dict:
+    rng = np.random.default_rng(args.seed)
+    if args.embeddings:
+        source = np.load(args.embeddings).astype(np.float32)
+        dims = [source.shape[1]]
+    else:
+        source = matryoshka_embeddings(args.vectors, max(args.dims), args.clusters, rng)
+        dims = args.dims
+
+    results = []
+    for dim in dims:
+        # truncating and renormalizing is how shortened text-embedding-3 vectors are produced
+        corpus = source[:, :dim] / np.linalg.norm(source[:, :dim], axis=1, keepdims=True)
+        picks = corpus[rng.integers(0, len(corpus), size=args.queries)]
+        queries = picks + rng.normal(size=picks.shape).astype(np.float32) * args.query_noise
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        truth = exact_top_k(corpus, queries, args.top_k)
+
+        for search_dim in [d for d in args.search_dims if d < dim] + [None]:
+            workdir = tempfile.mkdtemp(prefix="matryoshka-bench-")
+            try:
+                store = QuantizedVectorStore(
+                    workdir,
+                    quantization=args.quantization,
+                    rescore_candidates=args.candidates,
+                    search_dim=search_dim,
+                )
+                for start in range(0, len(corpus), args.batch_size):
+                    store.add(
+                        [
+                            TextNode(id_=str(start + i), text="", embedding=vector.tolist())
+                            for i, vector in enumerate(corpus[start : start + args.batch_size])
+                        ]
+                    )
+                for rescore in (False, True):
+                    result = {"dim": dim, "search_dim": search_dim or dim, **measure(store, queries, truth, args.top_k, rescore)}
+                    results.append(result)
+                    print(
+                        f"{result['search_dim']}/{dim}{' + rescoring' if rescore else ''}: "
+                        f"recall@{args.top_k} {result[f'recall_at_{args.top_k}']:.4f}, "
+                        f"p50 {result['latency_s']['p50'] * 1000:.2f}ms, {result['memory_mb']:.1f} MB"
+                    )
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "matryoshka",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embeddings", help="Optional .npy file with real embeddings")
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dims", type=int, nargs="+", default=[1536], help="Full embedding dimensions")
+    parser.add_argument("--search-dims", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-noise", type=float, default=0.05)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=300, help="Candidates rescored with the full vectors")
+    parser.add_argument("--quantization", default="int8", choices=QUANTIZATIONS)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench/matryoshka.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    write_report(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Recall and latency of the quantized vector store against exact float32 search.
+
+Builds a synthetic, clustered embedding corpus, loads it into
+`QuantizedVectorStore` with int8 and float16 codes and compares the top-k of
+every configuration, with and without full-precision rescoring, to a
+brute-force float32 search:
+
+    python -m benchmarks.quantization --vectors 50000 --dim 1536 --output bench/quantization.json
+
+Reports recall@k, p50/p95 query latency and the size of the in-memory search
+matrix for every configuration. The node payloads the store also keeps in
+memory are reported apart as `payload_mb`; the benchmark nodes have no text,
+so for real chunks they are much larger.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from app.engine.quantized import QUANTIZATIONS, QuantizedVectorStore
+from benchmarks.utils import git_revision, summarize, write_report
+
+
+def synthetic_embeddings(count: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """Unit vectors around random cluster centers, with uneven per-dimension spread like real embeddings."""
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    spread = rng.uniform(0.2, 1.5, size=dim).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, size=count)] * 0.5
+    vectors += rng.normal(size=(count, dim)).astype(np.float32) * spread
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, top_k: int) -> List[List[int]]:
+    scores = queries @ corpus.T
+    return [list(np.argsort(-row)[:top_k]) for row in scores]
+
+
+def measure(store: QuantizedVectorStore, queries: np.ndarray, truth: List[List[int]], top_k: int, rescore: bool) -> Dict:
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        ids = store.search_rows(query.tolist(), top_k, rescore=rescore)
+        latencies.append(time.perf_counter() - start)
+        hits += len({int(node_id) for node_id in ids} & set(expected))
+    return {
+        "quantization": store.quantization,
+        "rescore": rescore,
+        "rescore_candidates": store.rescore_candidates if rescore else 0,
+        f"recall_at_{top_k}": hits / (len(queries) * top_k),
+        "latency_s": summarize(latencies),
+        "memory_mb": store.matrix_bytes() / 2**20,
+        "payload_mb": store.payload_bytes() / 2**20,
+    }
+
+
+def run(args) -> Dict:
+    rng = np.random.default_rng(args.seed)
+    corpus = synthetic_embeddings(args.vectors, args.dim, args.clusters, rng)
+    picks = corpus[rng.integers(0, args.vectors, size=args.queries)]
+    queries = picks + rng.normal(size=picks.shape).astype(np.float32) * args.query_noise
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        np.argsort(-(corpus @ query))[: args.top_k]
+        latencies.append(time.perf_counter() - start)
+    truth = exact_top_k(corpus, queries, args.top_k)
+    results = [
+        {
+            "quantization": "float32",
+            "rescore": False,
+            "rescore_candidates": 0,
+            f"recall_at_{args.top_k}": 1.0,
+            "latency_s": summarize(latencies),
+            "memory_mb": corpus.nbytes / 2**20,
+            "payload_mb": 0.0,
+        }
+    ]
+    print(f"float32: exact, p50 {results[0]['latency_s']['p50'] * 1000:.2f}ms, {results[0]['memory_mb']:.1f} MB")
+
+    for quantization in args.quantizations:
+        workdir = tempfile.mkdtemp(prefix="quantization-bench-")
+        try:
+            store = QuantizedVectorStore(workdir, quantization=quantization, rescore_candidates=args.rescore_candidates)
+            for start in range(0, args.vectors, args.batch_size):
+                batch = corpus[start : start + args.batch_size]
+                store.add(
+                    [
+                        TextNode(id_=str(start + i), text="", embedding=vector.tolist())
+                        for i, vector in enumerate(batch)
+                    ]
+                )
+            for rescore in (False, True):
+                result = measure(store, queries, truth, args.top_k, rescore)
+                results.append(result)
+                print(
+                    f"{quantization}{' + rescoring' if rescore else ''}: "
+                    f"recall@{args.top_k} {result[f'recall_at_{args.top_k}']:.4f}, "
+                    f"p50 {result['latency_s']['p50'] * 1000:.2f}ms, {result['memory_mb']:.1f} MB "
+                    f"+ {result['payload_mb']:.1f} MB payloads"
+                )
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "quantization",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-noise", type=float, default=0.05)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rescore-candidates", type=int, default=100)
+    parser.add_argument("--quantizations", nargs="+", default=list(QUANTIZATIONS), choices=QUANTIZATIONS)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench/quantization.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    write_report(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,51 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
 import logging
 import os
 import uvicorn
 import aiostream
-from fastapi import FastAPI, Path
+import httpx
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Path, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from llama_index.core.settings import Settings
 from app.api.routers.chat import chat_router
 from app.api.routers.ingest import ingest_router
+from app.api.routers.messaging import MetricsCallbackHandler
 from app.api.routers.metadata import extract_metadata_and_text
+from app.clients import http_clients, use_shared_openai_clients
+from app.metrics import render_metrics
+from app.profiling import ProfilingMiddleware
 from app.settings import init_settings
-from requests.auth import HTTPBasicAuth
-from xml.etree import ElementTree
-import requests
-import urllib.parse
+from app.single_worker import acquire_worker_lock
+from app.uploads import ingest_jobs
+from app.warmup import warmup
+from app.webdav import WebDAVError, close_webdav_lister, get_webdav_lister
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # jobs, progress and sessions are process-local, refuse to start as a second worker
+    acquire_worker_lock()
+    # in the background, so the app is live while it warms up; /health/ready tells when it is done
+    use_shared_openai_clients(Settings.llm, Settings.embed_model)
+    warmup_task = asyncio.create_task(warmup.run())
+    yield
+    warmup_task.cancel()
+    await ingest_jobs.close()
+    await close_webdav_lister()
+    await http_clients.aclose()
+    http_clients.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -32,18 +56,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
 
 
 init_settings()
+Settings.callback_manager.add_handler(MetricsCallbackHandler())
 
 environment = os.getenv("ENVIRONMENT", "dev")  # Default to 'development' if not set
 load_dotenv()  # This loads the variables from a .env file in the same directory
 
-# Configuration using environment variables 
-base_url = os.getenv('WEBDAV_URL') + '/files/' + os.getenv('WEBDAV_LOGIN') + '/'
-auth = HTTPBasicAuth(os.getenv('WEBDAV_LOGIN'), os.getenv('WEBDAV_PASSWORD'))
-
-
 
 # Redirect to documentation page when accessing base URL
 @app.get("/")
@@ -52,39 +73,48 @@ async def redirect_to_docs():
 
 app.include_router(ingest_router, prefix="/api/ingest")
 
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus scrape endpoint with the chat and ingestion stage timings."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness probe: the process serves requests."""
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness probe: 503 until the startup warm-up has finished, see `app.warmup.Warmup`."""
+    return JSONResponse(warmup.to_dict(), status_code=200 if warmup.ready else 503)
+
 app.include_router(chat_router, prefix="/api/chat")
-def list_contents(directory):
-    """List all contents of a WebDAV directory given a directory path."""
-    url = base_url + urllib.parse.quote(directory)
-    headers = {
-        "Depth": "1",  # Depth: 1 to list direct children only
-        "Content-Type": "application/xml"
-    }
-    propfind_body = '''
-    <d:propfind xmlns:d="DAV:">
-    <d:prop>
-        <d:resourcetype/>
-        <d:getcontenttype/>
-    </d:prop>
-    </d:propfind>
-    '''
-    response = requests.request("PROPFIND", url, headers=headers, data=propfind_body, auth=auth)
-    if response.status_code != 207:
-        return {"error": f"Error listing contents for {url}: {response.status_code}"}
-    tree = ElementTree.fromstring(response.content)
-    namespace = {'d': 'DAV:'}
-    items = []
-    for response in tree.findall('.//d:response', namespace):
-        href = response.find('.//d:href', namespace).text
-        resource_type = response.find('.//d:resourcetype', namespace)
-        item_type = 'directory' if resource_type.find('.//d:collection', namespace) is not None else 'file'
-        items.append({"href": href, "type": item_type})
-    return items
+
 
 @app.get("/files/{directory:path}")
-async def read_files(directory: str = Path(..., description="The directory to list contents from")):
-        """Endpoint to list files in a given directory of the WebDAV server."""
-        return list_contents(directory)
+async def read_files(
+    response: Response,
+    directory: str = Path(..., description="The directory to list contents from"),
+    offset: int = Query(0, ge=0, description="Number of entries to skip"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of entries to return"),
+    details: bool = Query(False, description="Include size and modified time"),
+):
+    """Endpoint to list files in a given directory of the WebDAV server."""
+    try:
+        items = await get_webdav_lister().list(directory)
+    except (WebDAVError, httpx.HTTPError) as e:
+        return {"error": str(e)}
+    response.headers["X-Total-Count"] = str(len(items))
+    page = items[offset : offset + limit if limit is not None else None]
+    if details:
+        return [
+            {"href": item["href"], "type": item["type"], "size": item["size"], "modified": item["modified"]}
+            for item in page
+        ]
+    return [{"href": item["href"], "type": item["type"]} for item in page]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.admission import AdmissionController
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_acquire_and_release():
+    async def scenario():
+        controller = AdmissionController("test", limit=2, max_queue=0, queue_timeout=1.0)
+        first = await controller.acquire()
+        second = await controller.acquire()
+        assert controller._in_flight == 2
+        first.release()
+        # releasing twice doesn't free a second slot
+        first.release()
+        assert controller._in_flight == 1
+        third = await controller.acquire()
+        second.release()
+        third.release()
+        assert controller._in_flight == 0
+
+    run(scenario())
+
+
+def test_waiting_request_gets_the_released_slot():
+    async def scenario():
+        controller = AdmissionController("test", limit=1, max_queue=1, queue_timeout=1.0)
+        slot = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller._waiting == 1
+        slot.release()
+        queued = await waiter
+        assert controller._waiting == 0
+        assert controller._in_flight == 1
+        queued.release()
+
+    run(scenario())
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        controller = AdmissionController("test", limit=1, max_queue=1, queue_timeout=1.0)
+        slot = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await controller.acquire()
+        assert error.value.status_code == 429
+        assert int(error.value.headers["Retry-After"]) >= 1
+        slot.release()
+        (await waiter).release()
+
+    run(scenario())
+
+
+def test_queue_timeout_is_rejected_with_503():
+    async def scenario():
+        controller = AdmissionController("test", limit=1, max_queue=1, queue_timeout=0.01)
+        slot = await controller.acquire()
+        with pytest.raises(HTTPException) as error:
+            await controller.acquire()
+        assert error.value.status_code == 503
+        assert "Retry-After" in error.value.headers
+        assert controller._waiting == 0
+        slot.release()
+        # the timed out request didn't take the slot
+        (await controller.acquire()).release()
+
+    run(scenario())
+
+
+def test_dependency_releases_the_slot():
+    async def scenario():
+        controller = AdmissionController("test", limit=1, max_queue=0, queue_timeout=1.0)
+        dependency = controller()
+        await dependency.__anext__()
+        assert controller._in_flight == 1
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+        assert controller._in_flight == 0
+
+    run(scenario())
+
+
+def test_stream_slot_is_only_released_on_error():
+    async def scenario():
+        controller = AdmissionController("test", limit=1, max_queue=0, queue_timeout=1.0)
+        dependency = controller.stream_slot()
+        slot = await dependency.__anext__()
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+        # the stream owns the slot now
+        assert controller._in_flight == 1
+        slot.release()
+
+        failing = controller.stream_slot()
+        await failing.__anext__()
+        with pytest.raises(ValueError):
+            await failing.athrow(ValueError("engine failed"))
+        assert controller._in_flight == 0
+
+    run(scenario())
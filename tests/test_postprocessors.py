@@ -0,0 +1,122 @@
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from app.engine.postprocessors import AdaptiveTopK, ContextPacker, drop_contained, merge_adjacent
+
+
+class WordEncoding:
+    """One token per word, enough to check the packing without a model tokenizer."""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def chunk(text, score, doc="doc", start=None, **metadata):
+    node = TextNode(text=text, metadata=metadata)
+    if doc is not None:
+        node.metadata["file_name"] = doc
+    if start is not None:
+        node.start_char_idx, node.end_char_idx = start, start + len(text)
+    return NodeWithScore(node=node, score=score)
+
+
+def packer(token_budget: int) -> ContextPacker:
+    return ContextPacker(token_budget=token_budget, count_tokens=count_words, encoding=WordEncoding())
+
+
+def top_k(**kwargs) -> AdaptiveTopK:
+    return AdaptiveTopK(**{"min_k": 1, "max_k": 5, "score_floor": 0.5, "min_gap": 0.1, **kwargs})
+
+
+def test_cutoff_at_the_largest_drop():
+    assert top_k().cutoff([0.9, 0.88, 0.71, 0.7]) == 2
+
+
+def test_cutoff_keeps_all_without_a_large_drop():
+    assert top_k().cutoff([0.9, 0.87, 0.84, 0.81]) == 4
+
+
+def test_cutoff_respects_min_and_max_k():
+    assert top_k(min_k=2).cutoff([0.9, 0.5, 0.49]) == 3
+    assert top_k(max_k=3).cutoff([0.9, 0.89, 0.88, 0.87, 0.86]) == 3
+
+
+def test_adaptive_top_k_drops_results_below_the_floor():
+    nodes = [chunk(f"text {i}", score, doc=f"doc{i}") for i, score in enumerate([0.8, 0.78, 0.4, 0.3])]
+    kept = top_k().postprocess_nodes(nodes)
+    assert [node.score for node in kept] == [0.8, 0.78]
+
+
+def test_adaptive_top_k_keeps_unscored_results_up_to_max_k():
+    nodes = [chunk(f"text {i}", None, doc=f"doc{i}") for i in range(8)]
+    assert len(top_k().postprocess_nodes(nodes)) == 5
+
+
+def test_merge_adjacent_by_offsets():
+    text = "alpha beta gamma delta epsilon zeta eta theta iota kappa"
+    first = chunk(text[:30], 0.7, start=0)
+    second = chunk(text[20:], 0.9, start=20)
+    merged = merge_adjacent([second, first])
+    assert len(merged) == 1
+    assert merged[0].node.get_content() == text
+    assert merged[0].score == 0.9
+
+
+def test_merge_adjacent_by_overlapping_text():
+    shared = "the overlapping sentence that both chunks share"
+    first = chunk("An opening line. " + shared, 0.6)
+    second = chunk(shared + " and a closing line.", 0.8)
+    merged = merge_adjacent([first, second])
+    assert len(merged) == 1
+    assert merged[0].node.get_content() == "An opening line. " + shared + " and a closing line."
+
+
+def test_merge_adjacent_keeps_other_documents_apart():
+    shared = "the overlapping sentence that both chunks share"
+    merged = merge_adjacent([chunk("One. " + shared, 0.6, doc="a"), chunk(shared + " Two.", 0.8, doc="b")])
+    assert len(merged) == 2
+
+
+def test_drop_contained_keeps_the_better_score():
+    paragraph = "a paragraph copied into two files"
+    kept = drop_contained([chunk(paragraph, 0.9, doc="a"), chunk("Intro. " + paragraph + " Outro.", 0.6, doc="b")])
+    assert len(kept) == 1
+    assert kept[0].node.metadata["file_name"] == "b"
+    assert kept[0].score == 0.9
+
+
+def test_packing_keeps_the_best_chunks_within_the_budget():
+    nodes = [
+        chunk("one two three four five", 0.9, doc=None),
+        chunk("six seven eight nine ten", 0.8, doc=None),
+        chunk("eleven twelve", 0.7, doc=None),
+    ]
+    packed = packer(token_budget=7).postprocess_nodes(nodes)
+    # the second chunk doesn't fit and is too short a remainder to cut, the third still fits
+    assert [node.node.get_content() for node in packed] == ["one two three four five", "eleven twelve"]
+
+
+def test_packing_cuts_the_first_chunk_that_does_not_fit():
+    words = " ".join(f"w{i}" for i in range(200))
+    packed = packer(token_budget=100).postprocess_nodes([chunk(words, 0.9, doc=None)])
+    assert len(packed) == 1
+    assert count_words(packed[0].node.get_content()) == 100
+
+
+def test_truncation_leaves_room_for_the_metadata():
+    words = " ".join(f"w{i}" for i in range(200))
+    node = chunk(words, 0.9, doc="report.pdf")
+    truncated = packer(token_budget=100)._truncated(node, 100)
+    assert count_words(truncated.node.get_content(metadata_mode="llm")) == 100
+    assert truncated.node.get_content().startswith("w0 w1")
+
+
+def test_truncation_skips_the_node_if_only_metadata_fits():
+    node = chunk("some text", 0.9, doc="a rather long file name.pdf")
+    assert packer(token_budget=100)._truncated(node, 3) is None
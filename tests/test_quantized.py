@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from app.engine.quantized import QuantizedVectorStore
+
+
+def corpus(count=200, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def nodes_of(vectors):
+    return [
+        TextNode(id_=f"n{i}", text=f"chunk {i}", metadata={"part": i % 2}, embedding=vector.tolist())
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def exact_top_k(vectors, query, top_k):
+    return [f"n{i}" for i in np.argsort(-(vectors @ query))[:top_k]]
+
+
+def search(store, query, top_k, **kwargs):
+    return store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k, **kwargs))
+
+
+@pytest.mark.parametrize("quantization", ["int8", "float16"])
+def test_rescored_results_match_exact_search(tmp_path, quantization):
+    vectors = corpus()
+    store = QuantizedVectorStore(str(tmp_path), quantization=quantization, rescore_candidates=50)
+    store.add(nodes_of(vectors))
+    for query in vectors[:10]:
+        result = search(store, query, 5)
+        assert result.ids == exact_top_k(vectors, query, 5)
+        # rescored similarities are the full-precision cosine similarities
+        assert result.similarities[0] == pytest.approx(1.0, abs=1e-5)
+        assert result.nodes[0].get_content() == f"chunk {result.ids[0][1:]}"
+
+
+def test_store_is_reloaded_from_disk(tmp_path):
+    vectors = corpus()
+    store = QuantizedVectorStore(str(tmp_path))
+    store.add(nodes_of(vectors))
+    store.delete_nodes(["n0", "n1"])
+
+    reloaded = QuantizedVectorStore(str(tmp_path))
+    assert len(reloaded) == len(vectors) - 2
+    assert reloaded.memory_bytes() == store.memory_bytes()
+    result = search(reloaded, vectors[5], 3)
+    assert result.ids == search(store, vectors[5], 3).ids
+    assert "n0" not in search(reloaded, vectors[0], 5).ids
+    assert [node.node_id for node in reloaded.get_nodes(["n1", "n2"])] == ["n2"]
+
+
+def test_compaction_drops_deleted_rows(tmp_path):
+    vectors = corpus()
+    store = QuantizedVectorStore(str(tmp_path))
+    store.add(nodes_of(vectors))
+    store.delete_nodes([f"n{i}" for i in range(50)])
+    payload = store.payload_bytes()
+    assert store.dead_rows() == 50
+
+    assert store.compact() == 50
+    assert store.dead_rows() == 0
+    assert store.payload_bytes() == payload
+    reloaded = QuantizedVectorStore(str(tmp_path))
+    assert len(reloaded) == 150
+    assert search(reloaded, vectors[60], 1).ids == ["n60"]
+
+
+def test_upsert_replaces_a_node(tmp_path):
+    vectors = corpus()
+    store = QuantizedVectorStore(str(tmp_path))
+    store.add(nodes_of(vectors[:10]))
+    replacement = TextNode(id_="n3", text="replaced", embedding=vectors[20].tolist())
+    store.add([replacement])
+    assert len(store) == 10
+    result = search(store, vectors[20], 1)
+    assert result.ids == ["n3"]
+    assert result.nodes[0].get_content() == "replaced"
+
+
+def test_metadata_filters(tmp_path):
+    vectors = corpus()
+    store = QuantizedVectorStore(str(tmp_path))
+    store.add(nodes_of(vectors))
+    filters = MetadataFilters(filters=[ExactMatchFilter(key="part", value=1)])
+    result = search(store, vectors[0], 5, filters=filters)
+    assert len(result.ids) == 5
+    assert all(int(node_id[1:]) % 2 == 1 for node_id in result.ids)
+    assert search(store, vectors[0], 5, filters=MetadataFilters(filters=[ExactMatchFilter(key="part", value=7)])).ids == []
+
+
+def test_memory_bytes_counts_the_payloads(tmp_path):
+    vectors = corpus(count=10, dim=8)
+    store = QuantizedVectorStore(str(tmp_path))
+    store.add(nodes_of(vectors))
+    assert store.payload_bytes() > 0
+    assert store.memory_bytes() == store.matrix_bytes() + store.payload_bytes()
+    before = store.payload_bytes()
+    store.delete_nodes(["n0"])
+    assert store.payload_bytes() < before
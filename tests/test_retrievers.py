@@ -0,0 +1,40 @@
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from app.engine.retrievers import merge_top_k, reciprocal_rank_fusion
+
+
+def ranked(*ids_and_scores):
+    return [NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=score) for node_id, score in ids_and_scores]
+
+
+def test_rrf_ranks_nodes_found_by_several_queries_first():
+    first = ranked(("a", 0.9), ("b", 0.8), ("c", 0.7))
+    second = ranked(("c", 0.95), ("b", 0.6), ("d", 0.5))
+    fused = reciprocal_rank_fusion([first, second], top_k=4)
+    # c: 1/63 + 1/61, b: 1/62 + 1/62, a: 1/61, d: 1/63
+    assert [node.node.node_id for node in fused] == ["c", "b", "a", "d"]
+
+
+def test_rrf_keeps_the_best_similarity():
+    fused = reciprocal_rank_fusion([ranked(("a", 0.4)), ranked(("a", 0.9))], top_k=1)
+    assert fused[0].score == 0.9
+
+
+def test_rrf_ignores_scores_for_the_order():
+    # a low similarity at the top of a list outranks a high one further down
+    fused = reciprocal_rank_fusion([ranked(("a", 0.1), ("b", 0.99))], top_k=2)
+    assert [node.node.node_id for node in fused] == ["a", "b"]
+
+
+def test_rrf_top_k_and_constant():
+    lists = [ranked(("a", 0.9), ("b", 0.8)), ranked(("b", 0.9), ("c", 0.8)), ranked(("c", 0.9), ("a", 0.8))]
+    assert len(reciprocal_rank_fusion(lists, top_k=2)) == 2
+    assert reciprocal_rank_fusion([], top_k=3) == []
+    # with k=0 a first place weighs twice a second place: a: 1 + 1/2, b: 1/2 + 1/3
+    fused = reciprocal_rank_fusion([ranked(("a", 0.5), ("b", 0.5)), ranked(("a", 0.5), ("b", 0.5))], top_k=2, k=0)
+    assert [node.node.node_id for node in fused] == ["a", "b"]
+
+
+def test_merge_top_k_orders_by_best_score():
+    merged = merge_top_k([ranked(("a", 0.5), ("b", 0.4)), ranked(("b", 0.9), ("c", 0.3))], top_k=2)
+    assert [(node.node.node_id, node.score) for node in merged] == [("b", 0.9), ("a", 0.5)]
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.engine import sessions
+from app.engine.sessions import SessionStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def test_unused_sessions_expire(clock):
+    store = SessionStore(max_sessions=10, ttl=60)
+    session = store.create()
+    clock.now += 30
+    assert store.get(session.id) is session
+    # using a session keeps it alive
+    clock.now += 50
+    assert store.get(session.id) is session
+    clock.now += 61
+    assert store.get(session.id) is None
+
+
+def test_least_recently_used_session_is_dropped(clock):
+    store = SessionStore(max_sessions=2, ttl=3600)
+    first = store.create()
+    second = store.create()
+    store.get(first.id)
+    third = store.create()
+    assert store.get(second.id) is None
+    assert store.get(first.id) is first
+    assert store.get(third.id) is third
+
+
+def test_delete():
+    store = SessionStore(max_sessions=2, ttl=3600)
+    session = store.create()
+    assert store.delete(session.id)
+    assert not store.delete(session.id)
+    assert store.get(session.id) is None
+
+
+def test_turns_of_a_session_run_one_at_a_time():
+    async def scenario():
+        store = SessionStore(max_sessions=2, ttl=3600, turn_timeout=0.01)
+        session = store.create()
+        turn = await store.begin_turn(session, "first question")
+        with pytest.raises(asyncio.TimeoutError):
+            await store.begin_turn(session, "second question")
+        await turn.finish("first answer")
+        # finishing twice doesn't record the turn again or release a lock it doesn't hold
+        await turn.finish("first answer")
+        assert session.turns == 1
+        assert [message.content for message in session.messages] == ["first question", "first answer"]
+        next_turn = await store.begin_turn(session, "second question")
+        next_turn.release()
+        assert not session.lock.locked()
+
+    asyncio.run(scenario())
+
+
+def test_turn_without_answer_is_not_recorded():
+    async def scenario():
+        store = SessionStore(max_sessions=2, ttl=3600)
+        session = store.create()
+        turn = await store.begin_turn(session, "question")
+        await turn.finish("")
+        assert session.turns == 0
+        assert session.messages == []
+        assert not session.lock.locked()
+
+    asyncio.run(scenario())